@@ -14,8 +14,10 @@ import matplotlib.patches as patches
 from scipy.optimize import curve_fit
 from scipy.optimize import leastsq
 from skimage.restoration import unwrap_phase
-from twoD_Gaussian import twoD_GaussianWithTilt
+from twoD_Gaussian import GaussianModel, grid
 from d4s import get_d4sigma
+from phase_shifting import lsqPhase, aiaPhase, closedPhase
+import dataset_index
 from IPython import embed
 
 class fdmsImage():
@@ -53,18 +55,7 @@ class fdmsImage():
 		image.fitGauss()
         image.plotOverview()'''
 
-        #define default behavior
-        
-        self._plot_save = plot_save
-        msg = '%s saving figures' % ['Disabled', 'Enabled'][self._plot_save]
-        print(msg)
-        logging.info(msg)
-
-        self._plot_show = plot_show
-        msg = '%s displaying figures' % ['Disabled', 'Enabled'][self._plot_show]
-        print(msg)
-        logging.info(msg)
-
+        self._setOptions(plot_save, plot_show)
         
         msg = ('read contents of file %s' % filename)
         print(msg)
@@ -74,19 +65,7 @@ class fdmsImage():
         else:
             logging.error('could not find file %s' % filename)
             raise Exception('could not find file %s' % filename)
-        if a_path:
-            if not os.path.isdir(a_path):
-                msg = 'could not find path to analysis results directory: %s' % a_path
-                logging.error(msg)
-                raise Exception(msg)
-            a_path = os.path.join(a_path, os.path.basename(filename)[:8])
-            if not os.path.isdir(a_path):
-                os.mkdir(a_path)
-                print('created new directory for analysis results: %s' % a_path)
-        else:
-            a_path = os.path.dirname(filename)
-        self.a_path = a_path
-        self.a_time = time.strftime('%Y%m%dT%H%M%S')
+        self._setAnalysisPath(a_path, filename)
         
         try:
             with h5py.File(filepath, "r") as hdf5File:
@@ -101,22 +80,119 @@ class fdmsImage():
                 self.numSteps   = hdf5File['images'].attrs['numSteps']
                 self.filename   = hdf5File['images'].attrs['filename'].decode()
                 self.filepath   = os.path.split(filepath)[0]
-                self.wavelength = getattr(hdf5File['images'], 'wavelength', 635E-9)
+                self.wavelength = hdf5File['images'].attrs.get('wavelength', 635E-9)
+                # files without camera roi contain full, unbinned images
+                self.cameraRoi  = tuple(hdf5File['images'].attrs.get('cameraRoi', (0, 0) + self.images.shape[2:]))
+                self.binning    = int(hdf5File['images'].attrs.get('binning', 1))
+                self.pvPerFringe = hdf5File['images'].attrs.get('pvPerFringe', None)
+                self.mode       = hdf5File['images'].attrs.get('mode', b'step')
+                if isinstance(self.mode, bytes):
+                    self.mode = self.mode.decode()
         except Exception as error:
             logging.error('error during reading file %s: %s' % (filepath, error))
             raise Exception(error)
         logging.debug('done reading file %s'  % filepath)
+
+    @classmethod
+    def fromArrays(cls, images, timestamps, setpoints, pvs, wavelength, filename, cameraRoi=None, binning=1,
+                   pvPerFringe=None, mode='step', a_path='', plot_save=True, plot_show=True):
+        '''
+        Creates an fdmsImage from a measurement in memory, e.g. directly from 
+        measure_surface.Phase_stepping.acquireSurface(), without the round 
+        trip through the hdf5 file
         
-    def analyzeSurface(self, useNrOfSteps=None, roi=None, scale=0.1172E-6):
+        parameters:
+            images      array (nrSteps, nrImages, height, width) with interferograms
+            timestamps  array (nrSteps, nrImages) with camera timestamps
+            setpoints   piezo setpoints of the phase steps
+            pvs         measured piezo positions of the phase steps
+            wavelength  wavelength of the interferometer in m
+            filename    path of the hdf5 file the measurement is (or will be)
+                            stored in, used for naming the analysis results
+            cameraRoi   sensor region (T,L,H,W) of the images in unbinned 
+                            pixels, defaults to the full image
+            binning     binning of the images
+            pvPerFringe piezo position change for one fringe, needed for the 
+                            least squares phase retrieval
+            mode        step or sweep, see measure_surface
+            a_path      path to directory with analysis results, see __init__.
+                            If omitted, the directory of filename is used.
+            plot_save   store generated plots to disk
+            plot_show   show generated plots
+
+        measurement = measure.acquireSurface()
+        measure.saveSurface(measurement, wait=False)
+        image = fdmsImage.fromArrays(**measurement)'''
+        self = cls.__new__(cls)
+        self._setOptions(plot_save, plot_show)
+        self._setAnalysisPath(a_path, filename)
+        filename = os.path.basename(filename)
+        self.images = np.asarray(images)
+        self.timestamps = np.asarray(timestamps)
+        self.setpoints = np.asarray(setpoints)
+        self.pvs = np.asarray(pvs)
+        (self.numSteps, self.numImages) = self.images.shape[:2]
+        self.filename = filename
+        self.filepath = self.a_path
+        self.wavelength = wavelength
+        if cameraRoi is None:
+            cameraRoi = (0, 0) + self.images.shape[2:]
+        self.cameraRoi = tuple(cameraRoi)
+        self.binning = int(binning)
+        self.pvPerFringe = pvPerFringe
+        self.mode = mode
+        logging.debug('created fdmsImage of %s from memory' % filename)
+        return self
+
+    def _setOptions(self, plot_save, plot_show):
+        #define default behavior
+        
+        self._plot_save = plot_save
+        msg = '%s saving figures' % ['Disabled', 'Enabled'][self._plot_save]
+        print(msg)
+        logging.info(msg)
+
+        self._plot_show = plot_show
+        msg = '%s displaying figures' % ['Disabled', 'Enabled'][self._plot_show]
+        print(msg)
+        logging.info(msg)
+
+    def _setAnalysisPath(self, a_path, filename):
+        if a_path:
+            if not os.path.isdir(a_path):
+                msg = 'could not find path to analysis results directory: %s' % a_path
+                logging.error(msg)
+                raise Exception(msg)
+            a_path = os.path.join(a_path, os.path.basename(filename)[:8])
+            if not os.path.isdir(a_path):
+                os.mkdir(a_path)
+                print('created new directory for analysis results: %s' % a_path)
+        else:
+            a_path = os.path.dirname(filename)
+        self.a_path = a_path
+        self.a_time = time.strftime('%Y%m%dT%H%M%S')
+        
+    def analyzeSurface(self, useNrOfSteps=None, roi=None, scale=0.1172E-6, algorithm=None):
         ''' 
         Calculates height profile from stored surface interferogram.
         useNrOfSteps=N  specify if only the first N images are to be used for 
                         analysis
-        roi=(T,L,H,W)   specify ROI as (top, left, height, width) Default is 
-                        whole image
-        scale=F         dimension of image pixel in the fiber plane. Default is 
-                        117 nm with the Mitutoyo 50X and 200 mm tube lens and 
-                        5.86 um detector pixels
+        roi=(T,L,H,W)   specify ROI as (top, left, height, width) in sensor 
+                        pixels, also when the images are cropped or binned by 
+                        the camera. Default is whole image
+        scale=F         dimension of a sensor pixel in the fiber plane. Default 
+                        is 117 nm with the Mitutoyo 50X and 200 mm tube lens 
+                        and 5.86 um detector pixels
+        algorithm=A     'closed' for the closed form 5, 6 and 7 step 
+                        algorithms, which assume 90 degree steps, 'lsq' for
+                        least squares with the phase shifts of the measured 
+                        piezo positions or 'aia' for least squares with phase 
+                        shifts solved from the images, starting from the 
+                        measured positions (or 90 degree steps if pvPerFringe
+                        is unknown). Default is 'aia' when pvPerFringe is 
+                        stored with the measurement, otherwise 'closed' for 5,
+                        6 and 7 steps and 'aia' for other step counts. Sweep
+                        mode measurements need pvPerFringe
         '''
         
         if useNrOfSteps:
@@ -131,62 +207,55 @@ class fdmsImage():
         logging.info('analyzing with %d number of steps. (stored in hdf5 file: %d)' % (self.numStepAnalysis, self.numSteps))
 
         if roi:
-            self.roi = roi
-            # simple checks for input sanity
-            msg = ''
-            if roi[0] < 0 | roi[2] < 0:
-                msg = 'invalid ROI settings, negative position is illegal!'
-            if roi[0] + roi[2] > np.shape(self.images)[2]:
-                msg = 'ROI (horizontal offset + width) exceeds image width'
-            if roi[1] + roi[3] > np.shape(self.images)[2]:
-                msg = 'ROI (vertical offset + height) exceeds image height'
-            if msg:
-                logging.error(msg)
-                raise Exception(msg)
+            self.roi = tuple(roi)
+            self.imageRoi = self._imageRoi(roi)
             logging.info('analyzing with roi: (%d, %d, %d, %d) (T,L,H,W)' % tuple(roi))
-        self.scale = scale
+        else:
+            self.imageRoi = (0, 0) + np.shape(self.images)[2:]
+        roi = self.imageRoi
+        self.scale = scale * self.binning
         
         # average multiple images taken at eacht phase step
         self.averagedImages = np.mean(self.images[:,0:3,...],1)
         img = self.averagedImages
-        if self.numStepAnalysis == 5:
-            # phase according to Schwider-Hariharan Algorithm
-            nom = (-2*img[1,...] + 2*img[3,...])
-            denom = (img[0,...] - 2*img[2,...] + img[4,...])
-            self.wrappedPhase = np.arctan2(nom, denom)
-    
-            # contrast according to Schwider-Hariharan Algorithm
-            term1 = np.power((img[1,...] - img[3,...]), 2)
-            term2 = np.power((img[0,...] -2*img[2,...] + img[4,...]), 2)
-            nom = 2*np.power(4*term1 + term2, 0.5)
-            denom = (img[0,...] + 2*(img[1,...] + img[2,...] + img[3,...]) + img[4,...])
-            self.contrast =  nom / denom
-        
-        if self.numStepAnalysis == 6:
-            # phase
-            nom = (-3*img[1,...] + 4*img[3,...] -img[5,...])
-            denom =  (img[0,...] -4*img[2,...] + 3*img[4,...])
-            self.wrappedPhase = np.arctan2(nom, denom)
-    
-            # contrast (based on first 5 images, Schwider-Hariharan Algorithm)
-            term1 = np.power((img[1,...] - img[3,...]), 2)
-            term2 = np.power((img[0,...] -2*img[2,...] + img[4,...]), 2)
-            nom = 2*np.power(4*term1 + term2, 0.5)
-            denom = (img[0,...] + 2*(img[1,...] + img[2,...] + img[3,...]) + img[4,...])
-            self.contrast =  nom / denom
-    
-        if self.numStepAnalysis == 7:
-            # phase
-            nom = 4*(img[1,...] - 2*img[3,...] + img[5,...])
-            denom = (-img[0,...] + 7*img[2,...] - 7*img[4,...] + img[6,...])
-            self.wrappedPhase = np.arctan2(nom, denom)
-     
-            # contrast (based on first 5 images, Schwider-Hariharan Algorithm)
-            term1 = np.power((img[1,...] - img[3,...]), 2)
-            term2 = np.power((img[0,...] -2*img[2,...] + img[4,...]), 2)
-            nom = 2*np.power(4*term1 + term2, 0.5)
-            denom = (img[0,...] + 2*(img[1,...] + img[2,...] + img[3,...]) + img[4,...])
-            self.contrast =  nom / denom
+        if algorithm is None:
+            if self.pvPerFringe is not None:
+                algorithm = 'aia'
+            elif self.mode == 'sweep':
+                algorithm = 'lsq'
+            elif self.numStepAnalysis in (5, 6, 7):
+                algorithm = 'closed'
+            else:
+                # solves the phase shifts, starting from the nominal 90 degree steps
+                algorithm = 'aia'
+        if algorithm == 'lsq' and self.pvPerFringe is None:
+            msg = 'the lsq algorithm needs pvPerFringe to calculate the phase shifts from the piezo positions'
+            if self.mode == 'sweep':
+                msg += ', which sweep mode measurements require. Set pvPerFringe of this image first'
+            logging.error(msg)
+            raise Exception(msg)
+        if algorithm == 'lsq':
+            shifts = self.getPhaseShifts()[:self.numStepAnalysis]
+            (self.wrappedPhase, self.contrast, _) = lsqPhase(img[:self.numStepAnalysis], shifts)
+        elif algorithm == 'aia':
+            if self.pvPerFringe is not None:
+                shifts = self.getPhaseShifts()[:self.numStepAnalysis]
+            else:
+                shifts = np.arange(self.numStepAnalysis) * np.pi/2
+            # solve the phase shifts in the roi, then the phase of all pixels
+            roiImages = img[:self.numStepAnalysis, roi[0]:roi[0]+roi[2], roi[1]:roi[1]+roi[3]]
+            shifts = aiaPhase(roiImages, shifts)[3]
+            (self.wrappedPhase, self.contrast, _) = lsqPhase(img[:self.numStepAnalysis], shifts)
+            self._logPhaseShifts(shifts)
+        elif algorithm != 'closed' or self.numStepAnalysis not in (5, 6, 7):
+            msg = 'algorithm %s not available for %d steps' % (algorithm, self.numStepAnalysis)
+            logging.error(msg)
+            raise Exception(msg)
+        self.algorithm = algorithm
+        logging.info('phase retrieval with %s algorithm' % algorithm)
+
+        if algorithm == 'closed':
+            (self.wrappedPhase, self.contrast) = closedPhase(img[:self.numStepAnalysis])
 
         if roi:
             wrappedPhase = self.wrappedPhase[roi[0]:roi[0]+roi[2], roi[1]:roi[1]+roi[3]]
@@ -203,20 +272,79 @@ class fdmsImage():
         self.height -= np.mean(corners)
         logging.info('calculating contrast, phase and phase unwrapping done')
         
-        img = self.averagedImages
-        nom = (img[4,...] - img[0,...])
-        denom =  2*(img[3,...] - img[1,...])
-        self.phaseStep = np.arccos(nom/denom)[roi[0]:roi[0]+roi[2], roi[1]:roi[1]+roi[3]]
-
-        idx = np.logical_not(np.isnan(self.phaseStep))
-        phaseMean = np.mean(self.phaseStep[idx].reshape(-1))/np.pi*180
-        phaseStd = np.std(self.phaseStep[idx].reshape(-1))/np.pi*180
-        msg = 'Phase step calibration info:\n\tmean phase step value: %.3f deg\n\tstandard deviation: %.2f deg (using the first 5 steps only!!)' % (phaseMean, phaseStd)
+        if algorithm in ('lsq', 'aia'):
+            # steps between the measured piezo positions or solved by aia
+            steps = np.diff(shifts)
+            self.phaseStep = np.full(self.unwrapped_phase.shape, np.mean(steps))
+            phaseMean = np.mean(steps)/np.pi*180
+            phaseStd = np.std(steps)/np.pi*180
+            msg = 'Phase step calibration info:\n\tmean phase step value: %.3f deg\n\tstandard deviation: %.2f deg (%s phase shifts)' % (phaseMean, phaseStd, ['measured', 'solved'][algorithm == 'aia'])
+        else:
+            img = self.averagedImages
+            nom = (img[4,...] - img[0,...])
+            denom =  2*(img[3,...] - img[1,...])
+            self.phaseStep = np.arccos(nom/denom)[roi[0]:roi[0]+roi[2], roi[1]:roi[1]+roi[3]]
+
+            idx = np.logical_not(np.isnan(self.phaseStep))
+            phaseMean = np.mean(self.phaseStep[idx].reshape(-1))/np.pi*180
+            phaseStd = np.std(self.phaseStep[idx].reshape(-1))/np.pi*180
+            msg = 'Phase step calibration info:\n\tmean phase step value: %.3f deg\n\tstandard deviation: %.2f deg (using the first 5 steps only!!)' % (phaseMean, phaseStd)
         print(msg)
         logging.info(msg)
         self.phaseMean = phaseMean
         self.phaseStd = phaseStd
         
+    def getPhaseShifts(self):
+        '''returns the phase shifts in rad of all phase steps relative to the
+        first one, from the measured piezo positions and pvPerFringe'''
+        if self.pvPerFringe is None:
+            msg = 'pvPerFringe unknown, set it before using the least squares algorithm'
+            logging.error(msg)
+            raise Exception(msg)
+        pvs = np.asarray(self.pvs, dtype=np.float64)
+        return 2*np.pi*(pvs - pvs[0])/self.pvPerFringe
+
+    def _logPhaseShifts(self, shifts):
+        self.phaseShifts = shifts
+        msg = 'solved phase shifts: %s deg' % ', '.join('%.1f' % v for v in shifts/np.pi*180)
+        print(msg)
+        logging.info(msg)
+        pvs = np.asarray(self.pvs[:len(shifts)], dtype=np.float64)
+        pvs = pvs - pvs[0]
+        if np.any(pvs):
+            # least squares through the origin of pv change versus phase shift
+            self.fittedPvPerFringe = 2*np.pi * np.dot(pvs, shifts) / np.dot(shifts, shifts)
+            msg = 'pv per fringe from solved phase shifts: %.4f' % self.fittedPvPerFringe
+            if self.pvPerFringe is not None:
+                msg += ' (stored: %.4f)' % self.pvPerFringe
+            print(msg)
+            logging.info(msg)
+
+    def _imageRoi(self, roi):
+        '''converts a ROI (T,L,H,W) in sensor pixels to pixels of the stored 
+        images, which may be cropped and binned by the camera'''
+        (top, left, height, width) = self.cameraRoi
+        msg = ''
+        if roi[2] <= 0 or roi[3] <= 0:
+            msg = 'invalid ROI settings, height and width must be positive!'
+        elif roi[0] < top or roi[1] < left:
+            msg = 'ROI starts outside the camera region (%d,%d,%d,%d) (T,L,H,W)' % self.cameraRoi
+        elif roi[0] + roi[2] > top + height:
+            msg = 'ROI (vertical offset + height) exceeds image height'
+        elif roi[1] + roi[3] > left + width:
+            msg = 'ROI (horizontal offset + width) exceeds image width'
+        if msg:
+            logging.error(msg)
+            raise Exception(msg)
+        b = self.binning
+        return ((roi[0] - top)//b, (roi[1] - left)//b, roi[2]//b, roi[3]//b)
+
+    def _centroidIndex(self):
+        # indices of the fitted centroid in the height profile
+        xd = int((self.x_detector - self.cameraRoi[1])/self.binning - self.imageRoi[1])
+        yd = int((self.y_detector - self.cameraRoi[0])/self.binning - self.imageRoi[0])
+        return (xd, yd)
+
     def plotInterferograms(self, interpolation="none"):
         filename = self.filename
         try:
@@ -234,8 +362,8 @@ class fdmsImage():
             plotdata = self.averagedImages[ii,...]
             ax.imshow(plotdata, cmap='gray', interpolation=interpolation)
             if hasattr(self, 'roi'):
-                roi = self.roi
-                rect = patches.Rectangle((roi[1],roi[0]),roi[3],roi[2], \
+                imageRoi = self.imageRoi
+                rect = patches.Rectangle((imageRoi[1],imageRoi[0]),imageRoi[3],imageRoi[2], \
                                          linewidth=1,edgecolor='r',facecolor='none')
                 ax.add_patch(rect)
             title = '#%d' % ii
@@ -248,6 +376,7 @@ class fdmsImage():
         ax.axis('off')
         
         if hasattr(self, 'roi'):
+            roi = self.roi
             roitxt = 'ROI(T,L,H,W): (%d,%d,%d,%d)' % (roi[0],roi[1],roi[2],roi[3])
         else:
             roitxt = 'no ROI defined'
@@ -305,7 +434,7 @@ class fdmsImage():
                 plotdata = self.images[ii,jj,...]
                 ax.imshow(plotdata, cmap='gray', interpolation=interpolation)
                 if hasattr(self, 'roi'):
-                    roi = self.roi
+                    roi = self.imageRoi
                     rect = patches.Rectangle((roi[1],roi[0]),roi[3],roi[2], \
                                              linewidth=1,edgecolor='r',facecolor='none')
                     ax.add_patch(rect)
@@ -414,13 +543,14 @@ class fdmsImage():
         with h5py.File(HDF5_FILE, 'w') as f:
             dset = f.create_dataset("height", data=height, compression='lzf')
             # filename containing interferogram images
-            dset.attrs['filename'] = np.string_(self.filename)
+            dset.attrs['filename'] = np.bytes_(self.filename)
             # timestamp of analysis
             dset.attrs['analysis_timestamp'] = self.a_time
             # pixel size of image
             dset.attrs['scale'] = self.scale
-            # used ROI of interferogram
+            # used ROI of interferogram in sensor pixels
             dset.attrs['roi'] = self.roi
+            dset.attrs['binning'] = self.binning
             shape = height.shape
             extent = self.scale*1e6 * np.array((-shape[1], shape[1], -shape[0], shape[0]))/2
             # extent (use in imshow plot function as extent=list(extent) argument for scaling axes)
@@ -448,11 +578,8 @@ class fdmsImage():
         else:
             logging.debug('using manually entered height profile') 
         shape = np.shape(data)
-        x = np.linspace(0, shape[1], shape[1]) * self.scale *1e6
-        x = x-np.mean(x)
-        y = np.linspace(0, shape[0], shape[0]) * self.scale *1e6
-        y = y-np.mean(y)
-        x, y = np.meshgrid(x, y)
+        model = GaussianModel(shape, self.scale*1e6, centered=True)
+        (x, y) = model.grid
         
         # calculate initial estimages
         # size of square for which corner intensities are averaged            
@@ -471,7 +598,7 @@ class fdmsImage():
 
         (yo, xo) = (0, 0)
         detrend_params = (0, xo, yo, 4, 4, theta, offset, xtilt, ytilt)
-        trend = twoD_GaussianWithTilt((x,y, self.scale), *detrend_params).reshape(shape)
+        trend = model.evaluate(*detrend_params)
         # perform rough detrend so amplitude and sigma can be estimated
         detrended_data = data - trend
         # height at corners: [BL, BR, UL, UR]
@@ -479,7 +606,10 @@ class fdmsImage():
                         np.mean(detrended_data[-bs:,:bs]), np.mean(detrended_data[-bs:,-bs:])]
         amplitude = np.min(detrended_data) - np.mean(detr_corners)
         logging.debug('found amplitude: %.2E' % (amplitude))
-        (d4s_x, d4s_y, xo_px, yo_px) = get_d4sigma(detrended_data, 1)
+        try:
+            (d4s_x, d4s_y, xo_px, yo_px) = get_d4sigma(detrended_data, 1)
+        except ValueError:
+            (d4s_x, d4s_y, xo_px, yo_px) = (np.nan,)*4
         if np.isnan(np.array([d4s_x, d4s_y, xo_px, yo_px])).any():
             sigma_x, sigma_y = 3, 3
             xo, yo = 0, 0
@@ -504,13 +634,16 @@ class fdmsImage():
         for line in (txt % vals).splitlines():
             logging.info(line)
         
-        initial_guessSurf = twoD_GaussianWithTilt((x, y, self.scale), *initial_guess).reshape(shape)
-        popt, pcov = curve_fit(twoD_GaussianWithTilt, (x, y, self.scale), data.ravel(), p0=initial_guess)
+        initial_guessSurf = model.evaluate(*initial_guess, out=np.empty(shape))
+        # the model evaluates on its own cached grid, no xdata needed
+        popt, pcov = curve_fit(model, None, data.ravel(), p0=initial_guess)
+        # the model only depends on sigma**2, the fit may converge to negative sigmas
+        popt[3:5] = np.abs(popt[3:5])
         if popt[3] < popt[4]:
             popt[3], popt[4] = popt[4], popt[3]
             popt[5] += (popt[5] + np.pi/4)
         popt[5] %= np.pi/2
-        data_fitted = twoD_GaussianWithTilt((x, y, self.scale), *popt).reshape(shape)
+        data_fitted = model.evaluate(*popt, out=np.empty(shape))
         self.data_fitted = data_fitted
         self.popt = popt
         
@@ -527,12 +660,13 @@ class fdmsImage():
         # calculate centroid coordinates in detector pixels
         mnx, mxx = np.min(x), np.max(x)
         mny, mxy = np.min(y), np.max(y)
+        (top, left) = self.cameraRoi[:2]
         if hasattr(self, 'roi'):
-            self.x_detector = (popt[1]-mnx)/(mxx-mnx)*(x.shape[1]) + self.roi[1]
-            self.y_detector = (popt[2]-mny)/(mxy-mny)*(y.shape[0]) + self.roi[0]
+            self.x_detector = ((popt[1]-mnx)/(mxx-mnx)*(x.shape[1]) + self.imageRoi[1])*self.binning + left
+            self.y_detector = ((popt[2]-mny)/(mxy-mny)*(y.shape[0]) + self.imageRoi[0])*self.binning + top
         else:
-            self.x_detector = (popt[1]-mnx)/(mxx-mnx)*(x.shape[1]-1)
-            self.y_detector = (popt[2]-mny)/(mxy-mny)*(y.shape[0]-1)
+            self.x_detector = (popt[1]-mnx)/(mxx-mnx)*(x.shape[1]-1)*self.binning + left
+            self.y_detector = (popt[2]-mny)/(mxy-mny)*(y.shape[0]-1)*self.binning + top
         
         txt2 = 'centroid location in detector pixels: (%.1f, %.1f)  (left, top)'% (self.x_detector, self.y_detector)
         print(txt2)
@@ -641,7 +775,10 @@ class fdmsImage():
         print(msg6)
         logging.info(msg6)
 
-        msg7 = 'average phase step: %.3f deg, stdev: %.3f deg(based on first 5 interferograms only!)' % (self.phaseMean, self.phaseStd)
+        basis = {'closed': 'based on first 5 interferograms only!',
+                 'lsq': 'from measured phase shifts',
+                 'aia': 'from solved phase shifts'}[self.algorithm]
+        msg7 = 'average phase step: %.3f deg, stdev: %.3f deg(%s)' % (self.phaseMean, self.phaseStd, basis)
         print(msg7, '\n\n')
         logging.info(msg7)
 
@@ -688,6 +825,7 @@ class fdmsImage():
             logging.error('error during writing to file %s: %s' % (os.path.join(fp, fn), error))
             raise Exception(error)
         print('wrote dimple parameters in csv file %s' % os.path.join(fp, fn))
+        dataset_index.addAnalysis(os.path.join(fp, fn), dict(zip(dataset_index.ANALYSIS_COLUMNS, vals1 + vals2)), self.a_time)
 
     
     def plotOverview(self, interpolation='none'):
@@ -698,8 +836,9 @@ class fdmsImage():
         plt.title('%s - interferogram 0/%d' % (self.filename[:15],self.numStepAnalysis))
         roi = np.array(self.roi)*self.scale*1e6
         extent = [0, im.shape[1], 0, im.shape[0]]
-        rect = patches.Rectangle((self.roi[1], im.shape[0]-self.roi[0]-self.roi[2]), self.roi[3], \
-                        self.roi[2],linewidth=1, linestyle='--',edgecolor='w',facecolor='none')
+        imageRoi = self.imageRoi
+        rect = patches.Rectangle((imageRoi[1], im.shape[0]-imageRoi[0]-imageRoi[2]), imageRoi[3], \
+                        imageRoi[2],linewidth=1, linestyle='--',edgecolor='w',facecolor='none')
         for map in ('cividis', 'plasma', 'winter'):
             if map in plt.colormaps():
                 cmap = map
@@ -720,11 +859,7 @@ class fdmsImage():
         gfit = self.data_fitted
         popt = self.popt
         shape = np.shape(height)
-        x = np.linspace(0, shape[1], shape[1]) * self.scale *1e6
-        x = x-np.mean(x)
-        y = np.linspace(0, shape[0], shape[0]) * self.scale *1e6
-        y = y-np.mean(y)
-        x, y = np.meshgrid(x, y)
+        (x, y) = grid(shape, self.scale*1e6, centered=True)
         extent = self.scale*1e6 * np.array((-shape[1], shape[1], -shape[0], shape[0]))/2
         a = plt.imshow(height, interpolation=interpolation, extent=extent, aspect='auto', cmap='jet')
         plt.xlabel('position (um)')
@@ -748,8 +883,7 @@ class fdmsImage():
 
         plt.subplot(4,3,7)
         # plot horizontal crossection
-        xd = int(self.x_detector - self.roi[1])
-        yd = int(self.y_detector - self.roi[0])
+        (xd, yd) = self._centroidIndex()
         plt.plot(x[0,:],height[yd,:],label='height')
         plt.plot(x[0,:],gfit[yd,:],label='gauss fit')
         plt.xlabel(u'x (um)')
@@ -788,8 +922,7 @@ class fdmsImage():
 
         plt.subplot(4,3,9)
         # plot horizontal crossection
-        xd = int(self.x_detector - self.roi[1])
-        yd = int(self.y_detector - self.roi[0])
+        (xd, yd) = self._centroidIndex()
         plt.plot(x[0,:],height[yd,:],label='height')
         plt.plot(x[0,:],self.sphereFit[yd,:],label='sphere fit')
         plt.xlabel(u'x (um)')
@@ -8,7 +8,9 @@ import numpy as np
 import sys
 import socket
 import time
+import pickle
 import numpy as np
+import timing
 
 
 class CameraError(Exception):
@@ -21,6 +23,11 @@ class CameraClient:
     def __init__(self, camera_ini, host='localhost', tcpport=14901):
         logging.info('opening connection to camera application')
         self._ini = camera_ini
+        # region (T,L,H,W) in full sensor pixels and binning applied to every image
+        self.roi = camera_ini.get('roi')
+        self.binning = camera_ini.get('binning', 1)
+        if self.binning < 1:
+            raise CameraError('illegal binning in .ini file: %d' % self.binning)
         try:
             self._sock = socket.create_connection((host, tcpport))
             self._recv_buf = bytearray()
@@ -97,9 +104,51 @@ class CameraClient:
 
         Note that calling this function repeatedly may cause the same
         image to be returned more than once.
+
+        The image is cropped to the roi and binned as set in the [camera]
+        section of the .ini file, decode_meta_data() reports the size and
+        the sensor region of the returned image.
         '''
 
         logging.debug('request image from camera application')
+        with timing.span('camera.recv'):
+            (d1, d2) = self._receive_image()
+        with timing.span('camera.decode'):
+            # np.loads() was an alias of pickle.loads(), removed in numpy 1.22
+            image_data = pickle.loads(d1)
+            meta_data = pickle.loads(d2)
+        if self.roi is not None or self.binning > 1:
+            with timing.span('camera.crop'):
+                image_data = self.crop_image(image_data, meta_data)
+        return (image_data, meta_data)
+
+    def _image_roi(self, meta):
+        '''returns the sensor region (T,L,H,W) of the image after cropping'''
+        (top, left) = (int(meta['offset_y']), int(meta['offset_x']))
+        (height, width) = (int(meta['height']), int(meta['width']))
+        if self.roi is not None:
+            (T, L, H, W) = self.roi
+            if T < top or L < left or T + H > top + height or L + W > left + width:
+                raise CameraError('camera roi (%d,%d,%d,%d) (T,L,H,W) exceeds image region (%d,%d,%d,%d)'
+                                  % (T, L, H, W, top, left, height, width))
+            (top, left, height, width) = (T, L, H, W)
+        # only whole bins are kept
+        return (top, left, height - height % self.binning, width - width % self.binning)
+
+    def crop_image(self, image, meta):
+        '''crops an image to the camera roi and averages binning x binning
+        blocks, the data type of the image is kept'''
+        (T, L, H, W) = self._image_roi(meta)
+        (top, left) = (T - int(meta['offset_y']), L - int(meta['offset_x']))
+        image = image[top:top+H, left:left+W]
+        if self.binning > 1:
+            b = self.binning
+            binned = image.reshape(H//b, b, W//b, b).sum(axis=(1, 3), dtype=np.float64) / b**2
+            image = np.rint(binned).astype(image.dtype)
+        return image
+
+    def _receive_image(self):
+        '''requests an image and returns the pickled image and meta data'''
         self._sock.sendall(b'get_image\n')
         # Read image data.
         resp = self.read_line()
@@ -123,14 +172,17 @@ class CameraClient:
         eol = self.read_bytes(1)
         if eol != b'\n':
             raise CameraError('Invalid response from server')
-        image_data = np.loads(d1)
-        meta_data = np.loads(d2)
-        return (image_data, meta_data)
+        return (d1, d2)
 
     def decode_meta_data(self, meta):
-        '''decodes the image meta data'''
-        meta_data = {'width': meta['width'],
-             'height': meta['height'],
+        '''decodes the image meta data. width and height are the size of the
+        image returned by get_image(), roi is its region (T,L,H,W) on the
+        sensor in unbinned pixels'''
+        roi = self._image_roi(meta)
+        meta_data = {'width': roi[3] // self.binning,
+             'height': roi[2] // self.binning,
+             'roi': roi,
+             'binning': self.binning,
              'offset_x': meta['offset_x'],
              'offset_y': meta['offset_y'],
              'pixel_format': meta['pixel_format'].decode(),
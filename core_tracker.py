@@ -0,0 +1,191 @@
+'''M. Eschen, 2017
+
+Live tracking of the fibre core position for alignment. A background thread
+pulls the frames from the camera server, estimates the core position with
+fit_core.estimateCore() and publishes the latest position.
+
+Only the most recent position is kept for the consumers. A consumer that is
+slower than the camera skips positions, it never receives an old one. The
+camera server also returns only its most recent frame, so frames that arrive
+while a position is being estimated are dropped as well. Either way the
+latency stays at one frame.
+
+usage, with the camera client of fdms_control:
+    tracker = core_tracker.CoreTracker(cam)
+    tracker.start()
+    for position in tracker.positions(duration=10):
+        print('(%.2f, %.2f) px at %.1f Hz' % (position['x0'], position['y0'], position['rate']))
+    tracker.terminate()
+or with a function that is called with every new position in the tracker
+thread:
+    tracker = core_tracker.CoreTracker(cam, callback=func)
+
+The camera client can not be used for other measurements while the tracker
+is running.
+'''
+
+import time
+import logging
+from collections import deque
+from threading import Thread, Condition, Event
+import numpy as np
+from fit_core import estimateCore
+from measure_surface import FrameTracker, MeasureSurfaceError
+
+log = logging.getLogger('core_tracker')
+
+
+class CoreTrackerError(Exception):
+    pass
+
+
+class CoreTracker(Thread):
+    def __init__(self, cam, callback=None, window=None, method='parabola', historyLength=1000):
+        '''cam            camera.CameraClient instance
+        callback       optional function called with every new position dict,
+                       runs in the tracker thread and should return quickly
+        window         window size of estimateCore(), default is adaptive
+        method         'parabola' or 'moments', see estimateCore()
+        historyLength  number of positions kept for getHistory()
+
+        A position is a dict with:
+            x0, y0            core position in sensor pixels
+            sigma_x, sigma_y  core width in sensor pixels
+            amplitude, offset in counts
+            time              host time of the exposure start
+            latency           time from the exposure start to publishing
+            frame_id          camera frame id
+            rate              tracked frames per second over the last second
+            dropped           camera frames not tracked since the start
+        '''
+        Thread.__init__(self, daemon=True)
+        self.cam = cam
+        self.callback = callback
+        self.window = window
+        self.method = method
+        self.errors = 0
+        self.dropped = 0
+        self._latest = None
+        self._history = deque(maxlen=historyLength)
+        self._times = deque()
+        self._newPosition = Condition()
+        self._terminate = Event()
+
+    def run(self):
+        frames = FrameTracker(self.cam)
+        frameId = None
+        while not self._terminate.is_set():
+            try:
+                (image, meta, start) = frames.getFrame(timeout=1.0)
+                vals = estimateCore(image, window=self.window, method=self.method)
+            except (MeasureSurfaceError, ValueError) as err:
+                self.errors += 1
+                log.warning('core tracking failed: %s' % err)
+                self._terminate.wait(0.1)
+                continue
+            except Exception as err:
+                # lost connection to the camera server
+                self.errors += 1
+                log.error('core tracker stopped: %s' % err)
+                break
+            if frameId is not None and meta['frame_id'] > frameId + 1:
+                self.dropped += meta['frame_id'] - frameId - 1
+            frameId = meta['frame_id']
+            position = self._toSensor(vals, meta)
+            position.update({'time': start, 'frame_id': frameId, 'dropped': self.dropped})
+            now = time.time()
+            self._times.append(now)
+            while self._times[0] < now - 1.0:
+                self._times.popleft()
+            if len(self._times) > 1:
+                position['rate'] = (len(self._times) - 1) / (now - self._times[0])
+            else:
+                position['rate'] = 0.0
+            position['latency'] = now - start
+            with self._newPosition:
+                self._latest = position
+                self._history.append(position)
+                self._newPosition.notify_all()
+            if self.callback is not None:
+                try:
+                    self.callback(position)
+                except Exception as err:
+                    self.errors += 1
+                    log.error('core tracker callback failed: %s' % err)
+        with self._newPosition:
+            self._newPosition.notify_all()
+
+    def _toSensor(self, vals, meta):
+        # image pixels to sensor pixels, the centre of a bin is at (b-1)/2
+        (amplitude, x0, y0, sigma_x, sigma_y, offset) = vals
+        b = meta.get('binning', 1)
+        (top, left) = meta.get('roi', (meta.get('offset_y', 0), meta.get('offset_x', 0)))[:2]
+        return {'x0': (x0 + 0.5)*b - 0.5 + left, 'y0': (y0 + 0.5)*b - 0.5 + top,
+                'sigma_x': sigma_x*b, 'sigma_y': sigma_y*b, 'amplitude': amplitude, 'offset': offset}
+
+    def terminate(self):
+        self._terminate.set()
+        if self.is_alive():
+            self.join(5.0)
+
+    def latestPosition(self, maxAge=0.5, timeout=1.0):
+        '''returns the most recent position whose exposure started at most
+        maxAge seconds ago, waits at most timeout seconds for one'''
+        deadline = time.time() + timeout
+        with self._newPosition:
+            while True:
+                if self._latest is not None and time.time() - self._latest['time'] <= maxAge:
+                    return self._latest
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.is_alive():
+                    break
+                self._newPosition.wait(remaining)
+        msg = 'no core position younger than %.3fs available' % maxAge
+        log.error(msg)
+        raise CoreTrackerError(msg)
+
+    def positions(self, duration=None, timeout=1.0):
+        '''generator of the positions published after the call, for duration
+        seconds or until the tracker stops. Positions published while the
+        consumer was busy are skipped, every yielded position is the most
+        recent one.'''
+        end = None if duration is None else time.time() + duration
+        with self._newPosition:
+            last = self._latest
+        while end is None or time.time() < end:
+            with self._newPosition:
+                deadline = time.time() + timeout
+                while self._latest is last and self.is_alive():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        msg = 'no new core position within %.1f s' % timeout
+                        log.error(msg)
+                        raise CoreTrackerError(msg)
+                    self._newPosition.wait(remaining)
+                if self._latest is last:
+                    return
+                last = self._latest
+            yield last
+
+    def getHistory(self, window=None):
+        '''returns the list of positions of the last window seconds, or all
+        kept positions when window is None'''
+        with self._newPosition:
+            history = list(self._history)
+        if window is not None:
+            tmin = time.time() - window
+            history = [p for p in history if p['time'] >= tmin]
+        return history
+
+    def printStats(self, window=10.0):
+        history = self.getHistory(window)
+        if not history:
+            print('no core positions in the last %.1fs' % window)
+            return
+        x = np.array([p['x0'] for p in history])
+        y = np.array([p['y0'] for p in history])
+        latency = np.array([p['latency'] for p in history])
+        print('core position over last %.1fs (%d frames, %.1f Hz): x %.2f +/- %.2f px, y %.2f +/- %.2f px' %
+              (window, len(history), history[-1]['rate'], np.mean(x), np.std(x), np.mean(y), np.std(y)))
+        print('latency %.1f ms (max %.1f ms), %d frames dropped, %d errors' %
+              (np.mean(latency)*1e3, np.max(latency)*1e3, self.dropped, self.errors))
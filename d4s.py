@@ -1,31 +1,78 @@
-def get_d4sigma(array, pix_size):
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=32)
+def _coordinates(n):
+    # pixel coordinates 1..n, shared by all calls with the same size
+    coordinates = np.arange(1, n + 1, dtype=np.float64)
+    coordinates.flags.writeable = False
+    return coordinates
+
+
+def _moments(profile, x):
+    # total, centroid and variance of a marginal distribution at coordinates x
+    total = np.sum(profile)
+    if not total > 0:
+        raise ValueError('no signal above the background to calculate the d4sigma width')
+    centroid = np.dot(profile, x) / total
+    variance = np.dot(profile, (x - centroid)**2) / total
+    if not variance > 0:
+        raise ValueError('no positive second moment to calculate the d4sigma width')
+    return (total, centroid, variance)
+
+
+def get_d4sigma(array, pix_size, background='min', iterations=10):
     ''' (d4s_x, s4s_y, centr_x, centr_y) = get_d4sigma(array, pix_size)
-    
+
     returns the d4sigma as well as the centroids for X and Y
     array:    2D numpy array with data
     pix_size:   pixel size; square pixels are assumed
-    important: background is zero on average!!!   '''
-    
-    import numpy as np
-    
-    array = array-np.min(array)
+    background: 'min' subtracts the minimum of the array
+                'iso' ISO 11146 style: subtracts the mean of the corners
+                (10% of the size) and integrates over a window of three
+                times the d4sigma width around the centroid, iterated until
+                the window no longer changes
+    important for 'min': background is zero on average!!!
+    raises ValueError when the sum over the (window of the) array after
+    background subtraction is not positive, or when the resulting second 
+    moment in x or y is not positive, which can happen with a negative 
+    background subtracted signal in 'iso' mode
+
+    The moments are calculated from the row and column sums of the (window
+    of the) array instead of from 2D coordinate grids.   '''
+
+    array = np.asarray(array, dtype=np.float64)
     f_y, f_x = array.shape
-    
+    if background == 'min':
+        array = array - np.min(array)
+    elif background == 'iso':
+        bs = max(1, int(min(f_y, f_x) / 10))
+        corners = np.concatenate((array[:bs,:bs].ravel(), array[:bs,-bs:].ravel(),
+                                  array[-bs:,:bs].ravel(), array[-bs:,-bs:].ravel()))
+        array = array - np.mean(corners)
+    else:
+        raise ValueError('unknown background mode: %s' % background)
+
     #(uses 'D4sigma or second moment width' from wikipedia
-    #get centroids
-    x = np.linspace(1, f_x, f_x)
-    y = np.linspace(1, f_y, f_y)
-    x, y = np.meshgrid(x, y)
-    total_sum = np.sum(array)
-    centr_nom_x = np.sum(array * x)
-    centr_nom_y = np.sum(array * y)
-    centroid_x = centr_nom_x / total_sum
-    centroid_y = centr_nom_y / total_sum
+    #marginal distributions
+    window = (0, f_y, 0, f_x)
+    for ii in range(iterations if background == 'iso' else 1):
+        (T, B, L, R) = window
+        part = array[T:B, L:R]
+        (total, centroid_x, var_x) = _moments(np.sum(part, axis=0), _coordinates(f_x)[L:R])
+        (total, centroid_y, var_y) = _moments(np.sum(part, axis=1), _coordinates(f_y)[T:B])
+        # integration window of 3 times d4sigma, 1.5 times on both sides
+        (wx, wy) = (6 * np.sqrt(var_x), 6 * np.sqrt(var_y))
+        newWindow = (max(0, int(np.floor(centroid_y - 1 - wy))), min(f_y, int(np.ceil(centroid_y + wy))),
+                     max(0, int(np.floor(centroid_x - 1 - wx))), min(f_x, int(np.ceil(centroid_x + wx))))
+        if newWindow == window:
+            break
+        window = newWindow
 
     #determine D4sigma values
-    d4s_nom_x = np.sum(array * np.power(((x) - centroid_x), 2))
-    d4s_nom_y = np.sum(array * np.power(((y) - centroid_y), 2))
-    d4s_x = 4*np.power(d4s_nom_x / total_sum, 0.5) * pix_size
-    d4s_y = 4*np.power(d4s_nom_y / total_sum, 0.5) * pix_size
+    d4s_x = 4*np.power(var_x, 0.5) * pix_size
+    d4s_y = 4*np.power(var_y, 0.5) * pix_size
 
     return (d4s_x, d4s_y, centroid_x, centroid_y)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Index of all measurements and analyses in a SQLite database, so dimples can
+be selected on their fit parameters without opening the files.
+
+The measurements table holds the path, the acquisition time and the
+acquisition settings of every phase stepping hdf5 file. The analyses table
+holds every fitGauss() result with the columns of the _results.csv file, in
+the same units (um, pix, deg, mrad). Times are in s since the epoch, taken
+from the timestamps in the file names.
+
+When the index is enabled, Phase_stepping.saveSurface() and
+fdmsImage.fitGauss() add their files to it:
+
+    import dataset_index
+    dataset_index.enable(r'C:\\fdms\\data\\fdms_index.sqlite')
+
+fdms_control enables the index with the INDEX option of the [fdms] section.
+Files written before, or while the index was disabled, are added with the
+backfill scanner:
+
+    index = dataset_index.DatasetIndex(r'C:\\fdms\\data\\fdms_index.sqlite')
+    index.scan(r'C:\\fdms\\data')
+
+queries, e.g. all dimples with a RoC between 100 and 200 um from the last
+30 days, or of a single day:
+
+    index.findAnalyses(since=datetime.timedelta(days=30), RoC_sphere=(100, 200))
+    index.findAnalyses(since='20170612', until='20170613', depth=(None, 2.0))
+    index.findMeasurements(since='20170612', numSteps=(7, 7))
+
+The index is opened for every transaction, so it can be written from
+several threads and processes (e.g. the analysis workers of
+dimple_pipeline) at the same time.
+
+@author: eschenm
+'''
+
+import os
+import time
+import json
+import logging
+import sqlite3
+import datetime
+import re
+import h5py
+import numpy as np
+
+log = logging.getLogger('dataset_index')
+
+# columns of the _results.csv file written by fdmsImage.fitGauss()
+ANALYSIS_COLUMNS = ('filename', 'depth', 'centroid_left', 'centroid_top', 'sigma_x', 'sigma_y',
+                    'theta', 'offset', 'tiltX', 'tiltY', 'roi_T', 'roi_L', 'roi_H', 'roi_W',
+                    'RoC_x', 'RoC_y', 'RoC_sphere', 'ellipticity', 'meanPhaseStep', 'stdevPhaseStep',
+                    'residual_stdev_gaussFit', 'residual_stdev_sphereFit')
+# hdf5 attributes of the images dataset written by Phase_stepping.saveSurface()
+MEASUREMENT_COLUMNS = ('numSteps', 'numImages', 'wavelength', 'mode', 'binning', 'cameraRoi',
+                       'pvPerFringe', 'setpoints', 'pvs')
+
+_MEASUREMENTS = ('path', 'filename', 'acquired') + MEASUREMENT_COLUMNS
+_ANALYSES = ('path', 'acquired', 'analysed') + ANALYSIS_COLUMNS
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS measurements (
+    path TEXT PRIMARY KEY, filename TEXT, acquired REAL,
+    numSteps INTEGER, numImages INTEGER, wavelength REAL, mode TEXT, binning INTEGER,
+    cameraRoi TEXT, pvPerFringe REAL, setpoints TEXT, pvs TEXT);
+CREATE INDEX IF NOT EXISTS measurements_filename ON measurements (filename);
+CREATE INDEX IF NOT EXISTS measurements_acquired ON measurements (acquired);
+CREATE TABLE IF NOT EXISTS analyses (
+    path TEXT PRIMARY KEY, acquired REAL, analysed REAL, filename TEXT,
+    depth REAL, centroid_left REAL, centroid_top REAL, sigma_x REAL, sigma_y REAL,
+    theta REAL, "offset" REAL, tiltX REAL, tiltY REAL,
+    roi_T INTEGER, roi_L INTEGER, roi_H INTEGER, roi_W INTEGER,
+    RoC_x REAL, RoC_y REAL, RoC_sphere REAL, ellipticity REAL,
+    meanPhaseStep REAL, stdevPhaseStep REAL,
+    residual_stdev_gaussFit REAL, residual_stdev_sphereFit REAL);
+CREATE INDEX IF NOT EXISTS analyses_filename ON analyses (filename);
+CREATE INDEX IF NOT EXISTS analyses_acquired ON analyses (acquired);
+'''
+
+# lines of the _fit_results.txt file, for analyses without a _results.csv file
+_NUMBER = r'([-+0-9.eEnaif]+)'
+_FIT_RESULTS = (
+    (r'using ROI: \((\d+),(\d+),(\d+),(\d+)\)', ('roi_T', 'roi_L', 'roi_H', 'roi_W')),
+    (r'amplitude: %sum' % _NUMBER, ('depth',)),
+    (r'\(sigma_x, sigma_y\): \(%s, %s\) um' % (_NUMBER, _NUMBER), ('sigma_x', 'sigma_y')),
+    (r'theta: %s \(deg\)' % _NUMBER, ('theta',)),
+    (r'offset: %s um' % _NUMBER, ('offset',)),
+    (r'background tilt \(x, y\): \(%s, %s\)' % (_NUMBER, _NUMBER), ('tiltX', 'tiltY')),
+    (r'centroid location in detector pixels: \(%s, %s\)' % (_NUMBER, _NUMBER), ('centroid_left', 'centroid_top')),
+    (r'radii of curvature: %s and %s um' % (_NUMBER, _NUMBER), ('RoC_x', 'RoC_y')),
+    (r'spherical fit of 1/e diameter: %s' % _NUMBER, ('RoC_sphere',)),
+    (r'ellipticity:%s' % _NUMBER, ('ellipticity',)),
+    (r'gauss fit residual standard deviation: %s' % _NUMBER, ('residual_stdev_gaussFit',)),
+    (r'sphere fit residual standard deviation: %s' % _NUMBER, ('residual_stdev_sphereFit',)),
+    (r'average phase step: %s deg, stdev: %s deg' % (_NUMBER, _NUMBER), ('meanPhaseStep', 'stdevPhaseStep')),
+)
+
+
+class DatasetIndexError(Exception):
+    pass
+
+
+def _fileTime(name):
+    # time of the %Y%m%dT%H%M%S stamp in a file name, None when there is none
+    try:
+        return time.mktime(time.strptime(name[:15], '%Y%m%dT%H%M%S'))
+    except ValueError:
+        return None
+
+
+def _toTime(value):
+    # s since the epoch from a number, datetime, timedelta (before now) or string
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime.timedelta):
+        return time.time() - value.total_seconds()
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, datetime.date):
+        return time.mktime(value.timetuple())
+    for fmt in ('%Y%m%dT%H%M%S', '%Y%m%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise DatasetIndexError('can not interpret %r as a time' % (value,))
+
+
+def _toValue(value):
+    # sqlite values of hdf5 attributes, arrays are stored as json lists
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return json.dumps(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return json.dumps([_toValue(v) for v in value])
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class DatasetIndex():
+    def __init__(self, path, timeout=30.0):
+        '''path     SQLite database file, created when it does not exist
+        timeout  seconds to wait for a transaction of another thread or
+                 process to finish'''
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        con = self._connect()
+        try:
+            con.executescript(_SCHEMA)
+        except sqlite3.Error as err:
+            msg = 'could not open dataset index %s: %s' % (self.path, err)
+            log.error(msg)
+            raise DatasetIndexError(msg)
+        finally:
+            con.close()
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def _insert(self, con, table, columns, record):
+        names = ', '.join('"%s"' % c for c in columns)
+        values = tuple(_toValue(record.get(c)) for c in columns)
+        con.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table, names, ', '.join('?'*len(columns))), values)
+
+    def _measurementRecord(self, path, attrs):
+        record = dict((k, attrs[k]) for k in MEASUREMENT_COLUMNS if k in attrs)
+        record['path'] = os.path.abspath(path)
+        record['filename'] = os.path.basename(path)
+        record['acquired'] = _fileTime(record['filename'])
+        return record
+
+    def _analysisRecord(self, path, results, analysed=None):
+        record = dict((k, results.get(k)) for k in ANALYSIS_COLUMNS)
+        record['path'] = os.path.abspath(path)
+        record['filename'] = os.path.basename(str(record['filename']))
+        record['acquired'] = _fileTime(record['filename'])
+        if analysed is None:
+            # <measurement time>_<analysis time>_results.csv
+            analysed = os.path.basename(path)[16:31]
+        record['analysed'] = _fileTime(analysed) if isinstance(analysed, str) else analysed
+        return record
+
+    def addMeasurement(self, path, attrs):
+        '''adds or updates the hdf5 file path, attrs is a dict with the
+        attributes of its images dataset'''
+        con = self._connect()
+        try:
+            with con:
+                self._insert(con, 'measurements', _MEASUREMENTS, self._measurementRecord(path, attrs))
+        finally:
+            con.close()
+        log.debug('indexed measurement %s' % path)
+
+    def addAnalysis(self, path, results, analysed=None):
+        '''adds or updates the analysis results file path, results is a dict
+        with the ANALYSIS_COLUMNS, analysed the analysis time as
+        %Y%m%dT%H%M%S string or in s since the epoch, by default taken from
+        the file name'''
+        con = self._connect()
+        try:
+            with con:
+                self._insert(con, 'analyses', _ANALYSES, self._analysisRecord(path, results, analysed))
+        finally:
+            con.close()
+        log.debug('indexed analysis %s' % path)
+
+    def scan(self, path, rescan=False):
+        '''backfill: adds all measurement hdf5 files and analysis results in
+        the directory tree path that are not indexed yet, or all of them
+        with rescan=True. Analyses are read from the _results.csv files, or
+        from the _fit_results.txt file when there is no csv file.
+
+        returns (number of measurements, number of analyses) added'''
+        con = self._connect()
+        try:
+            known = set()
+            if not rescan:
+                for table in ('measurements', 'analyses'):
+                    known.update(row[0] for row in con.execute('SELECT path FROM %s' % table))
+            counts = [0, 0]
+            with con:
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        filepath = os.path.abspath(os.path.join(dirpath, name))
+                        if filepath in known:
+                            continue
+                        if name.endswith('_fit_results.txt') and \
+                                name[:-len('_fit_results.txt')] + '_results.csv' in filenames:
+                            continue
+                        try:
+                            if name.endswith('.hdf5'):
+                                attrs = self._readHdf5(filepath)
+                                if attrs is None:
+                                    continue
+                                self._insert(con, 'measurements', _MEASUREMENTS, self._measurementRecord(filepath, attrs))
+                                counts[0] += 1
+                            elif name.endswith('_results.csv') or name.endswith('_fit_results.txt'):
+                                if name.endswith('.csv'):
+                                    results = self._readResultsCsv(filepath)
+                                else:
+                                    results = self._readFitResults(filepath)
+                                    if results is None:
+                                        continue
+                                self._insert(con, 'analyses', _ANALYSES, self._analysisRecord(filepath, results))
+                                counts[1] += 1
+                        except Exception as err:
+                            log.warning('could not index %s: %s' % (filepath, err))
+        finally:
+            con.close()
+        msg = 'indexed %d measurements and %d analyses in %s' % (counts[0], counts[1], path)
+        print(msg)
+        log.info(msg)
+        return tuple(counts)
+
+    def _readHdf5(self, filepath):
+        # attributes of the images dataset, None for other hdf5 files
+        with h5py.File(filepath, 'r') as f:
+            if 'images' not in f or 'numSteps' not in f['images'].attrs:
+                return None
+            attrs = dict(f['images'].attrs)
+            # files without camera roi contain full, unbinned images
+            attrs.setdefault('cameraRoi', (0, 0) + f['images'].shape[2:])
+        return attrs
+
+    def _readResultsCsv(self, filepath):
+        with open(filepath, 'r') as f:
+            values = f.readline().strip().split(',')
+            header = f.readline().strip().split(',')
+        if header[:len(values)] != list(ANALYSIS_COLUMNS):
+            raise DatasetIndexError('unknown columns in %s' % filepath)
+        results = dict(zip(header, values))
+        for name in ANALYSIS_COLUMNS[1:]:
+            results[name] = float(results[name])
+        return results
+
+    def _readFitResults(self, filepath):
+        with open(filepath, 'r') as f:
+            text = f.read()
+        match = re.search(r'Analysing file: (\S+\.hdf5)', text)
+        if match is None:
+            # e.g. fit_core results of a tiff file
+            return None
+        results = {'filename': match.group(1)}
+        for (pattern, names) in _FIT_RESULTS:
+            match = re.search(pattern, text)
+            if match is not None:
+                results.update(zip(names, (float(v) for v in match.groups())))
+        return results
+
+    def _select(self, sql, columns, since, until, ranges, conditions=()):
+        conditions = list(conditions)
+        parameters = []
+        for (operator, value) in (('>=', _toTime(since)), ('<', _toTime(until))):
+            if value is not None:
+                conditions.append('r.acquired %s ?' % operator)
+                parameters.append(value)
+        for (name, limits) in ranges.items():
+            if name not in columns:
+                raise DatasetIndexError('unknown column %s, use one of %s' % (name, ', '.join(columns)))
+            if not isinstance(limits, (list, tuple)):
+                limits = (limits, limits)
+            for (operator, value) in zip(('>=', '<='), limits):
+                if value is not None:
+                    conditions.append('r."%s" %s ?' % (name, operator))
+                    parameters.append(value)
+        sql = 'SELECT * FROM (%s) r' % sql
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY r.acquired, r.path'
+        con = self._connect()
+        try:
+            return [dict(row) for row in con.execute(sql, parameters)]
+        finally:
+            con.close()
+
+    def findMeasurements(self, since=None, until=None, **ranges):
+        '''returns a list of dicts with the measurements acquired since and
+        before until, sorted by acquisition time. The times are s since the
+        epoch, a datetime, a timedelta before now or a string like 20170612
+        or 20170612T120000. Every keyword selects a range (min, max) of a
+        column, None for no limit, or a single value.'''
+        return self._select('SELECT * FROM measurements', _MEASUREMENTS, since, until, ranges)
+
+    def findAnalyses(self, since=None, until=None, latest=True, **ranges):
+        '''returns a list of dicts with the analyses of the measurements
+        acquired since and before until, with the acquisition settings of
+        the measurement when it is indexed, sorted by acquisition time.
+        latest=True only returns the most recent analysis of every
+        measurement. The ranges select on the ANALYSIS_COLUMNS, e.g.
+        RoC_sphere=(100, 200), see findMeasurements().'''
+        settings = ', '.join('m."%s"' % c for c in MEASUREMENT_COLUMNS)
+        sql = ('SELECT a.*, m.path AS measurement, %s FROM analyses a '
+               'LEFT JOIN measurements m ON m.filename = a.filename' % settings)
+        conditions = []
+        if latest:
+            conditions.append('r.analysed = (SELECT MAX(b.analysed) FROM analyses b WHERE b.filename = r.filename)')
+        return self._select(sql, _ANALYSES, since, until, ranges, conditions)
+
+_index = None
+
+
+def enable(path):
+    '''adds all files written by Phase_stepping.saveSurface() and
+    fdmsImage.fitGauss() from now on to the index in path'''
+    global _index
+    if _index is None or _index.path != os.path.abspath(path):
+        _index = DatasetIndex(path)
+        log.info('indexing measurements and analyses in %s' % _index.path)
+
+
+def disable():
+    global _index
+    _index = None
+
+
+def isEnabled():
+    return _index is not None
+
+
+def getPath():
+    '''returns the path of the enabled index, None when disabled'''
+    return None if _index is None else _index.path
+
+
+def addMeasurement(path, attrs):
+    '''adds a measurement to the enabled index, a failure is only logged so
+    it never interrupts a measurement'''
+    if _index is None:
+        return
+    try:
+        _index.addMeasurement(path, attrs)
+    except Exception as err:
+        log.error('could not add %s to the dataset index: %s' % (path, err))
+
+
+def addAnalysis(path, results, analysed=None):
+    '''adds analysis results to the enabled index, see addMeasurement()'''
+    if _index is None:
+        return
+    try:
+        _index.addAnalysis(path, results, analysed)
+    except Exception as err:
+        log.error('could not add %s to the dataset index: %s' % (path, err))
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Closed loop dimple fabrication: shoot a dimple, measure its surface with
+phase stepping, analyse the height profile and adjust the pulse width of
+the next shots towards a target depth and radius of curvature.
+
+The stages of consecutive dimples overlap:
+    - the AWG is armed for dimple k+1 while dimple k is being measured
+    - dimple k is analysed in a worker process while dimple k+1 is shot and
+      measured
+so the cycle time is set by the slowest stage instead of the sum of all
+stages. As a consequence the pulse width of a shot is based on the analysis
+results available at that moment, which lag one or two dimples behind.
+
+usage (MEASURE_SURFACE and SHOOT_DIMPLE both enabled in fdms.ini):
+    controller = dimple_pipeline.WidthController(targetDepth=1.0, targetRoc=200.0, width=5E-6)
+    pipeline = dimple_pipeline.DimplePipeline(shoot, measure, controller, roi=(410,390,400,400))
+    pipeline.run(10)
+    pipeline.printSummary()
+
+@author: eschenm
+'''
+
+import os
+import time
+import logging
+import multiprocessing
+from threading import Lock, Event
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import dataset_index
+
+log = logging.getLogger('dimple_pipeline')
+
+
+class DimplePipelineError(Exception):
+    pass
+
+
+def analyzeMeasurement(measurement, roi, scale, a_path='', useNrOfSteps=None, indexPath=None):
+    '''analyses a phase stepping measurement, runs in a worker process.
+    measurement is either the path of a hdf5 file or a dict as returned by
+    Phase_stepping.acquireSurface(), with filename set to the path of the
+    hdf5 file. The results are added to the dataset index in indexPath.
+    Returns a dict with the fit results and the analysis time.'''
+    import analyze_surface
+    if indexPath is not None:
+        dataset_index.enable(indexPath)
+    start = time.time()
+    if isinstance(measurement, dict):
+        filename = measurement['filename']
+        arrays = dict((k, v) for (k, v) in measurement.items() if k != 'timing')
+        image = analyze_surface.fdmsImage.fromArrays(a_path=a_path, plot_save=False, plot_show=False, **arrays)
+    else:
+        filename = measurement
+        image = analyze_surface.fdmsImage(filename, a_path=a_path, plot_save=False, plot_show=False)
+    image.analyzeSurface(useNrOfSteps=useNrOfSteps, roi=roi, scale=scale)
+    image.fitGauss(scale=scale)
+    return {'filename': filename,
+            'depth': abs(image.dimpleDepth),
+            # the RoC of the gauss fit is more robust than the sphere fit
+            'roc': float(sum(image.radiiOfCurvature) / 2),
+            'rocXY': tuple(image.radiiOfCurvature),
+            'rocSphere': image.roc_sphere,
+            'diameter': tuple(image.dimpleDiameter),
+            'ellipticity': image.ellipticity,
+            'centroid': (image.x_detector, image.y_detector),
+            'residualGauss': image.residualStdevGauss,
+            'residualSphere': image.residualStdevSphere,
+            'analysisTime': time.time() - start}
+
+
+class WidthController():
+    def __init__(self, targetDepth, targetRoc, width, depthWeight=1.0, rocWeight=1.0,
+                 minWidth=1E-6, maxWidth=1E-3, maxStep=0.2, gain=0.7, history=6):
+        '''run to run controller of the pulse width
+
+        targetDepth     target dimple depth in um
+        targetRoc       target radius of curvature in um, None to control
+                        the depth only
+        width           pulse width in s of the first shot
+        depthWeight     relative weight of the depth error
+        rocWeight       relative weight of the RoC error
+        minWidth        lower limit of the pulse width in s
+        maxWidth        upper limit of the pulse width in s
+        maxStep         maximum relative width change per update
+        gain            fraction of the calculated correction that is applied
+        history         number of recent results used to estimate the
+                        sensitivity of depth and RoC to the pulse width
+
+        Depth and RoC are both driven by the single pulse width. The width
+        minimises the weighted sum of the squared relative errors, using
+        sensitivities from a local linear fit of the recent results.'''
+        self.targetDepth = targetDepth
+        self.targetRoc = targetRoc
+        self.width = width
+        self.depthWeight = depthWeight
+        self.rocWeight = rocWeight
+        self.minWidth = minWidth
+        self.maxWidth = maxWidth
+        self.maxStep = maxStep
+        self.gain = gain
+        self.history = history
+        self.results = []
+        self._lock = Lock()
+
+    def nextWidth(self):
+        with self._lock:
+            return self.width
+
+    def _targets(self):
+        # (name, target, weight) of the controlled quantities
+        targets = [('depth', self.targetDepth, self.depthWeight)]
+        if self.targetRoc is not None:
+            targets.append(('roc', self.targetRoc, self.rocWeight))
+        return targets
+
+    def _slope(self, results, name):
+        # least squares slope of quantity name versus pulse width
+        widths = [r['width'] for r in results]
+        values = [r[name] for r in results]
+        n = len(widths)
+        wm = sum(widths) / n
+        vm = sum(values) / n
+        sww = sum((w - wm)**2 for w in widths)
+        if sww == 0:
+            return None
+        return sum((w - wm)*(v - vm) for (w, v) in zip(widths, values)) / sww
+
+    def update(self, width, result):
+        '''adds the analysis result of a dimple shot with the given width and
+        calculates the width for the next shots'''
+        with self._lock:
+            result = dict(result)
+            result['width'] = width
+            self.results.append(result)
+            recent = self.results[-self.history:]
+            # the most recent result, relative to the targets
+            num = 0.0
+            den = 0.0
+            for (name, target, weight) in self._targets():
+                slope = self._slope(recent, name)
+                if slope is None:
+                    continue
+                error = (target - result[name]) / target
+                sensitivity = slope / target
+                num += weight * sensitivity * error
+                den += weight * sensitivity**2
+            if den > 0:
+                newWidth = width + self.gain * num / den
+            else:
+                # sensitivity unknown, probe by assuming depth proportional to width
+                newWidth = width * (1 + self.gain * (self.targetDepth - result['depth']) / max(result['depth'], 1E-3))
+            # limit step size and range
+            newWidth = min(max(newWidth, width * (1 - self.maxStep)), width * (1 + self.maxStep))
+            newWidth = min(max(newWidth, self.minWidth), self.maxWidth)
+            self.width = newWidth
+        msg = 'dimple with width %.3Es: depth %.3f um, RoC %.1f um, next width %.3Es' % (width, result['depth'], result['roc'], newWidth)
+        print(msg)
+        log.info(msg)
+        return newWidth
+
+
+class DimplePipeline():
+    STAGES = ('arm', 'shoot', 'acquire', 'analyze')
+    LOG_HEADER = 'dimple,filename,width,depth,roc,roc_x,roc_y,ellipticity,arm_time,shoot_time,acquire_time,analyze_time,cycle_time\n'
+
+    def __init__(self, shoot, measure, controller, roi, scale=0.1172E-6, a_path='', beforeShot=None,
+                 workers=1, logFile=None):
+        '''shoot       dimple_shooting.DimpleShooting instance
+        measure     measure_surface.Phase_stepping instance
+        controller  WidthController instance
+        roi         (T,L,H,W) analysis ROI, see fdmsImage.analyzeSurface()
+        scale       pixel size in the fiber plane in m
+        a_path      directory for the analysis results, see fdmsImage
+        beforeShot  optional function called with the dimple number before
+                    every shot, e.g. to position the next fibre
+        workers     number of analysis worker processes
+        logFile     csv file with one line of results and timing per dimple
+        '''
+        self.shoot = shoot
+        self.measure = measure
+        self.controller = controller
+        self.roi = roi
+        self.scale = scale
+        self.a_path = a_path
+        self.beforeShot = beforeShot
+        self.workers = workers
+        self.logFile = logFile
+        self.dimples = []
+        self._abort = Event()
+        self._lock = Lock()
+        if logFile is not None and not os.path.exists(logFile):
+            with open(logFile, 'w') as f:
+                f.write(self.LOG_HEADER)
+
+    def _arm(self, dimple):
+        start = time.time()
+        self.shoot.prepareShot(width=dimple['width'])
+        dimple['times']['arm'] = time.time() - start
+
+    def _analysisDone(self, dimple, future):
+        try:
+            result = future.result()
+        except Exception as err:
+            dimple['error'] = str(err)
+            msg = 'analysis of dimple %d failed: %s' % (dimple['dimple'], err)
+            print(msg)
+            log.error(msg)
+            return
+        dimple['result'] = result
+        dimple['times']['analyze'] = result['analysisTime']
+        self.controller.update(dimple['width'], result)
+        self._writeLog(dimple)
+
+    def abort(self):
+        '''stops the pipeline after the dimple in progress'''
+        self._abort.set()
+
+    def run(self, nrDimples):
+        '''shoots, measures and analyses nrDimples dimples, returns the list
+        of dimple dicts with width, result and stage times'''
+        self._abort.clear()
+        msg = 'start closed loop fabrication of %d dimples' % nrDimples
+        print(msg)
+        log.info(msg)
+        # spawn, so no threads (PID loop, power sampler) are copied into the workers
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        armer = ThreadPoolExecutor(1)
+        dimples = []
+        futures = []
+        start = time.time()
+        try:
+            dimple = {'dimple': len(self.dimples), 'width': self.controller.nextWidth(), 'times': dict()}
+            armed = armer.submit(self._arm, dimple)
+            for ii in range(nrDimples):
+                cycleStart = time.time()
+                if self.beforeShot is not None:
+                    self.beforeShot(dimple['dimple'])
+                armed.result()
+                t0 = time.time()
+                self.shoot.shoot()
+                dimple['times']['shoot'] = time.time() - t0
+                dimple['shotTime'] = t0
+                dimples.append(dimple)
+                # arm the next shot while measuring this dimple
+                nextDimple = None
+                if ii + 1 < nrDimples and not self._abort.is_set():
+                    nextDimple = {'dimple': dimple['dimple'] + 1, 'width': self.controller.nextWidth(), 'times': dict()}
+                    armed = armer.submit(self._arm, nextDimple)
+                t0 = time.time()
+                measurement = self.measure.acquireSurface()
+                dimple['times']['acquire'] = time.time() - t0
+                # analyse from memory while the hdf5 file is written in the background
+                dimple['filename'] = self.measure.saveSurface(measurement, wait=False)
+                measurement['filename'] = dimple['filename']
+                future = pool.submit(analyzeMeasurement, measurement, self.roi, self.scale, self.a_path,
+                                     indexPath=dataset_index.getPath())
+                future.add_done_callback(lambda f, d=dimple: self._analysisDone(d, f))
+                futures.append(future)
+                dimple['times']['cycle'] = time.time() - cycleStart
+                if nextDimple is None:
+                    break
+                if self._abort.is_set():
+                    msg = 'closed loop fabrication aborted after %d dimples' % (ii+1)
+                    print(msg)
+                    log.warning(msg)
+                    break
+                dimple = nextDimple
+        finally:
+            armer.shutdown(wait=True)
+            # wait for the remaining analyses and files
+            pool.shutdown(wait=True)
+            with self._lock:
+                self.dimples.extend(dimples)
+            self.measure.waitForSaving()
+        msg = 'fabricated %d dimples in %.1f s' % (len(dimples), time.time() - start)
+        print(msg)
+        log.info(msg)
+        return dimples
+
+    def _writeLog(self, dimple):
+        if self.logFile is None:
+            return
+        r = dimple['result']
+        t = dimple['times']
+        txt = '%d,%s,%.5E,%.4f,%.3f,%.3f,%.3f,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f\n'
+        vals = (dimple['dimple'], os.path.basename(r['filename']), dimple['width'], r['depth'], r['roc'],
+                r['rocXY'][0], r['rocXY'][1], r['ellipticity'], t.get('arm', float('nan')),
+                t.get('shoot', float('nan')), t.get('acquire', float('nan')), t.get('analyze', float('nan')),
+                t.get('cycle', float('nan')))
+        try:
+            with self._lock:
+                with open(self.logFile, 'a') as f:
+                    f.write(txt % vals)
+        except Exception as error:
+            log.error('error during writing to file %s: %s' % (self.logFile, error))
+
+    def printSummary(self):
+        '''prints the mean time per stage, the cycle time and the results'''
+        dimples = [d for d in self.dimples if 'times' in d]
+        if not dimples:
+            print('no dimples fabricated yet')
+            return
+        print('mean stage times over %d dimples:' % len(dimples))
+        for stage in self.STAGES + ('cycle',):
+            times = [d['times'][stage] for d in dimples if stage in d['times']]
+            if times:
+                print('\t%-8s %8.1f ms' % (stage, sum(times) / len(times) * 1e3))
+        for d in dimples:
+            if 'result' in d:
+                r = d['result']
+                print('dimple %d: width %.3Es, depth %.3f um, RoC %.1f um' % (d['dimple'], d['width'], r['depth'], r['roc']))
+            else:
+                print('dimple %d: width %.3Es, no analysis result' % (d['dimple'], d['width']))
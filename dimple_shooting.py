@@ -13,9 +13,12 @@ class DimpleShootingError(Exception):
 
 
 class DimpleShooting():
-    def __init__(self, powermeter_ini, awg_ini, dimple_shooting_ini, powermeter, awg):
+    def __init__(self, powermeter_ini, awg_ini, dimple_shooting_ini, powermeter, awg, predictor=None):
+        '''predictor is an optional power_predictor.PowerPredictor, when given
+        the pulse height is corrected with the power predicted at trigger time'''
         self.powermeter = powermeter
         self.awg = awg
+        self.predictor = predictor
         self.powermeter_ini = powermeter_ini
         self.awg_ini = awg_ini
         self.dimple_shooting_ini = dimple_shooting_ini
@@ -68,19 +71,12 @@ class DimpleShooting():
     def shoot(self, correctPower=True):
         if self.awg.isArmed is False:
             raise DimpleShootingError('cannot shoot laser pulse, make sure shoot.prepareShot() has been run with correct parameters!!')
-        currentPower = self.powermeter.readPower()
-        msg = 'Measured actual powermeter value: %.3fW' % (currentPower)
-        print(msg)
-        logging.info(msg)
-        if correctPower:
-            correctedHeight = self.defaultHeight * (self.dimple_shooting_ini['default_power'] / currentPower)
-            msg = 'Corrected pulse height is %.3EV' % (correctedHeight)
-            print(msg)
-            logging.info(msg)
-            self.awg.setIntensity(correctedHeight)
+        self._correctHeight(correctPower)
         try:
             self.awg.sendBurst()
-        except err as Error:
+            if self.predictor is not None:
+                self.predictor.registerShot(self.awg.triggerTime)
+        except Exception as err:
             msg = 'error during sending burst: %s' % err
             logging.error(msg)
             raise DimpleShootingError(msg)
@@ -88,7 +84,69 @@ class DimpleShooting():
             # change pulse height setting back to non-powermeter corrected height value in case the next pulse wil be fired without height correction
             if correctPower:
                 self.awg.setIntensity(self.defaultHeight)
+
+    def triggerShot(self, correctPower=True):
+        '''corrects the pulse height and triggers the prepared shot without
+        waiting for the burst to complete, finishShot() must be called
+        afterwards. Returns (power, height, triggerTime).'''
+        if self.awg.isArmed is False:
+            raise DimpleShootingError('cannot shoot laser pulse, make sure shoot.prepareShot() has been run with correct parameters!!')
+        (currentPower, height) = self._correctHeight(correctPower)
+        try:
+            triggerTime = self.awg.triggerBurst()
+        except Exception as err:
+            msg = 'error during sending burst: %s' % err
+            logging.error(msg)
+            # the trigger time is unknown, do not wait for a burst but
+            # switch off the intensity and disarm right away
+            try:
+                self.awg.setOutput(2, False)
+                self.awg.isArmed = False
+                if correctPower:
+                    self.awg.setIntensity(self.defaultHeight)
+            except Exception as cleanupErr:
+                logging.error('could not disarm AWG after failed trigger: %s' % cleanupErr)
+            raise
+        return (currentPower, height, triggerTime)
+
+    def finishShot(self, correctPower=True):
+        '''waits for the burst started by triggerShot() to complete'''
+        try:
+            self.awg.finishBurst()
+            if self.predictor is not None:
+                self.predictor.registerShot(self.awg.triggerTime)
+        except Exception as err:
+            msg = 'error during sending burst: %s' % err
+            logging.error(msg)
+            raise DimpleShootingError(msg)
+        finally:
+            if correctPower:
+                self.awg.setIntensity(self.defaultHeight)
+
+    def _correctHeight(self, correctPower):
+        # returns the power and the pulse height used for the shot
+        currentPower = self._shotPower()
+        height = self.defaultHeight
+        if correctPower:
+            height = self.defaultHeight * (self.dimple_shooting_ini['default_power'] / currentPower)
+            msg = 'Corrected pulse height is %.3EV' % (height)
+            print(msg)
+            logging.info(msg)
+            self.awg.setIntensity(height)
+        return (currentPower, height)
                 
+    def _shotPower(self):
+        # power used for the pulse height correction
+        if self.predictor is not None:
+            (currentPower, std) = self.predictor.predictTrigger()
+            msg = 'Predicted powermeter value at trigger: %.3f +/- %.3fW' % (currentPower, std)
+        else:
+            currentPower = self.powermeter.latestPower(self.dimple_shooting_ini['max_power_age'])
+            msg = 'Measured actual powermeter value: %.3fW' % (currentPower)
+        print(msg)
+        logging.info(msg)
+        return currentPower
+
     def prepareShotWithoutArm(self, **kwargs):
         # METHOD ASSUMES OUTPUTS ARE ENABLED!!!
         '''prepareShot(width=150E-6, height=5.0, nr_pulses=10, period=1E-3)
@@ -100,9 +158,6 @@ class DimpleShooting():
         period:     [float] multiple pulse period time in s
         '''
 
-        logging.info('enabled AWG outputs')
-        time.sleep(1)
-        
         txt = ['', 'This value is taken from the ini file']
 
         defaultWidth = self.dimple_shooting_ini['width']
@@ -134,19 +189,12 @@ class DimpleShooting():
     def shootWithoutArm(self, correctPower=True):
         # METHOD ASSUMES OUTPUTS ARE ENABLED!!!
         
-        currentPower = self.powermeter.readPower()
-        msg = 'Measured actual powermeter value: %.3fW' % (currentPower)
-        print(msg)
-        logging.info(msg)
-        if correctPower:
-            correctedHeight = self.defaultHeight * (self.dimple_shooting_ini['default_power'] / currentPower)
-            msg = 'Corrected pulse height is %.3EV' % (correctedHeight)
-            print(msg)
-            logging.info(msg)
-            self.awg.setIntensity(correctedHeight)
+        self._correctHeight(correctPower)
         try:
             self.awg.sendBurstWithoutArm()
-        except err as Error:
+            if self.predictor is not None:
+                self.predictor.registerShot(self.awg.triggerTime)
+        except Exception as err:
             msg = 'error during sending burst: %s' % err
             logging.error(msg)
             raise DimpleShootingError(msg)
@@ -64,24 +64,42 @@ SHOOT_DIMPLE = fdms_ini['SHOOT_DIMPLE']
 PLOT_SAVE = fdms_ini['PLOT_SAVE'] 
 PLOT_SHOW = fdms_ini['PLOT_SHOW']
 
+if fdms_ini['TIMING']:
+    import timing
+    timing.enable()
+
+if fdms_ini['INDEX']:
+    import dataset_index
+    dataset_index.enable(os.path.join(datapath, fdms_ini['INDEX']))
+
 if MEASURE_SURFACE:
     import camera
     import pidControl
     import measure_surface
 
     log.info('setting up connections for measuring surface')
-    u3 = pidControl.connectU3()
+    connectParameters = {'numReadings': piezo_ini['adcReadings'],
+                         'simulate': fdms_ini['SIMULATE'],}
     parameters = {'pid': piezo_ini['pid'],
                   'setpoint': piezo_ini['offset'], 
                   'ovMin': -0.5,
                   'ovMax': 10.0,
-                  'pausetime': 0.005,}
-    ctrl = pidControl.PidController(u3, **parameters)
+                  'pausetime': 0.005,
+                  'maxError': piezo_ini['maxError'],
+                  'settleTicks': piezo_ini['settleTicks'],
+                  'feedForward': piezo_ini['feedForward'],}
+    if piezo_ini['pidProcess']:
+        # the PID process connects to the labjack itself
+        ctrl = pidControl.PidProcessController(connectParameters, **parameters)
+    else:
+        u3 = pidControl.connectU3(**connectParameters)
+        ctrl = pidControl.PidController(u3, **parameters)
     ctrl.start()
     log.info('started PID loop')
     # wait for pid loop to stabilize
     start = time.time()
-    while abs(ctrl.getError()) > piezo_ini['maxError']:
+    # the error is NaN until the first PID cycle has run
+    while not abs(ctrl.getError()) <= piezo_ini['maxError']:
         if (time.time() - start) > 5:
             log.error('piezo not within errormargin after initialisation')
             log.warning('piezo not at setpoint after initialisation')
@@ -97,10 +115,33 @@ if SHOOT_DIMPLE:
     import dimple_shooting
 
     log.info('setting up connections for shooting dimples')
-    awg = sdg2000x.Sdg2000x(awg_ini)
-    powermeter = pm100usb.Pm100usb(powermeter_ini)
+    if fdms_ini['SIMULATE']:
+        import scpi_sim
+        (awgServer, pmServer) = scpi_sim.startSimulators()
+        awg = sdg2000x.Sdg2000x(awg_ini, resourceName=awgServer.resourceName)
+        powermeter = pm100usb.Pm100usb(powermeter_ini, resourceName=pmServer.resourceName)
+    else:
+        awg = sdg2000x.Sdg2000x(awg_ini)
+        powermeter = pm100usb.Pm100usb(powermeter_ini)
+    if powermeter_ini['sampling']:
+        powermeter.startSampling()
+    predictor = None
+    if dimple_shooting_ini['predict_power']:
+        if powermeter.sampler is None:
+            log.warning('power prediction requires background power sampling, prediction disabled')
+        else:
+            import power_predictor
+            predictionLog = os.path.join(dailydir, time.strftime('%Y%m%dT%H%M%S_power_prediction.csv'))
+            predictor = power_predictor.PowerPredictor(powermeter.sampler,
+                processNoise=dimple_shooting_ini['power_process_noise'],
+                measurementNoise=dimple_shooting_ini['power_measurement_noise'],
+                logFile=predictionLog,
+                maxAge=dimple_shooting_ini['max_power_age'])
     
-    shoot = dimple_shooting.DimpleShooting(powermeter_ini, awg_ini, dimple_shooting_ini, powermeter, awg)
+    shoot = dimple_shooting.DimpleShooting(powermeter_ini, awg_ini, dimple_shooting_ini, powermeter, awg, predictor)
+    import shot_queue
+    shotLog = os.path.join(dailydir, time.strftime('%Y%m%dT%H%M%S_shots.csv'))
+    queue = shot_queue.ShotQueue(shoot, logFile=shotLog)
     
 msg = 'all hardware now connected'
 log.info(msg)
@@ -112,6 +153,8 @@ print(msg)
 def stopFdms():
     # closing connections
     log.info('shutting down application')
+    if fdms_ini['TIMING']:
+        timing.timer.logSummary(title='timing of this session')
     if MEASURE_SURFACE:
         try:
             global ctrl
@@ -140,6 +183,11 @@ def stopFdms():
             pass
         
     if SHOOT_DIMPLE:
+        if queue.isRunning():
+            queue.abort()
+        if predictor is not None:
+            # write the power at trigger time of the last shots to the log
+            predictor.flush()
         try:
             global powermeter
             powermeter.close()
@@ -155,6 +203,12 @@ def stopFdms():
             pass
         finally:
             pass
+
+        if fdms_ini['SIMULATE']:
+            # after closing the connections to the simulated instruments
+            awgServer.stop()
+            pmServer.stop()
+            log.debug('instrument simulators stopped')
     
     log.info('stop log')
     logging.shutdown()
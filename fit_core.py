@@ -1,126 +1,306 @@
-# routines for fitting position of core 
-
-import time
-import os
-import logging
-import numpy as np
-from tifffile import imread
-from twoD_Gaussian import simple_twoD_Gaussian
-from d4s import get_d4sigma
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-from IPython import embed
-
-from twoD_Gaussian import twoD_Gaussian
-
-def fitCore(file, scale=0.1172E-6):
-    '''returns the camera pixel coordinates of the maximum
-    '''
-    
-    roi = 100
-    default_sigma = 10
-    if os.path.isfile(file):
-        a_path = os.path.dirname(file)
-    else:
-        logging.error('could not find file %s' % file)
-        raise Exception('could not find file %s' % file)
-
-    try:
-        img = imread(file)
-    except Exception as e:
-        msg = 'error during reading file: %s' % e
-        logging.error(msg)
-        raise Exception(msg)
-
-    a_time = time.strftime('%Y%m%dT%H%M%S')
-    
-    # calculate initial estimages
-    max = np.max(img)
-    (row, col) = np.where((img == max))
-    y0 = row[0]
-    x0 = col[0]
-    #logging.debug
-    print('estimated centroid: %.2E %.2E' % (x0, y0))
-    
-    #idx are the ROI(T, T+h, L, L+w) coordinates
-    idx = np.int16([y0-(roi/2), y0+(roi/2), x0-(roi/2), x0+(roi/2)])
-    # check if idx is defined outside image
-    if idx[0] < 0:
-        idx[0] = 0
-    if idx[1] > np.shape(img)[0]:
-        idx[1] = np.shape(img)[0]
-    if idx[2] < 0:
-        idx[2] = 0
-    if idx[3] > np.shape(img)[1]:
-        idx[3] = np.shape(img)[1]
-    
-    #logging.debug
-    print('using ROI: [%d:%d, %d:%d] ROI(T:T+h, L:L+w)' % (idx[0], idx[1], idx[2], idx[3]))
-    img_roi = img[idx[0]:idx[1], idx[2]:idx[3]]
-    x = np.arange(0, np.shape(img_roi)[1])
-    y = np.arange(0, np.shape(img_roi)[0])
-    x, y = np.meshgrid(x, y)
-
-    offset = np.min(img_roi)
-    amplitude = max - offset
-    logging.debug('estimated amplitude and offset: %+.2E %+.2E' % (amplitude, offset))
-    (d4s_x, d4s_y, xo_px, yo_px) = get_d4sigma(img_roi, 1)
-    if np.isnan(np.array([d4s_x, d4s_y, xo_px, yo_px])).any():
-        sigma_x, sigma_y = default_sigma, default_sigma
-        msg = 'could not estimate sigma from height profile, use defaults: %.2E %.2E' % (sigma_x, sigma_y)
-        logging.debug(msg)
-    else:
-        sigma_x = d4s_x / 8
-        sigma_y = d4s_y / 8
-        logging.debug('estimated sigma: %.2E %.2E' % (sigma_x, sigma_y))
-    
-    
-    initial_guess = (amplitude, xo_px, yo_px, sigma_x, sigma_y, offset)
-    
-    popt, pcov = curve_fit(simple_twoD_Gaussian, (x, y), img_roi.ravel(), p0=initial_guess)
-    vals = (popt[0], popt[1]+idx[2], popt[2]+idx[0], popt[3], popt[4], popt[5])
-    txt = '\t\tamplitude: %.1f\n\t\t(x0, y0): (%.1f, %.1f) px\n\t\t(sigma_x, sigma_y): (%.1f, %.1f) px\n\t\toffset: %.1f\n'
-    print('found fit params:')
-    print(txt % vals)
-    fn = file.replace('.TIFF','').replace('.tiff','').replace('.tiff','').replace('.tif','')
-    fn += ('_' + a_time + '_fit_results.txt')
-    with open(os.path.join(a_path, fn), 'w') as f:
-        f.write('Analysing file: %s\n' % os.path.basename(file))
-        f.write('Aanalysis timestamp: %s\n\n' % a_time)
-        f.write('using ROI: [%d:%d, %d:%d] ROI(T:T+h, L:L+w)' % (idx[0], idx[1], idx[2], idx[3]))
-        f.write('2D Gauss fit params:\n')
-        f.write('%s\n' % (txt % vals))
-
-    logging.info('found fit parameters:')
-    for line in (txt % vals).splitlines():
-        logging.info(line)
-
-    fig, axes = plt.subplots(1, 2,figsize=(8,4))
-    plt.subplot(1,2,1)
-    
-    # contourplot
-    title = 'fitted Gauss\namplitude: %.1f, (x0, y0): (x=%.1f, y=%.1f)px\n' % (popt[0], popt[1]+idx[2], popt[2]+idx[0])
-    shape = np.shape(img_roi)
-    extent = (idx[2], idx[3], idx[1], idx[0])    
-    a = plt.imshow(img_roi, extent=extent, aspect='auto')
-    data_fitted = simple_twoD_Gaussian((x, y), *popt).reshape(img_roi.shape)
-    ax = plt.gca()
-    ax.contour(data_fitted[::-1,:], 5, extent=extent, colors='w')
-    cb1 = plt.colorbar(a, ax=ax)
-    plt.title(title)
-    
-    
-    plt.subplot(1,2,2)
-    title = 'fit residual'
-    a2 = plt.imshow(img_roi-data_fitted, extent=extent, aspect='auto')
-    ax2 = plt.gca()
-    cb1 = plt.colorbar(a2, ax=ax2)
-    plt.title(title)        
-    if 0:
-        plt.show()
-    
-    fn = file.replace('.TIFF','').replace('.tiff','').replace('.tiff','').replace('.tif','')
-    fn += ('_' + a_time + '_fitCore.png')
-    fig.savefig(os.path.join(a_path, fn))
-    print('saved plot %s' % os.path.join(a_path, fn))
-    
\ No newline at end of file
+# routines for fitting position of core
+
+import time
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tifffile import imread, TiffFile
+from twoD_Gaussian import GaussianModel
+from d4s import get_d4sigma
+from scipy.optimize import curve_fit
+import matplotlib.pyplot as plt
+
+RESULTS_HEADER = 'file,page,amplitude,x0,y0,sigma_x,sigma_y,offset,roi_T,roi_B,roi_L,roi_R,fit_time,error\n'
+
+def estimateCore(img, peak=None, window=None, method='parabola'):
+    '''(amplitude, x0, y0, sigma_x, sigma_y, offset) = estimateCore(img)
+
+    fast estimate of the core position and width without a fit, takes tens of
+    microseconds for cores of a few pixels
+    img       2D array
+    peak      (row, col) of the maximum, default is the argmax of img
+    window    size of the square around the peak. The default starts with 15
+              pixels and widens the window to 8 sigma until it covers the core
+    method    'parabola' peak interpolation of the logarithm of the row and
+                         column sums, exact for a Gauss and robust for
+                         narrow cores
+              'moments'  centroid and second moment width of the window
+                         with ISO 11146 background subtraction (get_d4sigma)
+    The background is the mean of the window edges. Returns nan values if no
+    peak is found in the window.
+    '''
+    if peak is None:
+        peak = np.unravel_index(np.argmax(img), np.shape(img))
+    if window is not None:
+        return _estimateCore(img, peak, window, method)
+    window = 15
+    for ii in range(4):
+        vals = _estimateCore(img, peak, window, method)
+        if np.isnan(vals[3:5]).any():
+            break
+        # background from the edges at 4 sigma
+        needed = 2 * int(np.ceil(4 * max(vals[3:5]))) + 1
+        if needed <= window:
+            break
+        window = needed
+    return vals
+
+def _estimateCore(img, peak, window, method):
+    (h, w) = np.shape(img)
+    (row, col) = peak
+    half = window // 2
+    (T, L) = (max(0, row - half), max(0, col - half))
+    win = np.array(img[T:min(h, row + half + 1), L:min(w, col + half + 1)], dtype=np.float64)
+    offset = (np.sum(win[0]) + np.sum(win[-1]) + np.sum(win[1:-1, 0]) + np.sum(win[1:-1, -1])) / (2*sum(win.shape) - 4)
+    win -= offset
+    if method == 'moments':
+        (d4s_x, d4s_y, xo, yo) = get_d4sigma(win, 1, background='iso')
+        # get_d4sigma uses 1 based coordinates
+        (x0, y0, sigma_x, sigma_y) = (xo - 1 + L, yo - 1 + T, d4s_x / 4, d4s_y / 4)
+        amplitude = np.max(win)
+    elif method == 'parabola':
+        # points about sigma/2 apart, the window is 8 sigma after widening
+        step = max(1, window // 16)
+        (x0, sigma_x, peak_x) = _logParabola(np.sum(win, axis=0), step)
+        (y0, sigma_y, peak_y) = _logParabola(np.sum(win, axis=1), step)
+        (x0, y0) = (x0 + L, y0 + T)
+        # the row sums of a Gauss are a Gauss with amplitude*sqrt(2*pi)*sigma_y
+        amplitude = peak_x / (np.sqrt(2*np.pi) * sigma_y)
+    else:
+        raise ValueError('unknown core estimator: %s' % method)
+    return (amplitude, x0, y0, sigma_x, sigma_y, offset)
+
+def _logParabola(profile, step=1):
+    # (position, sigma, peak value) of a parabola through the logarithm of 3 points around the maximum
+    i = int(np.argmax(profile))
+    if i < step or i + step >= len(profile) or profile[i-step] <= 0 or profile[i+step] <= 0:
+        return (np.nan, np.nan, np.nan)
+    (l0, l1, l2) = np.log(profile[i-step:i+step+1:step])
+    curvature = l0 - 2*l1 + l2
+    if not curvature < 0:
+        return (np.nan, np.nan, np.nan)
+    dx = 0.5 * (l0 - l2) / curvature
+    return (i + step * dx, step * np.sqrt(-1 / curvature), np.exp(l1 - 0.25 * (l0 - l2) * dx))
+
+def fitCoreImage(img, roi=100, default_sigma=10, precise=True, window=None):
+    '''fits a 2D Gauss around the maximum of a camera image
+
+    img             2D array, may be a memory mapped page of a tiff file
+    roi             size of the square around the maximum used for the fit
+    default_sigma   initial sigma in pixels if it can not be estimated
+    precise         False returns the fast estimate of estimateCore() on a
+                    window around the maximum instead of the fit
+    window          window size of estimateCore()
+
+    returns (vals, idx, popt) with vals the fitted (amplitude, x0, y0,
+    sigma_x, sigma_y, offset) in camera pixels, idx the ROI (T, T+h, L, L+w)
+    and popt the parameters of the simple Gauss model in ROI pixels
+    '''
+    # calculate initial estimates, argmax only needs a single pass
+    (y0, x0) = [int(v) for v in np.unravel_index(np.argmax(img), np.shape(img))]
+    logging.debug('estimated centroid: %.2E %.2E' % (x0, y0))
+
+    #idx are the ROI(T, T+h, L, L+w) coordinates, limited to the image
+    (h, w) = np.shape(img)
+    if not precise:
+        vals = estimateCore(img, peak=(y0, x0), window=window)
+        # plot a window of 8 sigma
+        half = int(np.nan_to_num(4 * max(vals[3:5]), nan=roi/2))
+        idx = (max(0, y0-half), min(h, y0+half+1), max(0, x0-half), min(w, x0+half+1))
+        popt = (vals[0], vals[1]-idx[2], vals[2]-idx[0], vals[3], vals[4], vals[5])
+        return (vals, idx, popt)
+    idx = (max(0, int(y0-roi/2)), min(h, int(y0+roi/2)), max(0, int(x0-roi/2)), min(w, int(x0+roi/2)))
+    img_roi = np.array(img[idx[0]:idx[1], idx[2]:idx[3]], dtype=np.float64)
+    model = GaussianModel(np.shape(img_roi), kind='simple')
+
+    # the fast estimate is the initial guess of the fit
+    (amplitude, xo_px, yo_px, sigma_x, sigma_y, offset) = estimateCore(img, peak=(y0, x0), window=window)
+    (xo_px, yo_px) = (xo_px - idx[2], yo_px - idx[0])
+    if np.isnan(np.array([amplitude, xo_px, yo_px, sigma_x, sigma_y])).any():
+        offset = np.min(img_roi)
+        amplitude = img_roi[y0-idx[0], x0-idx[2]] - offset
+        (xo_px, yo_px) = (x0-idx[2], y0-idx[0])
+        sigma_x, sigma_y = default_sigma, default_sigma
+        msg = 'could not estimate sigma, use defaults: %.2E %.2E' % (sigma_x, sigma_y)
+        logging.debug(msg)
+    else:
+        logging.debug('estimated sigma: %.2E %.2E' % (sigma_x, sigma_y))
+    logging.debug('estimated amplitude and offset: %+.2E %+.2E' % (amplitude, offset))
+
+    initial_guess = (amplitude, xo_px, yo_px, sigma_x, sigma_y, offset)
+
+    popt, pcov = curve_fit(model, None, img_roi.ravel(), p0=initial_guess)
+    vals = (popt[0], popt[1]+idx[2], popt[2]+idx[0], popt[3], popt[4], popt[5])
+    return (vals, idx, popt)
+
+def fitCore(file, scale=0.1172E-6, precise=True):
+    '''returns the camera pixel coordinates of the maximum
+    precise=False uses the fast estimate instead of the 2D Gauss fit
+    '''
+
+    roi = 100
+    if os.path.isfile(file):
+        a_path = os.path.dirname(file)
+    else:
+        logging.error('could not find file %s' % file)
+        raise Exception('could not find file %s' % file)
+
+    try:
+        img = imread(file)
+    except Exception as e:
+        msg = 'error during reading file: %s' % e
+        logging.error(msg)
+        raise Exception(msg)
+
+    a_time = time.strftime('%Y%m%dT%H%M%S')
+
+    (vals, idx, popt) = fitCoreImage(img, roi=roi, precise=precise)
+    #logging.debug
+    print('using ROI: [%d:%d, %d:%d] ROI(T:T+h, L:L+w)' % (idx[0], idx[1], idx[2], idx[3]))
+    txt = '\t\tamplitude: %.1f\n\t\t(x0, y0): (%.1f, %.1f) px\n\t\t(sigma_x, sigma_y): (%.1f, %.1f) px\n\t\toffset: %.1f\n'
+    print('found fit params:')
+    print(txt % vals)
+    fn = file.replace('.TIFF','').replace('.tiff','').replace('.tiff','').replace('.tif','')
+    fn += ('_' + a_time + '_fit_results.txt')
+    with open(os.path.join(a_path, fn), 'w') as f:
+        f.write('Analysing file: %s\n' % os.path.basename(file))
+        f.write('Aanalysis timestamp: %s\n\n' % a_time)
+        f.write('using ROI: [%d:%d, %d:%d] ROI(T:T+h, L:L+w)' % (idx[0], idx[1], idx[2], idx[3]))
+        f.write('2D Gauss fit params:\n')
+        f.write('%s\n' % (txt % vals))
+
+    logging.info('found fit parameters:')
+    for line in (txt % vals).splitlines():
+        logging.info(line)
+
+    fn = file.replace('.TIFF','').replace('.tiff','').replace('.tiff','').replace('.tif','')
+    fn += ('_' + a_time + '_fitCore.png')
+    _plotCore(img[idx[0]:idx[1], idx[2]:idx[3]], idx, popt, os.path.join(a_path, fn))
+    print('saved plot %s' % os.path.join(a_path, fn))
+    return vals
+
+def _plotCore(img_roi, idx, popt, filename):
+    fig, axes = plt.subplots(1, 2,figsize=(8,4))
+    plt.subplot(1,2,1)
+
+    # contourplot
+    title = 'fitted Gauss\namplitude: %.1f, (x0, y0): (x=%.1f, y=%.1f)px\n' % (popt[0], popt[1]+idx[2], popt[2]+idx[0])
+    extent = (idx[2], idx[3], idx[1], idx[0])
+    a = plt.imshow(img_roi, extent=extent, aspect='auto')
+    data_fitted = GaussianModel(img_roi.shape, kind='simple').evaluate(*popt)
+    ax = plt.gca()
+    ax.contour(data_fitted[::-1,:], 5, extent=extent, colors='w')
+    cb1 = plt.colorbar(a, ax=ax)
+    plt.title(title)
+
+
+    plt.subplot(1,2,2)
+    title = 'fit residual'
+    a2 = plt.imshow(img_roi-data_fitted, extent=extent, aspect='auto')
+    ax2 = plt.gca()
+    cb1 = plt.colorbar(a2, ax=ax2)
+    plt.title(title)
+    if 0:
+        plt.show()
+
+    fig.savefig(filename)
+    plt.close(fig)
+
+def _tiffPages(path):
+    # (file, page) of all pages in a (multi-page) tiff file or a directory of tiff files
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, fn) for fn in os.listdir(path) if fn.lower().endswith(('.tif', '.tiff')))
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        logging.error('could not find file or directory %s' % path)
+        raise Exception('could not find file or directory %s' % path)
+    pages = []
+    for file in files:
+        try:
+            with TiffFile(file) as tif:
+                pages.extend((file, page) for page in range(len(tif.pages)))
+        except Exception:
+            # unreadable files end up as failed fit in the results
+            pages.append((file, 0))
+    return pages
+
+def _fitPage(file, page, roi, plot, precise):
+    # fits one page in a worker process, errors are returned with the results
+    start = time.time()
+    result = {'file': file, 'page': page}
+    try:
+        # the page is memory mapped, only the ROI around the maximum is copied
+        img = imread(file, key=page, out='memmap')
+        (vals, idx, popt) = fitCoreImage(img, roi=roi, precise=precise)
+        result.update(zip(('amplitude', 'x0', 'y0', 'sigma_x', 'sigma_y', 'offset'), vals))
+        result['roi'] = idx
+        if plot:
+            fn = os.path.splitext(file)[0] + '_p%d_fitCore.png' % page
+            _plotCore(np.asarray(img[idx[0]:idx[1], idx[2]:idx[3]]), idx, popt, fn)
+        del img
+    except Exception as e:
+        result['error'] = str(e)
+    result['fitTime'] = time.time() - start
+    return result
+
+def fitCores(path, resultsFile=None, roi=100, processes=None, plot=False, precise=True):
+    '''fits the core position of all images in a directory of tiff files or
+    in a multi-page tiff file
+
+    path         directory or (multi-page) tiff file
+    resultsFile  csv file with one line per page, default is
+                 <path>_<timestamp>_fitCores.csv next to the directory or file
+    roi          size of the square around the maximum used for the fit
+    processes    number of worker processes, 1 fits in this process. Default
+                 is the number of cpus, but at least 100 images per worker
+                 since starting a worker takes about a second
+    plot         save a plot of every fit next to the tiff file
+    precise      False uses the fast estimate instead of the 2D Gauss fit
+
+    returns the list of result dicts, failed fits have an 'error' entry
+    '''
+    pages = _tiffPages(path)
+    if resultsFile is None:
+        a_time = time.strftime('%Y%m%dT%H%M%S')
+        resultsFile = os.path.normpath(path).replace('.TIFF','').replace('.tiff','').replace('.tif','') + '_' + a_time + '_fitCores.csv'
+    msg = 'fitting core position in %d images from %s' % (len(pages), path)
+    print(msg)
+    logging.info(msg)
+    start = time.time()
+    n = len(pages)
+    args = ([file for (file, page) in pages], [page for (file, page) in pages], [roi]*n, [plot]*n, [precise]*n)
+    if processes is None:
+        processes = min(os.cpu_count() or 1, max(1, n // 100))
+    if processes == 1:
+        results = list(map(_fitPage, *args))
+    else:
+        # spawn, so no threads (PID loop, power sampler) are copied into the workers
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            chunksize = max(1, n // (4 * processes))
+            results = list(pool.map(_fitPage, *args, chunksize=chunksize))
+
+    txt = '%s,%d,%.1f,%.2f,%.2f,%.2f,%.2f,%.1f,%d,%d,%d,%d,%.4f,\n'
+    try:
+        with open(resultsFile, 'w') as f:
+            f.write(RESULTS_HEADER)
+            for r in results:
+                if 'error' in r:
+                    f.write('%s,%d,,,,,,,,,,,%.4f,%s\n' % (r['file'], r['page'], r['fitTime'], r['error'].replace(',', ';').replace('\n', ' ')))
+                    continue
+                vals = (r['file'], r['page'], r['amplitude'], r['x0'], r['y0'], r['sigma_x'], r['sigma_y'], r['offset'],
+                        *r['roi'], r['fitTime'])
+                f.write(txt % vals)
+    except Exception as error:
+        logging.error('error during writing to file %s: %s' % (resultsFile, error))
+        raise Exception(error)
+
+    failed = [r for r in results if 'error' in r]
+    for r in failed:
+        logging.error('fit of %s page %d failed: %s' % (r['file'], r['page'], r['error']))
+    msg = 'fitted %d images in %.2f s, %d failed, results in %s' % (len(results), time.time() - start, len(failed), resultsFile)
+    print(msg)
+    logging.info(msg)
+    return results
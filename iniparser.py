@@ -23,6 +23,11 @@ def parseInifile(file):
         fdms[option] = parser.getboolean('fdms', option)
     for option in strings:
         fdms[option] = parser.get('fdms', option)
+    # use simulated hardware instead of the real devices
+    fdms['SIMULATE'] = parser.getboolean('fdms', 'SIMULATE', fallback=False)
+    fdms['TIMING'] = parser.getboolean('fdms', 'TIMING', fallback=False)
+    # dataset index, relative to measure_datapath, empty disables the index
+    fdms['INDEX'] = parser.get('fdms', 'INDEX', fallback='fdms_index.sqlite')
     
     # this section starts all connections
     # piezo pid control
@@ -31,6 +36,18 @@ def parseInifile(file):
     for option in floats:
         piezo[option] = float(parser.get('piezo', option))
     piezo['pid'] = tuple([float(val) for val in parser.get('piezo', 'pid').split(',')])
+    # number of ADC readings averaged in one LabJack feedback packet
+    piezo['adcReadings'] = parser.getint('piezo', 'adcReadings', fallback=1)
+    # nr of consecutive PID cycles within maxError before position is settled
+    piezo['settleTicks'] = parser.getint('piezo', 'settleTicks', fallback=10)
+    # run the PID loop in a separate process
+    piezo['pidProcess'] = parser.getboolean('piezo', 'pidProcess', fallback=False)
+    # optional feed-forward model: volts per pv, offset in volts
+    feedForward = parser.get('piezo', 'feedForward', fallback='')
+    if feedForward:
+        piezo['feedForward'] = tuple([float(val) for val in feedForward.split(',')])
+    else:
+        piezo['feedForward'] = None
 
     # reading camera ini settings
     camera = dict()
@@ -40,6 +57,15 @@ def parseInifile(file):
         camera[option] = float(parser.get('camera', option))
     for option in ints:
         camera[option] = int(parser.get('camera', option))
+    # optional region (T,L,H,W) in sensor pixels and binning of the stored images
+    roi = parser.get('camera', 'roi', fallback='')
+    if roi:
+        camera['roi'] = tuple([int(val) for val in roi.split(',')])
+    else:
+        camera['roi'] = None
+    camera['binning'] = parser.getint('camera', 'binning', fallback=1)
+    # unit of the frame timestamps in s
+    camera['timestampUnit'] = parser.getfloat('camera', 'timestampUnit', fallback=1E-9)
 
     # reading awg ini settings
     # channel 1 MUST be connected to the digital input of the RF driver
@@ -49,12 +75,16 @@ def parseInifile(file):
     strings = ('load1', 'load2', )
     for option in strings:
         awg[option] = parser.get('awg', option)
+    # safety margin in s after the burst duration before channel 2 is disabled
+    awg['burstMargin'] = parser.getfloat('awg', 'burstMargin', fallback=0.1)
     
     # reading powermeter ini settings
     powermeter = dict()
     ints = ('wavelength', 'averages', )
     for option in ints:
         powermeter[option] = int(parser.get('powermeter', option))
+    powermeter['sampling'] = parser.getboolean('powermeter', 'sampling', fallback=False)
+    powermeter['bufferSize'] = parser.getint('powermeter', 'bufferSize', fallback=1000)
 
     # reading phase stepping ini settings
     phase_stepping = dict()
@@ -64,6 +94,13 @@ def parseInifile(file):
         phase_stepping[option] = float(parser.get('phase_stepping', option))
     for option in ints:
         phase_stepping[option] = int(parser.get('phase_stepping', option))
+    # step: settle at every phase step, sweep: record frames while the piezo moves
+    phase_stepping['mode'] = parser.get('phase_stepping', 'mode', fallback='step')
+    if phase_stepping['mode'] not in ('step', 'sweep'):
+        raise ValueError('illegal phase stepping mode in .ini file: %s' % phase_stepping['mode'])
+    phase_stepping['sweepFrames'] = parser.getint('phase_stepping', 'sweepFrames', fallback=12)
+    phase_stepping['sweepRange'] = parser.getfloat('phase_stepping', 'sweepRange', 
+            fallback=(phase_stepping['nrSteps'] - 1) * phase_stepping['stepSize'])
 
     # reading dimple shooting settings
     dimple_shooting = dict()
@@ -73,6 +110,10 @@ def parseInifile(file):
         dimple_shooting[option] = float(parser.get('dimple_shooting', option))
     for option in ints:
         dimple_shooting[option] = int(parser.get('dimple_shooting', option))
+    dimple_shooting['max_power_age'] = parser.getfloat('dimple_shooting', 'max_power_age', fallback=0.5)
+    dimple_shooting['predict_power'] = parser.getboolean('dimple_shooting', 'predict_power', fallback=False)
+    dimple_shooting['power_process_noise'] = parser.getfloat('dimple_shooting', 'power_process_noise', fallback=0.03)
+    dimple_shooting['power_measurement_noise'] = parser.getfloat('dimple_shooting', 'power_measurement_noise', fallback=0.03)
     
     inis = ('fdms', 'piezo', 'camera', 'phase_stepping', 'powermeter', 'awg', \
             'dimple_shooting')
@@ -83,3 +124,38 @@ def parseInifile(file):
         
     return (fdms, piezo, camera, phase_stepping, powermeter, awg, \
             dimple_shooting)
+
+def updateOption(file, section, option, value):
+    '''Replaces the value of an option in an ini file. Other lines, including
+    comments, are kept as they are. The option is appended to the section if it
+    does not exist yet.'''
+    with open(file, 'r') as f:
+        lines = f.readlines()
+    sectionStart = None
+    sectionEnd = len(lines)
+    found = False
+    for (ii, line) in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            if sectionStart is not None:
+                sectionEnd = ii
+                break
+            if stripped[1:-1].strip().lower() == section.lower():
+                sectionStart = ii
+            continue
+        if sectionStart is not None and '=' in stripped and not stripped.startswith(('#', ';')):
+            key = stripped.split('=', 1)[0].strip()
+            if key.lower() == option.lower():
+                lines[ii] = '%s = %s\n' % (key, value)
+                found = True
+                break
+    if sectionStart is None:
+        raise KeyError('section [%s] not found in %s' % (section, file))
+    if not found:
+        # insert before the empty lines separating the next section
+        while sectionEnd > sectionStart + 1 and not lines[sectionEnd - 1].strip():
+            sectionEnd -= 1
+        lines.insert(sectionEnd, '%s = %s\n' % (option, value))
+    with open(file, 'w') as f:
+        f.writelines(lines)
+    logging.getLogger('iniparser').info('set %s in section [%s] of %s to %s' % (option, section, file, value))
@@ -3,10 +3,15 @@
 @author: eschenm
 """
 
-import LabJackPython
-import u3
 import struct
 import sys
+try:
+    import LabJackPython
+    import u3
+except ImportError:
+    # only the simulated device (labjack_sim) can be used
+    LabJackPython = None
+    u3 = None
 
 
 class LabJackError(Exception):
@@ -48,6 +53,10 @@ class LabJackU3():
                 pass
 
     def connectToFirstDevice(self):
+        if LabJackPython is None:
+            raise LabJackError("LabJackPython is not installed")
+        # module providing the feedback commands (AIN, BitStateWrite, ...)
+        self.commands = u3
         if len(LabJackPython.listAll(self.deviceType)) > 0:
             self.device = u3.U3()
             self.calibrationData = self.device.getCalibrationData()
@@ -109,17 +118,51 @@ class Piezo():
         return voltage
 
 class Adc():
-    def __init__(self, u3device, numReadings = 1):
+    # the IOTypes of a U3 feedback command are limited to 57 bytes, each AIN
+    # command takes 3 bytes of it, so a single packet holds at most 19 readings
+    MAX_AIN_PER_PACKET = 19
+
+    def __init__(self, u3device, numReadings = 1, longSettling = False, quickSample = False):
         self.u3device = u3device
-        self.numReadings = numReadings
+        self.numReadings = int(numReadings)
+        self.longSettling = longSettling
+        self.quickSample = quickSample
         if not self.u3device.isConnected:
             raise LabJackError("no device connected")
-    
+        if self.numReadings < 1:
+            raise LabJackError("number of readings must be at least 1")
+
     def readValue(self):
-        voltage = 0
-        for ii in range(self.numReadings):
-            voltage += self.u3device.device.getAIN(self.u3device.U3_ADC_PIN)
-        return voltage/float(self.numReadings)
+        (mean, std) = self.readValueStats()
+        return mean
+
+    def readValueStats(self):
+        # all readings are requested as AIN commands in a single feedback 
+        # packet (or as few packets as possible) instead of calling getAIN 
+        # numReadings times. Returns (mean, standard deviation) in Volt.
+        pin = self.u3device.U3_ADC_PIN
+        bits = []
+        remaining = self.numReadings
+        while remaining > 0:
+            n = min(remaining, self.MAX_AIN_PER_PACKET)
+            commands = [self.u3device.commands.AIN(pin, 31, self.longSettling, self.quickSample) for ii in range(n)]
+            bits.extend(self.u3device.device.getFeedback(*commands))
+            remaining -= n
+        voltages = [self.bitsToVoltage(b) for b in bits]
+        mean = sum(voltages)/float(len(voltages))
+        if len(voltages) > 1:
+            var = sum([(v - mean)**2 for v in voltages])/float(len(voltages) - 1)
+        else:
+            var = 0.0
+        return (mean, var**0.5)
+
+    def bitsToVoltage(self, bits):
+        # same conversion as u3.U3.getAIN() for a single ended reading
+        pin = self.u3device.U3_ADC_PIN
+        lvChannel = True
+        if getattr(self.u3device.device, 'isHV', False) and pin < 4:
+            lvChannel = False
+        return self.u3device.device.binaryToCalibratedAnalogVoltage(bits, isLowVoltage = lvChannel, isSingleEnded = True, isSpecialSetting = False, channelNumber = pin)
         
 class Pulser():
     def __init__(self, u3device, dio_val = 0):
@@ -144,20 +187,21 @@ class Pulser():
         # function returns the actual pulse length in ms
 
         pin = self.u3device.U3_DIO_PIN
+        commands = self.u3device.commands
         if length < 256*0.128:
             waitS = int(round(length/0.128))
-            wait1 = u3.WaitShort(waitS)
+            wait1 = commands.WaitShort(waitS)
             waittime = waitS*0.128
         else:
             waitL = int(length/16.384)
-            wait2 = u3.WaitLong(waitL)
+            wait2 = commands.WaitLong(waitL)
             waittime = waitL*16.384
             waitS = int(round((length - waittime)/0.128))
-            wait1 = u3.WaitShort(waitS)
+            wait1 = commands.WaitShort(waitS)
             waittime = waitL*16.384 + waitS*0.128
 
-        sethigh = u3.BitStateWrite(pin, 1)
-        setlow = u3.BitStateWrite(pin, 0)
+        sethigh = commands.BitStateWrite(pin, 1)
+        setlow = commands.BitStateWrite(pin, 0)
         if length < 256*0.128:
             self.u3device.device.getFeedback(sethigh, wait1, setlow)
         else:
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated LabJack U3 with LJTick-DAC and piezo driven reference mirror, for
+testing and benchmarking the PID loop and the phase stepping without hardware.
+
+The piezo is modelled as a first order plus dead time system with hysteresis
+(play operator on the drive voltage) and gaussian noise on the position
+signal. DAC output is quantised using the LJTick-DAC calibration constants
+and every USB transaction is delayed by a configurable latency.
+
+usage:
+    u3 = pidControl.connectU3(simulate=True)
+    or with custom plant parameters:
+    u3 = pidControl.connectU3(simulate=True, timeConstant=0.01, noise=0.001)
+
+@author: eschenm
+"""
+
+import sys
+import time
+import math
+import random
+import struct
+import logging
+from threading import Lock
+import labjack
+
+log = logging.getLogger('labjack_sim')
+
+
+# max size in bytes of the IOTypes in a single U3 feedback command
+MAX_FEEDBACK_BYTES = 57
+
+
+# feedback commands with the same constructor arguments as the ones in u3.py,
+# cmdBytes is the size of the IOType in the feedback command
+class AIN():
+    cmdBytes = 3
+
+    def __init__(self, PositiveChannel, NegativeChannel=31, LongSettling=True, QuickSample=False):
+        self.positiveChannel = PositiveChannel
+        self.negativeChannel = NegativeChannel
+        self.longSettling = LongSettling
+        self.quickSample = QuickSample
+
+class BitStateWrite():
+    cmdBytes = 2
+
+    def __init__(self, IONumber, State):
+        self.IONumber = IONumber
+        self.State = State
+
+class WaitShort():
+    cmdBytes = 2
+
+    def __init__(self, Time):
+        # multiples of 128 us
+        self.Time = Time
+
+class WaitLong():
+    cmdBytes = 2
+
+    def __init__(self, Time):
+        # multiples of 16.384 ms
+        self.Time = Time
+
+
+def fromDouble(value):
+    '''inverse of labjack.toDouble(), returns 8 byte list'''
+    wh = int(math.floor(value))
+    dec = int(round((value - wh) * 2**32))
+    if dec == 2**32:
+        (wh, dec) = (wh + 1, 0)
+    return list(struct.pack('<Ii', dec, wh))
+
+
+class PiezoPlant():
+    def __init__(self, gain=0.1, offset=0.0, timeConstant=0.004, deadTime=0.002, noise=0.0005, hysteresis=0.05):
+        '''first order plus dead time model of the piezo position signal
+
+        gain            static gain in pv/V
+        offset          pv at 0 V
+        timeConstant    time constant in s
+        deadTime        dead time in s
+        noise           standard deviation of the position signal noise in pv
+        hysteresis      width in V of the hysteresis loop of the piezo
+        '''
+        self.gain = gain
+        self.offset = offset
+        self.timeConstant = timeConstant
+        self.deadTime = deadTime
+        self.noise = noise
+        self.hysteresis = hysteresis
+        self._lock = Lock()
+        self._x = 0.0                           # drive after hysteresis
+        self._u = 0.0                           # drive acting on the plant now
+        self._pv = offset
+        self._t = time.time()
+        self._events = []                       # [(time, drive), ...]
+
+    def setVoltage(self, voltage, tm=None):
+        if tm is None:
+            tm = time.time()
+        with self._lock:
+            # play operator
+            h = self.hysteresis / 2.0
+            if voltage > self._x + h:
+                self._x = voltage - h
+            elif voltage < self._x - h:
+                self._x = voltage + h
+            self._events.append((tm + self.deadTime, self._x))
+
+    def _advance(self, tm):
+        # exponential response to piecewise constant input
+        while self._t < tm:
+            if self._events and self._events[0][0] <= tm:
+                tNext = max(self._events[0][0], self._t)
+            else:
+                tNext = tm
+            pvss = self.gain * self._u + self.offset
+            self._pv = pvss + (self._pv - pvss) * math.exp(-(tNext - self._t) / self.timeConstant)
+            self._t = tNext
+            while self._events and self._events[0][0] <= self._t:
+                self._u = self._events.pop(0)[1]
+        while self._events and self._events[0][0] <= self._t:
+            self._u = self._events.pop(0)[1]
+
+    def getPosition(self, tm=None):
+        if tm is None:
+            tm = time.time()
+        with self._lock:
+            self._advance(tm)
+            pv = self._pv
+        return pv + random.gauss(0.0, self.noise)
+
+
+class SimulatedU3Device():
+    # nominal U3-LV single ended AIN calibration
+    LV_SE_SLOPE = 3.7231E-5
+    LV_SE_OFFSET = 0.0
+
+    def __init__(self, plant, dacSlope=3158.8, dacOffset=32768.0, usbLatency=0.001):
+        '''emulates the part of the u3.U3 interface used in labjack.py
+
+        plant       PiezoPlant instance
+        dacSlope    LJTick-DAC calibration slope in bits/V
+        dacOffset   LJTick-DAC calibration offset in bits
+        usbLatency  duration in s of a single USB transaction
+        '''
+        self.plant = plant
+        self.dacSlope = dacSlope
+        self.dacOffset = dacOffset
+        self.usbLatency = usbLatency
+        self.isHV = False
+        self.dacVoltage = 0.0
+        self._dio = dict()
+        self._lock = Lock()
+        self.transactions = 0
+
+    def _transaction(self, duration=0.0):
+        # USB transactions are handled one at a time
+        with self._lock:
+            time.sleep(self.usbLatency + duration)
+            self.transactions += 1
+
+    def getCalibrationData(self):
+        return {'lvSESlope': self.LV_SE_SLOPE, 'lvSEOffset': self.LV_SE_OFFSET}
+
+    def i2c(self, Address, I2CBytes, NumI2CBytesToReceive=0, SDAPinNum=None, SCLPinNum=None, **kwargs):
+        self._transaction()
+        if Address == labjack.LabJackU3.EEPROM_ADDRESS:
+            # LJTick-DAC calibration constants
+            data = fromDouble(self.dacSlope) + fromDouble(self.dacOffset)
+            data += [0] * (NumI2CBytesToReceive - len(data))
+            return {'I2CBytes': data[:NumI2CBytesToReceive]}
+        if Address == labjack.LabJackU3.DAC_ADDRESS and I2CBytes[0] == 48:
+            bitval = min(max(I2CBytes[1]*256 + I2CBytes[2], 0), 65535)
+            self.dacVoltage = (bitval - self.dacOffset) / self.dacSlope
+            self.plant.setVoltage(self.dacVoltage)
+        return {'I2CBytes': []}
+
+    def _readAIN(self):
+        voltage = self.plant.getPosition()
+        bits = int(round((voltage - self.LV_SE_OFFSET) / self.LV_SE_SLOPE))
+        # 12 bit converter, left justified in 16 bits
+        return min(max(bits, 0), 65535) & 0xFFF0
+
+    def binaryToCalibratedAnalogVoltage(self, bits, isLowVoltage=True, isSingleEnded=True, isSpecialSetting=False, channelNumber=0):
+        return bits * self.LV_SE_SLOPE + self.LV_SE_OFFSET
+
+    def getAIN(self, posChannel, negChannel=31, longSettle=False, quickSample=False):
+        self._transaction()
+        return self.binaryToCalibratedAnalogVoltage(self._readAIN())
+
+    def getFeedback(self, *commands):
+        size = sum(getattr(command, 'cmdBytes', 0) for command in commands)
+        if size > MAX_FEEDBACK_BYTES:
+            raise labjack.LabJackError('feedback command of %d bytes exceeds the maximum of %d bytes'
+                                       % (size, MAX_FEEDBACK_BYTES))
+        results = []
+        duration = 0.0
+        for command in commands:
+            if isinstance(command, AIN):
+                results.append(self._readAIN())
+            elif isinstance(command, BitStateWrite):
+                self._dio[command.IONumber] = bool(command.State)
+                results.append(None)
+            elif isinstance(command, WaitShort):
+                duration += command.Time * 128e-6
+                results.append(None)
+            elif isinstance(command, WaitLong):
+                duration += command.Time * 16.384e-3
+                results.append(None)
+            else:
+                raise labjack.LabJackError('unsupported feedback command: %s' % type(command).__name__)
+        self._transaction(duration)
+        return results
+
+    def setDOState(self, ioNum, state=1):
+        self._transaction()
+        self._dio[ioNum] = bool(state)
+
+    def setDIOState(self, ioNum, state=1):
+        self.setDOState(ioNum, state)
+
+    def getDIOState(self, ioNum):
+        self._transaction()
+        return int(self._dio.get(ioNum, False))
+
+    def configAnalog(self, *args):
+        self._transaction()
+
+    def close(self):
+        pass
+
+
+class SimulatedLabJackU3(labjack.LabJackU3):
+    def __init__(self, DACpin = 4, DIOpin = 6, ADCpin = 0, usbLatency = 0.001, **plantParameters):
+        '''drop-in replacement of labjack.LabJackU3, plantParameters are passed
+        to PiezoPlant'''
+        self._usbLatency = usbLatency
+        self._plantParameters = plantParameters
+        labjack.LabJackU3.__init__(self, DACpin, DIOpin, ADCpin)
+
+    def connectToFirstDevice(self):
+        self.commands = sys.modules[__name__]
+        self.plant = PiezoPlant(**self._plantParameters)
+        self.device = SimulatedU3Device(self.plant, usbLatency=self._usbLatency)
+        self.calibrationData = self.device.getCalibrationData()
+        self.isConnected = True
+        log.info('connected simulated labjack U3')
+
+
+def benchmark(ctrl, offset=0.05, stepSize=0.095, nrSteps=7, timeout=1.0, duration=2.0):
+    '''measures PID loop rate, settling time per phase step and total phase
+    step time of a running PidController
+
+    returns dict with the results'''
+    ctrl.setSetpoint(offset)
+    ctrl.waitForSettled(timeout)
+    time.sleep(duration)
+    loopFrequency = ctrl.getPidLoopFrequency()
+    settleTimes = []
+    start = time.time()
+    for ii in range(nrSteps):
+        t0 = time.time()
+        ctrl.setSetpoint(offset + ii*stepSize)
+        if ctrl.waitForSettled(timeout):
+            settleTimes.append(time.time() - t0)
+        else:
+            settleTimes.append(None)
+    totalTime = time.time() - start
+    ctrl.setSetpoint(offset)
+    results = {'loopFrequency': loopFrequency, 'settleTimes': settleTimes,
+               'phaseStepTime': totalTime}
+    print('PID loop frequency: %.1f Hz' % loopFrequency)
+    for (ii, ts) in enumerate(settleTimes):
+        if ts is None:
+            print('step %d: not settled within %.2f s' % (ii, timeout))
+        else:
+            print('step %d: settled in %.1f ms' % (ii, ts*1e3))
+    print('total time for %d phase steps: %.1f ms' % (nrSteps, totalTime*1e3))
+    return results
+
+
+if __name__ == '__main__':
+    import pidControl
+    u3 = pidControl.connectU3(simulate=True)
+    parameters = {'pid' : (3, 600, 0.001), 'setpoint' : 0.05, 'ovMin' : -0.5, 'ovMax' : 10.0, 'pausetime' : 0.005,}
+    ctrl = pidControl.PidController(u3, **parameters)
+    ctrl.start()
+    try:
+        benchmark(ctrl)
+    finally:
+        ctrl.terminate()
@@ -0,0 +1,259 @@
+'''M. Eschen, 2017
+
+Live preview of the fringe contrast and wrapped phase for aligning the
+interferometer. Every preview is a fast 4 or 5 frame phase shifting capture,
+binned to a reduced resolution and analysed with the algorithms of
+fdmsImage.analyzeSurface(). The capture modes are:
+    sweep   consecutive frames while the setpoint ramps, like the sweep mode
+            of Phase_stepping. The phase shifts are taken from the PID
+            telemetry with pvPerFringe and the phase is solved with least
+            squares. No settling, so the preview runs at several Hz.
+    step    one frame per settled 90 degree phase step, closed form
+            algorithm (or least squares when pvPerFringe is known)
+The piezo moves alternately up and down, so it never has to return from
+the last to the first position. The preview is shown in a matplotlib window
+that only redraws the images (blitting) and/or streamed to a hdf5 file.
+
+usage, with the instances of fdms_control:
+    preview = live_preview.LivePreview(piezo_ini, phase_stepping_ini, cam, ctrl)
+    preview.run(duration=60)
+    preview.run(duration=60, show=False, filename='alignment.hdf5')
+
+The camera client can not be used for other measurements while the preview
+is running.
+'''
+
+import time
+import logging
+import numpy as np
+from phase_shifting import lsqPhase, closedPhase
+from measure_surface import FrameTracker
+
+log = logging.getLogger('live_preview')
+
+
+class LivePreviewError(Exception):
+    pass
+
+
+class LivePreview():
+    def __init__(self, piezo_ini, phase_stepping_ini, cam, ctrl, nrSteps=4, binning=4, mode=None, sweepTime=0.3):
+        '''piezo_ini           piezo section of fdms.ini, offset and pvperfringe
+        phase_stepping_ini  phase stepping section of fdms.ini, stepSize
+        cam                 camera.CameraClient instance
+        ctrl                pidControl.PidController or PidProcessController
+        nrSteps             4 or 5 frames per preview
+        binning             additional binning of the camera images
+        mode                'sweep' or 'step', default is sweep when
+                            pvPerFringe is known
+        sweepTime           duration in s of a sweep over nrSteps + 1 phase
+                            steps, long enough for the piezo to follow the
+                            ramp. The frames are taken evenly spread over the
+                            sweep, at least one frame period apart
+        '''
+        if nrSteps not in (4, 5):
+            raise LivePreviewError('live preview supports 4 or 5 phase steps, not %d' % nrSteps)
+        self.piezo_ini = piezo_ini
+        self.phase_stepping_ini = phase_stepping_ini
+        self.cam = cam
+        self.ctrl = ctrl
+        self.nrSteps = nrSteps
+        self.binning = binning
+        self.pvPerFringe = piezo_ini.get('pvperfringe')
+        if mode is None:
+            mode = 'sweep' if self.pvPerFringe else 'step'
+        if mode not in ('sweep', 'step'):
+            raise LivePreviewError('unknown live preview mode: %s' % mode)
+        if mode == 'sweep' and not self.pvPerFringe:
+            raise LivePreviewError('sweep mode needs pvperfringe in the piezo section of the ini file')
+        self.mode = mode
+        self.sweepTime = sweepTime
+        self.setpoints = [piezo_ini['offset'] + ii*phase_stepping_ini['stepSize'] for ii in range(nrSteps)]
+        self._reverse = False
+
+    def _bin(self, image):
+        b = self.binning
+        (h, w) = (image.shape[0] // b * b, image.shape[1] // b * b)
+        image = image[:h, :w].astype(np.float32)
+        if b > 1:
+            image = image.reshape(h // b, b, w // b, b).mean(axis=(1, 3))
+        return image
+
+    def capture(self, frames=None):
+        '''records nrSteps frames and returns (phase, contrast, pvs) with the
+        wrapped phase and contrast of the binned images and the piezo
+        positions of the frames'''
+        if frames is None:
+            frames = FrameTracker(self.cam)
+        if self.mode == 'sweep':
+            return self._sweep(frames)
+        order = range(self.nrSteps)
+        if self._reverse:
+            order = reversed(order)
+        self._reverse = not self._reverse
+        images = None
+        pvs = np.empty(self.nrSteps)
+        for ii in order:
+            self.ctrl.setSetpoint(self.setpoints[ii])
+            if not self.ctrl.waitForSettled(1.0):
+                log.warning('piezo not settled at %.4f within 1 s' % self.setpoints[ii])
+            settled = time.time()
+            pvs[ii] = self.ctrl.getPv()
+            image = self._bin(frames.getFrame(notBefore=settled)[0])
+            if images is None:
+                images = np.empty((self.nrSteps,) + image.shape, dtype=np.float32)
+            images[ii] = image
+        if self.pvPerFringe:
+            shifts = 2*np.pi*(pvs - self.setpoints[0])/self.pvPerFringe
+            (phase, contrast, _) = lsqPhase(images, shifts)
+        else:
+            (phase, contrast) = closedPhase(images)
+        return (phase, contrast, pvs)
+
+    def _sweep(self, frames):
+        # ramp over nrSteps + 1 steps, the frames are about one step apart
+        # and all exposed during the ramp
+        interval = max(frames.period, self.sweepTime / (self.nrSteps+1))
+        (start, stop) = (self.setpoints[0], self.setpoints[0] + (self.nrSteps+1)*self.phase_stepping_ini['stepSize'])
+        if self._reverse:
+            (start, stop) = (stop, start)
+        self._reverse = not self._reverse
+        images = None
+        exposureStarts = np.empty(self.nrSteps)
+        rampStart = time.time()
+        duration = (self.nrSteps+1)*interval
+        self.ctrl.rampSetpoint(start, stop, duration)
+        for ii in range(self.nrSteps):
+            (image, meta, exposureStarts[ii]) = frames.getFrame(notBefore=rampStart + ii*interval)
+            image = self._bin(image)
+            if images is None:
+                images = np.empty((self.nrSteps,) + image.shape, dtype=np.float32)
+            images[ii] = image
+        # the next sweep starts where this ramp ends, without a setpoint jump
+        remaining = rampStart + duration - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        (times, pvs, setpoints) = self.ctrl.getHistory(since=rampStart - 0.1)
+        if not times:
+            raise LivePreviewError('no PID telemetry recorded during sweep')
+        pvs = np.interp(exposureStarts + frames.exposure/2, times, pvs)
+        # relative to the first step, so up and down sweeps give the same phase
+        shifts = 2*np.pi*(pvs - self.setpoints[0])/self.pvPerFringe
+        (phase, contrast, _) = lsqPhase(images, shifts)
+        return (phase, contrast, pvs)
+
+    def run(self, duration=None, show=True, filename=None):
+        '''shows and/or streams previews until duration seconds have passed,
+        the window is closed or the run is interrupted with ctrl-c
+
+        duration    seconds, None runs until stopped
+        show        show the preview in a matplotlib window
+        filename    hdf5 file to which contrast, phase, times and pvs of
+                    every preview are appended, None does not store
+
+        returns the number of previews'''
+        if not show and filename is None and duration is None:
+            raise LivePreviewError('live preview without window or file needs a duration')
+        frames = FrameTracker(self.cam)
+        if self.mode == 'sweep':
+            # start of the first ramp
+            self._reverse = False
+            self.ctrl.setSetpoint(self.setpoints[0])
+            self.ctrl.waitForSettled(1.0)
+        (phase, contrast, pvs) = self.capture(frames)
+        display = _BlitDisplay(phase, contrast) if show else None
+        stream = _Hdf5Stream(filename, phase.shape, self.nrSteps, self.binning, self.mode) if filename else None
+        msg = 'live preview in %s mode with %d frames of %dx%d binned pixels' % (self.mode, self.nrSteps, phase.shape[1], phase.shape[0])
+        print(msg)
+        log.info(msg)
+        start = time.time()
+        nr = 0
+        times = []
+        try:
+            while duration is None or time.time() - start < duration:
+                if nr:
+                    (phase, contrast, pvs) = self.capture(frames)
+                now = time.time()
+                nr += 1
+                # rate over the last 10 previews
+                times = times[-9:] + [now]
+                rate = (len(times) - 1) / (now - times[0]) if len(times) > 1 else 0.0
+                if stream is not None:
+                    stream.append(now, phase, contrast, pvs)
+                if display is not None:
+                    if not display.update(phase, contrast, rate):
+                        break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.ctrl.setSetpoint(self.piezo_ini['offset'])
+            if stream is not None:
+                stream.close()
+        msg = 'live preview stopped after %d previews in %.1f s' % (nr, time.time() - start)
+        print(msg)
+        log.info(msg)
+        return nr
+
+
+class _BlitDisplay():
+    # contrast and phase images, only the images and the title are redrawn
+    def __init__(self, phase, contrast):
+        import matplotlib.pyplot as plt
+        (self.fig, axes) = plt.subplots(1, 2, figsize=(12, 5))
+        self.contrastImage = axes[0].imshow(contrast, vmin=0, vmax=1, animated=True)
+        self.fig.colorbar(self.contrastImage, ax=axes[0]).set_label('contrast')
+        self.phaseImage = axes[1].imshow(phase, vmin=-np.pi, vmax=np.pi, cmap='twilight', animated=True)
+        self.fig.colorbar(self.phaseImage, ax=axes[1]).set_label('wrapped phase (rad)')
+        axes[0].set_title('contrast')
+        axes[1].set_title('wrapped phase')
+        self.text = self.fig.suptitle(' ', animated=True)
+        self.closed = False
+        self.fig.canvas.mpl_connect('close_event', self._onClose)
+        plt.show(block=False)
+        plt.pause(0.1)
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _onClose(self, event):
+        self.closed = True
+
+    def update(self, phase, contrast, rate):
+        '''redraws the images, returns False when the window is closed'''
+        if self.closed:
+            return False
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self.contrastImage.set_data(contrast)
+        self.phaseImage.set_data(phase)
+        self.text.set_text('mean contrast %.3f, max %.3f - %.1f Hz' % (np.nanmean(contrast), np.nanmax(contrast), rate))
+        for artist in (self.contrastImage, self.phaseImage, self.text):
+            self.fig.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        return not self.closed
+
+
+class _Hdf5Stream():
+    # resizable datasets, flushed after every preview so the file can be read while streaming
+    def __init__(self, filename, shape, nrSteps, binning, mode):
+        import h5py
+        self.file = h5py.File(filename, 'w')
+        self.phase = self.file.create_dataset('phase', (0,) + shape, maxshape=(None,) + shape,
+                                              dtype=np.float32, chunks=(1,) + shape)
+        self.contrast = self.file.create_dataset('contrast', (0,) + shape, maxshape=(None,) + shape,
+                                                 dtype=np.float32, chunks=(1,) + shape)
+        self.times = self.file.create_dataset('times', (0,), maxshape=(None,), dtype=np.float64)
+        self.pvs = self.file.create_dataset('pvs', (0, nrSteps), maxshape=(None, nrSteps), dtype=np.float64)
+        self.file.attrs['numSteps'] = nrSteps
+        self.file.attrs['binning'] = binning
+        self.file.attrs['mode'] = np.bytes_(mode)
+        log.info('streaming live preview to %s' % filename)
+
+    def append(self, now, phase, contrast, pvs):
+        n = self.times.shape[0]
+        for (dataset, value) in ((self.phase, phase), (self.contrast, contrast), (self.times, now), (self.pvs, pvs)):
+            dataset.resize(n + 1, axis=0)
+            dataset[n] = value
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -13,12 +13,81 @@ import os
 import time
 import h5py
 import numpy as np
+from threading import Thread
+import timing
+import dataset_index
 
 
 class MeasureSurfaceError(Exception):
     pass
 
 
+class FrameTracker():
+    def __init__(self, cam):
+        '''returns every camera frame only once and skips frames whose
+        exposure started before a given time, without blind sleeps.
+
+        The camera timestamps are mapped to the host clock with the lower
+        envelope of (receive time - exposure time - timestamp) over all
+        frames, the exposure start of a frame is thus estimated at most the
+        shortest readout and transfer time late. The timestamp unit in s is
+        set by timestampUnit in the [camera] section of the ini file. Create
+        a new tracker for every measurement, so drift of the camera clock
+        does not build up.'''
+        self.cam = cam
+        self.period = 1.0 / cam._ini['framerate']
+        self.exposure = cam._ini['exposureTime'] * 1E-6
+        self.timestampUnit = cam._ini.get('timestampUnit', 1E-9)
+        self.discarded = 0
+        self.repeated = 0
+        self._frameId = None
+        self._timestamp = None
+        self._start = None
+        self._offset = None
+
+    def _exposureStart(self, meta, received):
+        # host time at which the exposure of the frame started
+        timestamp = meta['timestamp'] * self.timestampUnit
+        if self._timestamp is not None and timestamp <= self._timestamp:
+            # camera without (running) timestamps
+            return received - self.exposure
+        self._timestamp = timestamp
+        offset = received - self.exposure - timestamp
+        if self._offset is None or offset < self._offset:
+            self._offset = offset
+        return timestamp + self._offset
+
+    def getFrame(self, notBefore=0.0, timeout=1.0):
+        '''returns (image, meta, exposureStart) of the next new frame whose
+        exposure started at or after host time notBefore, meta is the decoded
+        meta data'''
+        deadline = time.time() + timeout + self.exposure
+        while True:
+            if self._start is not None:
+                # sleep until the first frame starting after notBefore is read out
+                nr = max(1, np.ceil((notBefore - self._start) / self.period))
+                wait = self._start + nr*self.period + self.exposure - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            (image, meta) = self.cam.get_image()
+            received = time.time()
+            meta = self.cam.decode_meta_data(meta)
+            if meta['frame_id'] == self._frameId:
+                self.repeated += 1
+                # frame not yet available, poll again shortly
+                time.sleep(self.period / 10)
+            else:
+                self._frameId = meta['frame_id']
+                self._start = self._exposureStart(meta, received)
+                if self._start >= notBefore:
+                    return (image, meta, self._start)
+                self.discarded += 1
+            if time.time() > deadline:
+                msg = 'no new camera frame exposed after %.3f within %.1f s' % (notBefore, timeout)
+                logging.error(msg)
+                raise MeasureSurfaceError(msg)
+
+
 class Phase_stepping():
     def __init__(self, piezo_ini, phase_stepping_ini, cam, ctrl, datapath):
         self.piezo_ini = piezo_ini
@@ -26,10 +95,45 @@ class Phase_stepping():
         self.cam = cam
         self.ctrl = ctrl
         self.datapath = datapath
+        self._saveThreads = []
+        # errors of hdf5 files written in the background, by file
+        self._saveErrors = dict()
 
     def recordSurface(self):
-        (image, meta) = self.cam.get_image()
-        meta = self.cam.decode_meta_data(meta)
+        '''records the phase stepping interferograms and stores them in a hdf5
+        file in datapath, returns the path of the file'''
+        measurement = self.acquireSurface()
+        return self.saveSurface(measurement)
+
+    def acquireSurface(self):
+        '''records the phase stepping interferograms in memory
+
+        returns a dict with images, timestamps, setpoints, pvs, wavelength,
+        cameraRoi, binning and filename, which can be passed to
+        analyze_surface.fdmsImage.fromArrays() and to saveSurface(). When
+        timing is enabled the dict also holds the span statistics of the
+        measurement under timing.
+
+        Every image is a different camera frame, exposed after the piezo
+        settled at the phase step, see FrameTracker. With mode = sweep in the
+        phase_stepping section the frames are recorded while the piezo moves,
+        see _sweep().'''
+        if not timing.isEnabled():
+            return self._acquireSurface()
+        with timing.collect() as timer:
+            with timing.span('measure.total'):
+                measurement = self._acquireSurface()
+        timer.logSummary(title='timing of %s' % measurement['filename'])
+        measurement['timing'] = timer.getStats()
+        return measurement
+
+    def _acquireSurface(self):
+        frames = FrameTracker(self.cam)
+        (image, meta, start) = frames.getFrame()
+        # sensor region (T,L,H,W) of the images, in unbinned pixels
+        binning = meta.get('binning', 1)
+        cameraRoi = meta.get('roi', (meta.get('offset_y', 0), meta.get('offset_x', 0),
+                                     meta['height']*binning, meta['width']*binning))
         pixformat = self.cam._ini['nrBits']
         if pixformat == 8:
             dtype = np.uint8
@@ -39,25 +143,19 @@ class Phase_stepping():
             msg = 'unsupported number of bits: %d' % pixformat
             logging.error(msg)
             raise MeasureSurfaceError(msg)
-        hdfDtype = dtype
 
         filename = time.strftime('%Y%m%dT%H%M%S_interferograms.hdf5')
-        HDF5_FILE = os.path.join(self.datapath, filename)
-        logging.info('Saving image data to %s' % HDF5_FILE)
-        print('Saving image data to %s' % HDF5_FILE)
-        try:
-            f = h5py.File(HDF5_FILE, "w")
-            imageStack = f.create_dataset("images",
-                (self.phase_stepping_ini['nrSteps'], self.phase_stepping_ini['nrImages'], meta['height'], meta['width']), 
-                dtype=hdfDtype, 
-                compression='gzip', 
-                compression_opts=9)
-            timeStampStack = f.create_dataset("timestamps",
-                (self.phase_stepping_ini['nrSteps'], self.phase_stepping_ini['nrImages']), 
-                dtype=np.float64)
-        except:
-            logging.error('could not open hdf5 file %s' % HDF5_FILE)
-            raise MeasureSurfaceError('error during creating HDF5 file')
+        mode = self.phase_stepping_ini.get('mode', 'step')
+        measurement = {'wavelength': self.phase_stepping_ini['wavelength'], 'cameraRoi': tuple(cameraRoi),
+                       'binning': binning, 'pvPerFringe': self.piezo_ini.get('pvperfringe'),
+                       'mode': mode, 'filename': filename}
+        if mode == 'sweep':
+            measurement.update(self._sweep(frames, (meta['height'], meta['width']), dtype))
+            return measurement
+        images = np.empty((self.phase_stepping_ini['nrSteps'], self.phase_stepping_ini['nrImages'], meta['height'], meta['width']), 
+                          dtype=dtype)
+        timestamps = np.empty((self.phase_stepping_ini['nrSteps'], self.phase_stepping_ini['nrImages']), 
+                              dtype=np.float64)
         
         setpoints = []
         pvs = []
@@ -66,58 +164,174 @@ class Phase_stepping():
         for ii in range(self.phase_stepping_ini['nrSteps']):
             self.ctrl.setSetpoint(setpoints[ii])
             logging.debug('go to setpoint %.3f' % setpoints[ii])
-            time.sleep(0.15)
-            self.waitForPosition(timeout=1)
-            pvs.append(self.ctrl.getPv())
+            with timing.span('measure.settle'):
+                self.waitForPosition(timeout=1)
+                pvs.append(self.ctrl.getPv())
+            settled = time.time()
             logging.info('PID setpoint: %.4f current position: %.4f' % (setpoints[ii], pvs[-1]))
             if abs(setpoints[ii] - pvs[-1]) > self.piezo_ini['maxError']:        
                 msg = 'current position %f deviates more from setpoint %f than tolerated!' % (pvs[-1], setpoints[ii])
                 logging.warning(msg)
                 print(msg)
-                time.sleep(1)
-                pvs.pop()
-                pvs.append(self.ctrl.getPv())
-                msg = 'after additional 1 second wait time: PID setpoint: %.4f current position: %.4f' % (setpoints[ii], pvs[-1])
+                with timing.span('measure.resettle'):
+                    self.waitForPosition(timeout=1)
+                    pvs.pop()
+                    pvs.append(self.ctrl.getPv())
+                settled = time.time()
+                msg = 'after additional wait for settling: PID setpoint: %.4f current position: %.4f' % (setpoints[ii], pvs[-1])
                 logging.info(msg)
                 print(msg)
-            # record number of images and store in hdf5 file
+            # record number of images
             print('step {}/{} - recording {} images: '.format(ii+1, self.phase_stepping_ini['nrSteps'], self.phase_stepping_ini['nrImages']), end = '')
             for jj in range(self.phase_stepping_ini['nrImages']):
-                (image, meta_data) = self.cam.get_image()
-                meta = self.cam.decode_meta_data(meta_data)
-                imageStack[ii,jj,...] = image
-                timeStampStack[ii,jj] = meta['timestamp']
+                with timing.span('measure.fetch'):
+                    # only frames exposed completely after settling
+                    (image, meta, start) = frames.getFrame(notBefore=settled)
+                with timing.span('measure.store'):
+                    images[ii,jj,...] = image
+                    timestamps[ii,jj] = meta['timestamp']
                 print('{}'.format(jj+1), end=' ')
             print('\n')
             logging.info('recorded %d images at step %d' % (jj+1, ii+1))         
     
         # set pid controller back to start position
         self.ctrl.setSetpoint(self.piezo_ini['offset'])
-    
-        # store some housekeeping data
-        imageStack.attrs['filename'] = np.string_(filename)
-        imageStack.attrs['setpoints'] = setpoints
-        imageStack.attrs['pvs'] = pvs
-        imageStack.attrs['numSteps'] = ii+1
-        imageStack.attrs['numImages'] = jj+1
-        imageStack.attrs['wavelength'] = self.phase_stepping_ini['wavelength']
-        
-        f.flush()
-        f.close()
-        logging.debug('closed hdf5 file')
+        logging.info('skipped %d frames exposed before settling and %d repeated frames'
+                     % (frames.discarded, frames.repeated))
+        measurement.update({'images': images, 'timestamps': timestamps, 'setpoints': setpoints, 'pvs': pvs})
+        return measurement
+
+    def _sweep(self, frames, shape, dtype):
+        '''records sweepFrames consecutive frames while the setpoint ramps
+        linearly over sweepRange, instead of settling at every phase step.
+        The position of every frame is interpolated from the PID telemetry at
+        the middle of its exposure, the phase shifts are therefore not equal
+        and the analysis uses the least squares algorithm.
+
+        returns a dict with images (sweepFrames, 1, H, W), timestamps,
+        setpoints and pvs'''
+        nrFrames = self.phase_stepping_ini['sweepFrames']
+        start = self.piezo_ini['offset']
+        stop = start + self.phase_stepping_ini['sweepRange']
+        images = np.empty((nrFrames, 1) + shape, dtype=dtype)
+        timestamps = np.empty((nrFrames, 1), dtype=np.float64)
+        exposureStarts = np.empty(nrFrames)
+        self.ctrl.setSetpoint(start)
+        with timing.span('measure.settle'):
+            self.waitForPosition(timeout=1)
+        # one extra frame period, so the last frame is exposed before the ramp ends
+        duration = (nrFrames + 1) * frames.period
+        msg = 'sweep from %.3f to %.3f in %.0f ms - recording %d frames' % (start, stop, duration*1e3, nrFrames)
+        print(msg)
+        logging.info(msg)
+        rampStart = time.time()
+        self.ctrl.rampSetpoint(start, stop, duration)
+        for ii in range(nrFrames):
+            with timing.span('measure.fetch'):
+                (image, meta, exposureStarts[ii]) = frames.getFrame(notBefore=rampStart)
+            with timing.span('measure.store'):
+                images[ii,0,...] = image
+                timestamps[ii,0] = meta['timestamp']
+        (times, pvs, setpoints) = self.ctrl.getHistory(since=rampStart - 0.1)
+        self.ctrl.setSetpoint(self.piezo_ini['offset'])
+        if not times:
+            msg = 'no PID telemetry recorded during sweep'
+            logging.error(msg)
+            raise MeasureSurfaceError(msg)
+        exposureMiddle = exposureStarts + frames.exposure/2
+        pvs = np.interp(exposureMiddle, times, pvs)
+        setpoints = np.interp(exposureMiddle, times, setpoints)
+        logging.info('recorded %d frames, pv from %.4f to %.4f, skipped %d frames and %d repeated frames'
+                     % (nrFrames, pvs[0], pvs[-1], frames.discarded, frames.repeated))
+        return {'images': images, 'timestamps': timestamps, 'setpoints': list(setpoints), 'pvs': list(pvs)}
+
+    def saveSurface(self, measurement, wait=True):
+        '''stores a measurement of acquireSurface() in a hdf5 file in datapath
+        and returns the path of the file. With wait=False the file is written
+        in a background thread, use waitForSaving() before relying on the file,
+        errors during writing are raised by waitForSaving().'''
+        HDF5_FILE = os.path.join(self.datapath, measurement['filename'])
+        logging.info('Saving image data to %s' % HDF5_FILE)
+        print('Saving image data to %s' % HDF5_FILE)
+        if wait:
+            self._writeHdf5(HDF5_FILE, measurement)
+        else:
+            thread = Thread(target=self._writeInBackground, args=(HDF5_FILE, measurement), daemon=False)
+            thread.start()
+            self._saveThreads = [t for t in self._saveThreads if t.is_alive()] + [thread]
         return HDF5_FILE
+
+    def waitForSaving(self, timeout=None):
+        '''waits until all hdf5 files written in the background are closed.
+        Returns False when files are still being written after timeout. 
+        Raises MeasureSurfaceError when writing any of the files failed.'''
+        for thread in self._saveThreads:
+            thread.join(timeout)
+        self._saveThreads = [t for t in self._saveThreads if t.is_alive()]
+        if self._saveErrors:
+            (errors, self._saveErrors) = (self._saveErrors, dict())
+            msg = 'error during saving %s' % ', '.join('%s (%s)' % item for item in errors.items())
+            raise MeasureSurfaceError(msg)
+        return not self._saveThreads
+
+    def _writeInBackground(self, HDF5_FILE, measurement):
+        try:
+            self._writeHdf5(HDF5_FILE, measurement)
+        except Exception as e:
+            logging.error('error during saving %s: %s' % (HDF5_FILE, e))
+            self._saveErrors[HDF5_FILE] = e
+
+    def _writeHdf5(self, HDF5_FILE, measurement):
+        images = measurement['images']
+        (nrSteps, nrImages) = images.shape[:2]
+        start = time.perf_counter()
+        try:
+            f = h5py.File(HDF5_FILE, "w")
+        except:
+            logging.error('could not open hdf5 file %s' % HDF5_FILE)
+            raise MeasureSurfaceError('error during creating HDF5 file')
+        # the file is closed as well when writing fails
+        with f:
+            try:
+                imageStack = f.create_dataset("images",
+                    data=images, 
+                    compression='gzip', 
+                    compression_opts=9)
+                f.create_dataset("timestamps", data=measurement['timestamps'])
+            except:
+                logging.error('could not write images to hdf5 file %s' % HDF5_FILE)
+                raise MeasureSurfaceError('error during creating HDF5 file')
+        
+            # store some housekeeping data
+            imageStack.attrs['filename'] = np.bytes_(measurement['filename'])
+            imageStack.attrs['setpoints'] = measurement['setpoints']
+            imageStack.attrs['pvs'] = measurement['pvs']
+            imageStack.attrs['numSteps'] = nrSteps
+            imageStack.attrs['numImages'] = nrImages
+            imageStack.attrs['wavelength'] = measurement['wavelength']
+            imageStack.attrs['cameraRoi'] = measurement['cameraRoi']
+            imageStack.attrs['binning'] = measurement['binning']
+            imageStack.attrs['mode'] = np.bytes_(measurement['mode'])
+            if measurement['pvPerFringe'] is not None:
+                imageStack.attrs['pvPerFringe'] = measurement['pvPerFringe']
+            if 'timing' in measurement:
+                # breakdown of the acquisition plus the compression of this file
+                timing.writeAttrs(measurement['timing'], imageStack.attrs)
+                duration = time.perf_counter() - start
+                imageStack.attrs['timing_measure.save'] = [1, duration, duration]
+                timing.record('measure.save', duration)
+            attrs = dict(imageStack.attrs)
+            f.flush()
+        logging.debug('closed hdf5 file %s' % HDF5_FILE)
+        dataset_index.addMeasurement(HDF5_FILE, attrs)
     
     def waitForPosition(self, timeout=2):
-        start = time.time()
-        to = True
-        while time.time() < (start + timeout):
-            if self.ctrl.getError() > self.piezo_ini['maxError']:
-                time.sleep(0.020)
-            else:
-                to = False
-                break
-        if to:
-            msg = 'timeout while waiting for PID controller to reach position'
-            print(msg)
-            logging.warning(msg)
+        '''waits until the PID controller reports that the error stayed within 
+        maxError for a number of consecutive cycles, returns False on timeout'''
+        if self.ctrl.waitForSettled(timeout):
+            return True
+        msg = 'timeout while waiting for PID controller to reach position'
+        print(msg)
+        logging.warning(msg)
+        return False
             
\ No newline at end of file
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+def lsqPhase(images, shifts):
+    ''' (phase, contrast, background) = lsqPhase(images, shifts)
+
+    least squares phase retrieval for arbitrary, known phase shifts
+    images:   array (N, H, W) with N >= 3 interferograms
+    shifts:   N phase shifts of the interferograms in rad
+
+    fits I_k = a + b*cos(shifts_k) + c*sin(shifts_k) in every pixel. The
+    design matrix is the same for all pixels, so a single pseudo inverse
+    solves all pixels at once. Returns the wrapped phase atan2(-c, b), the
+    contrast sqrt(b^2 + c^2)/a and the background a, each (H, W).   '''
+
+    shifts = np.asarray(shifts, dtype=np.float64)
+    n = len(shifts)
+    if n < 3 or images.shape[0] != n:
+        raise ValueError('need at least 3 images and one phase shift per image')
+    A = np.stack((np.ones(n), np.cos(shifts), np.sin(shifts)), axis=1)
+    coeffs = np.linalg.pinv(A) @ images.reshape(n, -1).astype(np.float64)
+    (a, b, c) = coeffs.reshape((3,) + images.shape[1:])
+    phase = np.arctan2(-c, b)
+    contrast = np.hypot(b, c) / a
+    return (phase, contrast, a)
+
+
+def aiaPhase(images, shifts, iterations=30, tolerance=1E-4, minContrast=0.5):
+    ''' (phase, contrast, background, shifts) = aiaPhase(images, shifts)
+
+    advanced iterative algorithm (Wang and Han, 2004): phase retrieval with
+    unknown phase shifts, alternating between
+        - the phase of every pixel for the current phase shifts (lsqPhase)
+        - the phase shift of every frame for the current pixel phases, by
+          fitting the intensity relative to the background of the pixel,
+          I_k/background = a_k + b_k*cos(phase) + c_k*sin(phase), over the
+          pixels
+    images:       array (N, H, W) with N >= 3 interferograms
+    shifts:       N initial phase shifts in rad, e.g. from the piezo positions
+    iterations:   maximum number of iterations
+    tolerance:    stop when no shift changes more than tolerance rad
+    minContrast:  pixels with a contrast below minContrast times the median
+                  contrast are not used for the phase shifts, neither are
+                  pixels without background or with undefined contrast
+
+    The design matrix of both steps is shared by all pixels respectively all
+    frames, so every step is a single 3x3 system with many right hand sides.
+    Returns the wrapped phase, contrast, background and the phase shifts
+    relative to the first frame. The direction of the shifts is taken from
+    the initial shifts. When too few pixels are usable to fit the phase
+    shifts, the initial shifts are used as they are (lsqPhase).   '''
+
+    shifts = np.asarray(shifts, dtype=np.float64)
+    shifts = shifts - shifts[0]
+    measured = shifts
+    n = len(shifts)
+    data = images.reshape(n, -1).astype(np.float64)
+    for ii in range(iterations):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            (phase, contrast, background) = lsqPhase(data, shifts)
+        valid = (background > 0) & np.isfinite(contrast)
+        use = valid.copy()
+        if np.any(valid):
+            use[valid] = contrast[valid] > minContrast * np.nanmedian(contrast[valid])
+        if np.count_nonzero(use) < 3:
+            shifts = measured
+            break
+        # relative intensity, so pixels with different illumination are weighted equally
+        relative = data[:, use] / background[use]
+        X = np.stack((np.ones(np.count_nonzero(use)), np.cos(phase[use]), np.sin(phase[use])), axis=1)
+        try:
+            (a, b, c) = np.linalg.solve(X.T @ X, X.T @ relative.T)
+        except np.linalg.LinAlgError:
+            shifts = measured
+            break
+        # 1 + V*cos(phase + shift_k) gives b = V*cos(shift_k), c = -V*sin(shift_k)
+        newShifts = np.arctan2(-c, b)
+        newShifts = newShifts - newShifts[0]
+        # keep the shifts continuous with the previous estimate
+        change = np.angle(np.exp(1j*(newShifts - shifts)))
+        shifts = shifts + change
+        if np.max(np.abs(change)) < tolerance:
+            break
+    with np.errstate(divide='ignore', invalid='ignore'):
+        (phase, contrast, background) = lsqPhase(data, shifts)
+    shape = images.shape[1:]
+    return (phase.reshape(shape), contrast.reshape(shape), background.reshape(shape), shifts)
+
+
+def closedPhase(images):
+    ''' (phase, contrast) = closedPhase(images)
+
+    closed form phase retrieval for N = 4, 5, 6 or 7 interferograms with
+    equal phase steps of 90 degrees
+    images:   array (N, H, W)
+
+    4 steps: standard four bucket algorithm
+    5 steps: Schwider-Hariharan algorithm
+    6 and 7 steps: the corresponding error compensating algorithms, the
+    contrast is calculated from the first 5 images with Schwider-Hariharan
+    Returns the wrapped phase and the contrast, each (H, W).   '''
+
+    img = images
+    n = img.shape[0]
+    if n == 4:
+        phase = np.arctan2(img[3,...] - img[1,...], img[0,...] - img[2,...])
+        nom = 2*np.hypot(img[3,...] - img[1,...], img[0,...] - img[2,...])
+        contrast = nom / (img[0,...] + img[1,...] + img[2,...] + img[3,...])
+        return (phase, contrast)
+    if n == 5:
+        # phase according to Schwider-Hariharan Algorithm
+        nom = (-2*img[1,...] + 2*img[3,...])
+        denom = (img[0,...] - 2*img[2,...] + img[4,...])
+    elif n == 6:
+        nom = (-3*img[1,...] + 4*img[3,...] -img[5,...])
+        denom =  (img[0,...] -4*img[2,...] + 3*img[4,...])
+    elif n == 7:
+        nom = 4*(img[1,...] - 2*img[3,...] + img[5,...])
+        denom = (-img[0,...] + 7*img[2,...] - 7*img[4,...] + img[6,...])
+    else:
+        raise ValueError('no closed form algorithm for %d steps' % n)
+    phase = np.arctan2(nom, denom)
+
+    # contrast according to Schwider-Hariharan Algorithm
+    term1 = np.power((img[1,...] - img[3,...]), 2)
+    term2 = np.power((img[0,...] -2*img[2,...] + img[4,...]), 2)
+    nom = 2*np.power(4*term1 + term2, 0.5)
+    denom = (img[0,...] + 2*(img[1,...] + img[2,...] + img[3,...]) + img[4,...])
+    contrast =  nom / denom
+    return (phase, contrast)
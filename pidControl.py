@@ -5,25 +5,154 @@ Created on Fri Oct 21 14:16:02 2016
 @author: eschenm
 """
 
-import time, logging
+import time, logging, math
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
 import labjack
+import iniparser
+import timing
 from threading import Thread
 from threading import Lock
+from threading import Event
 
 log = logging.getLogger('pidControl')
 
-def connectU3():
-    u3 = labjack.LabJackU3()
+def connectU3(numReadings=1, simulate=False, **simParameters):
+    '''connects the LabJack U3 and creates the piezo, adc and pulser
+
+    numReadings     nr of position readings averaged per adc reading
+    simulate        use the simulated U3 and piezo of labjack_sim, 
+                    simParameters are passed to labjack_sim.SimulatedLabJackU3
+    '''
+    if simulate:
+        import labjack_sim
+        u3 = labjack_sim.SimulatedLabJackU3(**simParameters)
+    else:
+        u3 = labjack.LabJackU3()
     log.debug('connected labjeck U3')
     u3.piezo = labjack.Piezo(u3)
-    u3.adc = labjack.Adc(u3)
+    # position readings are averaged within a single feedback packet
+    u3.adc = labjack.Adc(u3, numReadings=numReadings)
     u3.pulser = labjack.Pulser(u3)
-    # include averaging of position readings
     return u3
 
+def fopdtFromRelay(relayAmplitude, oscAmplitude, period, processGain, hysteresis=0.0):
+    '''Fits a first order plus dead time model K*exp(-L*s)/(1 + T*s) to the 
+    result of a relay (Astrom-Hagglund) experiment.
+
+    relayAmplitude  relay output amplitude d in V
+    oscAmplitude    amplitude a of the resulting pv oscillation
+    period          ultimate period Tu of the oscillation in s
+    processGain     static gain K in pv/V
+    hysteresis      relay hysteresis in pv
+
+    returns (K, T, L, Ku, Tu)'''
+    a = math.sqrt(max(oscAmplitude**2 - hysteresis**2, 1e-12))
+    Ku = 4 * relayAmplitude / (math.pi * a)
+    w = 2 * math.pi / period
+    KKu = abs(processGain) * Ku
+    if KKu > 1:
+        T = math.sqrt(KKu**2 - 1) / w
+    else:
+        # oscillation is dominated by dead time
+        T = 1e-6
+    L = (math.pi - math.atan(w * T)) / w
+    return (processGain, T, L, Ku, period)
+
+def simulateStepResponse(pid, model, stepSize, dt, duration=1.0, ovMin=-0.5, ovMax=10.0, dtx=0.005):
+    '''Simulates a setpoint step of the PID loop on a first order plus dead 
+    time plant. The control law is the same as in 
+    PidController.calculateControlVariable, including the fixed dtx and the 
+    capped integral term.
+
+    pid         (Kp, Ki, Kd)
+    model       (K, T, L) plant model, K in pv/V and T, L in s
+    stepSize    setpoint step in pv
+    dt          PID loop interval in s
+
+    returns list of pv values, one per PID cycle'''
+    (Kp, Ki, Kd) = pid
+    (K, T, L) = model
+    delay = int(round(L / dt))
+    alpha = 1 - math.exp(-dt / max(T, 1e-9))
+    # start in steady state at the operating point in the middle of the range
+    u0 = (ovMin + ovMax) / 2.0
+    pv = K * u0
+    setpoint = pv + stepSize
+    Ci = u0 / Ki if Ki else 0.0
+    Ci = min(max(Ci, -0.2), 0.2)
+    prevError = 0.0
+    history = [u0] * (delay + 1)
+    response = []
+    for ii in range(int(duration / dt)):
+        error = setpoint - pv
+        Ci = min(max(Ci + error * dtx, -0.2), 0.2)
+        Cd = (error - prevError) / dtx if ii > 0 else 0.0
+        prevError = error
+        u = Kp * error + Ki * Ci + Kd * Cd
+        u = min(max(u, ovMin), ovMax)
+        history.append(u)
+        pv += alpha * (K * history.pop(0) - pv)
+        response.append(pv)
+    return (setpoint, response)
+
+def settlingTime(setpoint, response, maxError, dt):
+    '''returns the time after which the response stays within maxError of 
+    the setpoint, None if it does not settle'''
+    for ii in range(len(response) - 1, -1, -1):
+        if abs(setpoint - response[ii]) > maxError:
+            if ii == len(response) - 1:
+                return None
+            return (ii + 1) * dt
+    return 0.0
+
+def proposeGains(model, maxError, stepSize, dt, ovMin=-0.5, ovMax=10.0, dtx=0.005):
+    '''Proposes PID gains for a first order plus dead time model which 
+    minimise the simulated settling time into the maxError band.
+
+    Candidates are SIMC (Skogestad) tunings for a range of closed loop time 
+    constants, converted to the units used by PidController (integral and 
+    derivative terms are scaled with the fixed dtx instead of the loop 
+    interval). Each candidate is evaluated with simulateStepResponse.
+
+    returns ((Kp, Ki, Kd), settling time in s)'''
+    (K, T, L) = model
+    K = abs(K)
+    best = (None, None)
+    for factor in (0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0):
+        tauC = max(factor * max(L, dt), dt)
+        Kp = T / (K * (tauC + L)) if T > 1e-5 else 0.0
+        Ti = min(max(T, dt), 4 * (tauC + L))
+        if Kp == 0:
+            # pure integral control for a dead time dominated plant
+            Ki = 1.0 / (K * (tauC + L)) * dt / dtx
+        else:
+            Ki = Kp / Ti * dt / dtx
+        for Td in (0.0, L / 2.0):
+            Kd = Kp * Td * dtx / dt
+            pid = (Kp, Ki, Kd)
+            (setpoint, response) = simulateStepResponse(pid, (K, T, L), stepSize, dt, 
+                                    duration=max(1.0, 50 * (T + L)), ovMin=ovMin, ovMax=ovMax, dtx=dtx)
+            ts = settlingTime(setpoint, response, maxError, dt)
+            if ts is not None and (best[1] is None or ts < best[1]):
+                best = (pid, ts)
+    return best
+
 class PidController(Thread):    
-    def __init__(self, u3, pid = None, setpoint = 0.0, ovMin = 0.0, ovMax=10.0, pausetime = 0.1, debug = False):
-        '''constructor '''
+    def __init__(self, u3, pid = None, setpoint = 0.0, ovMin = 0.0, ovMax=10.0, pausetime = 0.1, debug = False, maxError = 0.01, settleTicks = 10, feedForward = None, historyLength = 2000):
+        '''constructor 
+        
+        maxError        max allowed difference between setpoint and pv for the
+                        position to be regarded as settled
+        settleTicks     number of consecutive PID cycles the error has to stay
+                        within maxError before the position is settled
+        feedForward     (voltsPerPv, offset) model of the piezo: on a setpoint 
+                        change the output jumps to voltsPerPv*setpoint + offset
+                        and the PID loop only corrects the residual
+        historyLength   number of PID cycles kept in the telemetry history,
+                        see getHistory()
+        '''
         Thread.__init__(self)
         self.lock = Lock()
         self._u3 = u3
@@ -40,10 +169,22 @@ class PidController(Thread):
         self._pidInterval = []
         self._pidLoopCnt = 0
         self._pidLoopLen = 50
+        self._maxError = float(maxError)
+        self._settleTicks = int(settleTicks)
+        self._settledCnt = 0
+        self._settled = Event()
+        self._feedForward = None
+        self._openLoop = False
+        self._pv = float('nan')
+        self._pvTime = float('nan')
+        self._ramp = None
+        self._history = deque(maxlen=int(historyLength))
         if pid is None:
             self.setPid((0, 0, 0))    
         else:
             self.setPid(pid)
+        if feedForward is not None:
+            self.setFeedForward(feedForward)
         if debug:
             self._displayStatus = True
 
@@ -125,9 +266,292 @@ class PidController(Thread):
         self.lock.acquire()
         try:
             self._setpoint = setpoint
+            self._ramp = None
+            self._settledCnt = 0
+            self._settled.clear()
+        finally:
+            self.lock.release()
+
+    def rampSetpoint(self, start, stop, duration):
+        '''moves the setpoint linearly from start to stop in duration seconds.
+        The setpoint is updated every PID cycle, the position is settled after
+        the ramp has ended. setSetpoint() aborts the ramp.'''
+        self.lock.acquire()
+        try:
+            self._ramp = (time.time(), float(start), float(stop), float(duration))
+            self._setpoint = start
+            self._settledCnt = 0
+            self._settled.clear()
+        finally:
+            self.lock.release()
+        log.debug('ramp setpoint from %.3f to %.3f in %.3f s' % (start, stop, duration))
+
+    def _updateRamp(self):
+        self.lock.acquire()
+        try:
+            if self._ramp is None:
+                return
+            (t0, start, stop, duration) = self._ramp
+            f = (time.time() - t0) / duration
+            if f >= 1:
+                self._setpoint = stop
+                self._ramp = None
+            else:
+                self._setpoint = start + f * (stop - start)
+        finally:
+            self.lock.release()
+
+    def getHistory(self, since=None):
+        '''returns lists (times, pvs, setpoints) of the PID cycles after time
+        since, times are the middle of the position readings'''
+        self.lock.acquire()
+        try:
+            history = list(self._history)
+        finally:
+            self.lock.release()
+        if since is not None:
+            history = [h for h in history if h[0] > since]
+        if not history:
+            return ([], [], [])
+        return tuple(list(values) for values in zip(*history))
+
+    def getFeedForward(self):
+        self.lock.acquire()
+        try:
+            feedForward = self._feedForward
+        finally:
+            self.lock.release()
+        return feedForward
+
+    def setFeedForward(self, feedForward):
+        '''setFeedForward((voltsPerPv, offset)) enables feed-forward control, 
+        setFeedForward(None) disables it.
+
+        The integral term is corrected for the change in feed-forward output so 
+        switching does not cause a jump in piezo voltage.'''
+        self.lock.acquire()
+        try:
+            oldOutput = self._feedForwardOutput(self._setpoint)
+            if feedForward is None:
+                self._feedForward = None
+            else:
+                self._feedForward = (float(feedForward[0]), float(feedForward[1]))
+            newOutput = self._feedForwardOutput(self._setpoint)
+            if self._Ki:
+                self._Ci += (oldOutput - newOutput) / self._Ki
+        finally:
+            self.lock.release()
+        if feedForward is None:
+            log.info('disabled feed-forward control')
+        else:
+            log.info('enabled feed-forward control: %.4f V/pv, offset %.4f V' % self._feedForward)
+
+    def _feedForwardOutput(self, setpoint):
+        # must be called with the lock acquired
+        if self._feedForward is None:
+            return 0.0
+        return self._feedForward[0] * setpoint + self._feedForward[1]
+
+    def isSettled(self):
+        '''True when the error stayed within maxError for settleTicks PID cycles 
+        since the last setpoint change'''
+        return self._settled.is_set()
+
+    def waitForSettled(self, timeout=None):
+        '''blocks until the position is settled, returns False on timeout'''
+        return self._settled.wait(timeout)
+
+    def _updateSettled(self, error):
+        self.lock.acquire()
+        try:
+            if self._ramp is not None:
+                # never settled while ramping
+                self._settledCnt = 0
+                self._settled.clear()
+            elif abs(error) <= self._maxError:
+                self._settledCnt += 1
+                if self._settledCnt >= self._settleTicks:
+                    self._settled.set()
+            else:
+                self._settledCnt = 0
+                self._settled.clear()
         finally:
             self.lock.release()
+
+    def calibrateFeedForward(self, voltages=None, settleTime=0.1, stepDuration=0.5, pvPerFringe=None):
+        '''Measures the static voltage-per-pv model and the step response of the
+        piezo in open loop and enables feed-forward control.
+
+        voltages        list of piezo voltages at which the pv is measured, 
+                        defaults to 8 points between 1 and 8 V
+        settleTime      wait time in s after setting each voltage
+        stepDuration    recording time in s of the step response from the first
+                        to the last voltage
+        pvPerFringe     if given, the calibrated volts per fringe is logged
+
+        returns a dict with the fitted model and step response properties'''
+        if voltages is None:
+            voltages = [1.0 + ii for ii in range(8)]
+        voltages = [min(max(float(v), self._ovMin), self._ovMax) for v in voltages]
+        if len(set(voltages)) < 2:
+            raise ValueError('at least two different voltages are needed for calibration')
+        log.info('calibrating feed-forward model in open loop')
+        self.lock.acquire()
+        self._openLoop = True
+        self.lock.release()
+        try:
+            pvs = []
+            for voltage in voltages:
+                self.setOutput(voltage)
+                time.sleep(settleTime)
+                pvs.append(self.getPv())
+            # least squares fit of voltage = voltsPerPv * pv + offset
+            n = float(len(pvs))
+            mpv = sum(pvs) / n
+            mv = sum(voltages) / n
+            sxx = sum([(p - mpv)**2 for p in pvs])
+            sxy = sum([(p - mpv)*(v - mv) for (p, v) in zip(pvs, voltages)])
+            if sxx == 0:
+                raise ValueError('pv does not change with piezo voltage, check connections')
+            voltsPerPv = sxy / sxx
+            offset = mv - voltsPerPv * mpv
+
+            # record step response from first to last voltage
+            self.setOutput(voltages[0])
+            time.sleep(settleTime)
+            pvStart = self.getPv()
+            response = []
+            start = time.time()
+            self.setOutput(voltages[-1])
+            while time.time() - start < stepDuration:
+                response.append((time.time() - start, self.getPv()))
+        finally:
+            self.lock.acquire()
+            self._openLoop = False
+            # integral term wound up during the open loop measurement
+            self._Ci = 0
+            self.lock.release()
+        pvEnd = response[-1][1]
+        span = pvEnd - pvStart
+        (t10, t90, tSettle) = (None, None, 0.0)
+        for (t, pv) in response:
+            if span == 0:
+                break
+            if t10 is None and (pv - pvStart) / span >= 0.1:
+                t10 = t
+            if t90 is None and (pv - pvStart) / span >= 0.9:
+                t90 = t
+            if abs(pv - pvEnd) > self._maxError:
+                tSettle = t
+        riseTime = (t90 - t10) if (t10 is not None and t90 is not None) else None
+        calibration = {'voltsPerPv': voltsPerPv, 'offset': offset, 
+                       'riseTime': riseTime, 'settleTime': tSettle,
+                       'stepResponse': response}
+        log.info('feed-forward calibration: %.4f V/pv, offset %.4f V' % (voltsPerPv, offset))
+        if pvPerFringe:
+            log.info('feed-forward calibration: %.3f V/fringe' % (voltsPerPv * pvPerFringe))
+        if riseTime is not None:
+            log.info('step response: 10-90%% rise time %.1f ms, settling time %.1f ms' % (riseTime*1e3, tSettle*1e3))
+        self.lock.acquire()
+        try:
+            self._feedForward = (voltsPerPv, offset)
+        finally:
+            self.lock.release()
+        return calibration
             
+    def autoTune(self, relayAmplitude=0.5, hysteresis=None, cycles=6, timeout=10.0, stepSize=0.095, apply=False, iniFile=None):
+        '''Runs a relay (Astrom-Hagglund) experiment around the current 
+        setpoint, fits a first order plus dead time model and proposes PID 
+        gains which minimise the settling time into the maxError band for a 
+        setpoint step of stepSize.
+
+        relayAmplitude  relay output amplitude in V around the current output
+        hysteresis      relay hysteresis in pv, defaults to maxError/2
+        cycles          number of oscillation periods used for the analysis
+        timeout         max duration of the experiment in s
+        stepSize        setpoint step (pv) for which settling is optimised
+        apply           use the proposed gains directly
+        iniFile         if given, the proposed gains are written to the pid 
+                        option in the [piezo] section of this file
+
+        returns dict with the fitted model, the proposed gains and the 
+        expected settling time'''
+        if hysteresis is None:
+            hysteresis = self._maxError / 2.0
+        setpoint = self.getSetpoint()
+        # relay oscillates around the output voltage at the settled setpoint
+        self.waitForSettled(1.0)
+        bias = self.getOutput()
+        d = float(relayAmplitude)
+        log.info('starting relay auto-tune experiment, relay amplitude %.3f V' % d)
+        self.lock.acquire()
+        self._openLoop = True
+        self.lock.release()
+        try:
+            # static process gain, from the feed-forward model when available
+            feedForward = self.getFeedForward()
+            if feedForward is not None:
+                processGain = 1.0 / feedForward[0]
+            else:
+                pv0 = self.getPv()
+                self.setOutput(bias + d)
+                time.sleep(0.2)
+                processGain = (self.getPv() - pv0) / d
+                self.setOutput(bias)
+                time.sleep(0.2)
+            if processGain == 0:
+                raise ValueError('pv does not respond to piezo voltage, check connections')
+            sign = 1 if processGain > 0 else -1
+            # relay experiment
+            records = []
+            switches = []
+            u = bias + sign * d
+            self.setOutput(u)
+            start = time.time()
+            while time.time() - start < timeout and len(switches) < 2 * cycles + 4:
+                pv = self.getPv()
+                t = time.time() - start
+                error = setpoint - pv
+                if error > hysteresis and u != bias + sign * d:
+                    u = bias + sign * d
+                    switches.append(t)
+                elif error < -hysteresis and u != bias - sign * d:
+                    u = bias - sign * d
+                    switches.append(t)
+                self.setOutput(u)
+                records.append((t, pv))
+                time.sleep(self._pausetime)
+            dt = (records[-1][0] - records[0][0]) / max(len(records) - 1, 1)
+        finally:
+            self.setOutput(bias)
+            self.lock.acquire()
+            self._openLoop = False
+            # integral term wound up during the relay experiment
+            self._Ci = 0
+            self.lock.release()
+        if len(switches) < 6:
+            raise ValueError('relay experiment did not oscillate, increase relayAmplitude or timeout')
+        # skip the first transient half periods
+        used = switches[2:]
+        period = 2 * (used[-1] - used[0]) / (len(used) - 1)
+        pvs = [pv for (t, pv) in records if t >= used[0]]
+        oscAmplitude = (max(pvs) - min(pvs)) / 2.0
+        (K, T, L, Ku, Tu) = fopdtFromRelay(d, oscAmplitude, period, processGain, hysteresis)
+        log.info('relay experiment: Ku=%.3f V/pv, Tu=%.2f ms, loop interval %.2f ms' % (Ku, Tu*1e3, dt*1e3))
+        log.info('fitted FOPDT model: K=%.4f pv/V, T=%.2f ms, L=%.2f ms' % (K, T*1e3, L*1e3))
+        (pid, ts) = proposeGains((K, T, L), self._maxError, stepSize, dt, self._ovMin, self._ovMax)
+        if pid is None:
+            raise ValueError('no stable PID gains found for the fitted model')
+        log.info('proposed PID gains: Kp=%.4g Ki=%.4g Kd=%.4g, expected settling time %.1f ms' % (pid[0], pid[1], pid[2], ts*1e3))
+        if apply:
+            self.setPid(pid)
+            log.info('applied proposed PID gains')
+        if iniFile:
+            iniparser.updateOption(iniFile, 'piezo', 'pid', '%.4g, %.4g, %.4g' % pid)
+            log.info('wrote PID gains to %s' % iniFile)
+        return {'model': (K, T, L), 'Ku': Ku, 'Tu': Tu, 'interval': dt, 
+                'pid': pid, 'settlingTime': ts}
+
     def getPv(self):
         self.lock.acquire()
         try:
@@ -136,6 +560,15 @@ class PidController(Thread):
             self.lock.release()
         return pv
 
+    def getPvStats(self):
+        '''returns (mean, standard deviation) of the averaged position readings'''
+        self.lock.acquire()
+        try:
+            stats = self._u3.adc.readValueStats()
+        finally:
+            self.lock.release()
+        return stats
+
     def getCi(self):
         self.lock.acquire()
         try:
@@ -169,13 +602,17 @@ class PidController(Thread):
             Cd = de/dtx                            # derivative term
         self._prevtm = self._currtm               # save t for next pass
         self._prevError = error                   # save t-1 error
-        return (Cp + (self._Ki * self._Ci) + (self._Kd * Cd), dt)
+        Cff = self._feedForwardOutput(self._setpoint)  # feed-forward term
+        return (Cff + Cp + (self._Ki * self._Ci) + (self._Kd * Cd), dt)
 
     def getError(self):
         self.lock.acquire()
         try:
             setpoint = self._setpoint
+            start = time.time()
             pv = self._u3.adc.readValue()
+            self._pvTime = (start + time.time()) / 2
+            self._pv = pv
         finally:
             self.lock.release()
         return (setpoint - pv)
@@ -211,7 +648,12 @@ class PidController(Thread):
     def run(self):
         n=0
         while self._continue:
-            error = self.getError()
+            cycle = time.perf_counter()
+            self._updateRamp()
+            with timing.span('pid.read'):
+                error = self.getError()
+            self._history.append((self._pvTime, self._pv, self._pv + error))
+            self._updateSettled(error)
             (self._output, interval) = self.calculateControlVariable(error)
             self.updatePidLoopInterval(interval)
             if self._output > self._ovMax:
@@ -221,13 +663,22 @@ class PidController(Thread):
             if self._displayStatus and n > 5/self._pausetime:
                 self.printStatus()
                 n=0
-            self.setOutput(self._output)
-            self.setOutput(self._output)
+            if not self._openLoop:
+                with timing.span('pid.write'):
+                    self.setOutput(self._output)
+                    self.setOutput(self._output)
+            self._syncState(error)
+            # cycle time without the pause
+            timing.record('pid.cycle', time.perf_counter() - cycle)
             n += 1
             time.sleep(self._pausetime)
         print("exiting pid control, set piezo voltage to 0.0")
         self.setOutput(0.0)
         
+    def _syncState(self, error):
+        # called once every PID cycle, used by subclasses to exchange state
+        pass
+
     def laserPulse(self, length):
         self.lock.acquire()
         try:
@@ -244,6 +695,299 @@ class PidController(Thread):
             self.lock.release()
         return output
         
+class _SharedMemoryPidController(PidController):
+    '''PID controller running in the child process of PidProcessController.
+    Takes the setpoint from and publishes telemetry to shared memory.'''
+    def __init__(self, u3, shm, **parameters):
+        PidController.__init__(self, u3, **parameters)
+        self._shm = shm
+        self._state = shm.buf.cast('d')
+        self._setpointSeq = self._state[PidProcessController.SETPOINT_SEQ]
+        self._cycle = 0
+
+    def _syncState(self, error):
+        state = self._state
+        seq = state[PidProcessController.SETPOINT_SEQ]
+        if seq != self._setpointSeq:
+            self._setpointSeq = seq
+            duration = state[PidProcessController.RAMP_DURATION]
+            if duration > 0:
+                self.rampSetpoint(state[PidProcessController.RAMP_START], state[PidProcessController.SETPOINT], duration)
+            else:
+                self.setSetpoint(state[PidProcessController.SETPOINT])
+        # the setpoint of this cycle, which differs from SETPOINT while ramping
+        state[PidProcessController.ACTIVE_SETPOINT] = self.getSetpoint()
+        state[PidProcessController.PV] = self._pv
+        state[PidProcessController.ERROR] = error
+        state[PidProcessController.OUTPUT] = self._output
+        state[PidProcessController.CI] = self._Ci
+        state[PidProcessController.TIMESTAMP] = time.time()
+        state[PidProcessController.SETTLED] = float(self.isSettled())
+        state[PidProcessController.SETTLED_SEQ] = self._setpointSeq
+        self._cycle += 1
+        if self._cycle % self._pidLoopLen == 0:
+            state[PidProcessController.FREQUENCY] = self.getPidLoopFrequency()
+        state[PidProcessController.CYCLES] = self._cycle
+
+    def release(self):
+        self._state.release()
+        self._shm.close()
+
+
+def _pidProcessMain(shmName, conn, connectParameters, controllerParameters):
+    '''entry point of the PID control process'''
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        u3 = connectU3(**connectParameters)
+        ctrl = _SharedMemoryPidController(u3, shm, **controllerParameters)
+    except Exception as e:
+        shm.close()
+        conn.send(('error', e))
+        return
+    ctrl.start()
+    conn.send(('ok', None))
+    try:
+        while ctrl.is_alive():
+            if not conn.poll(0.1):
+                continue
+            (method, args, kwargs) = conn.recv()
+            if method == 'terminate':
+                ctrl.terminate()
+                ctrl.join()
+                conn.send(('ok', None))
+                break
+            try:
+                result = getattr(ctrl, method)(*args, **kwargs)
+                conn.send(('ok', result))
+            except Exception as e:
+                conn.send(('error', e))
+    finally:
+        ctrl.terminate()
+        ctrl.join()
+        ctrl.release()
+        u3.disconnect()
+
+
+class PidProcessController():
+    '''PID controller running in a dedicated process, so the control loop is
+    not stalled by the GIL while images are analysed or stored.
+
+    The child process owns the LabJack. Setpoint and telemetry (pv, error,
+    output, settled state) are exchanged through shared memory; other calls
+    (laserPulse, setPid, calibrateFeedForward, autoTune, ...) are forwarded 
+    through a pipe. The API is the same as that of PidController except that
+    getPv and getError return the values of the latest PID cycle.
+
+    ctrl = PidProcessController({'numReadings': 4}, pid=(3, 600, 0.001), 
+                                setpoint=0.05, pausetime=0.005)
+    ctrl.start()
+
+    Note that with the spawn start method (Windows) the child process imports
+    the __main__ module again, so hardware connections in a top level script
+    must be guarded by if __name__ == '__main__' or the controller must be
+    started from an interactive session.
+    '''
+    # layout of the shared memory block (doubles)
+    SETPOINT = 0
+    SETPOINT_SEQ = 1
+    PV = 2
+    ERROR = 3
+    OUTPUT = 4
+    CI = 5
+    SETTLED = 6
+    SETTLED_SEQ = 7
+    FREQUENCY = 8
+    TIMESTAMP = 9
+    CYCLES = 10
+    RAMP_START = 11
+    RAMP_DURATION = 12
+    ACTIVE_SETPOINT = 13
+    SIZE = 14
+
+    def __init__(self, connectParameters=None, **parameters):
+        '''connectParameters are passed to connectU3 in the child process,
+        parameters to the PidController constructor'''
+        if connectParameters is None:
+            connectParameters = dict()
+        self._connectParameters = connectParameters
+        self._parameters = parameters
+        self._shm = shared_memory.SharedMemory(create=True, size=8*self.SIZE)
+        self._state = self._shm.buf.cast('d')
+        for ii in range(self.SIZE):
+            self._state[ii] = 0.0
+        self._state[self.SETPOINT] = parameters.get('setpoint', 0.0)
+        self._state[self.ACTIVE_SETPOINT] = self._state[self.SETPOINT]
+        self._state[self.PV] = float('nan')
+        self._pidLock = Lock()
+        self._connLock = Lock()
+        (self._conn, childConn) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_pidProcessMain, 
+                            args=(self._shm.name, childConn, connectParameters, parameters),
+                            daemon=True)
+        self._closed = False
+
+    def __del__(self):
+        try:
+            self.terminate()
+        except Exception:
+            pass
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        rtxt = "piezo control PID loop (separate process):\n"
+        if self.is_alive():
+            rtxt = rtxt + "\tstatus: running\n"
+            pid = self.getPid()
+            rtxt = rtxt + ("PID parameters:\tKp:%.3f Ki:%.3f Kd:%.3f\n" % (pid[0], pid[1], pid[2]))
+            rtxt = rtxt + "setpoint: %.3f\n" % self.getSetpoint()
+            rtxt = rtxt + "pv:       %.3f\n" % self.getPv()
+            rtxt = rtxt + "error:    %.3f\n" % self.getError()
+            rtxt = rtxt + "output:   %.3f\n" % self.getOutput()
+            rtxt = rtxt + "Ci:       %.3f\n" % self.getCi()
+        else:
+            rtxt = rtxt + "\tstatus: not running\n"
+        return rtxt
+
+    def start(self):
+        self._process.start()
+        (status, result) = self._conn.recv()
+        if status != 'ok':
+            self._process.join()
+            self._release()
+            raise result
+        log.info('started PID control process (pid %d)' % self._process.pid)
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def join(self, timeout=None):
+        self._process.join(timeout)
+
+    def _call(self, method, *args, **kwargs):
+        if not self._process.is_alive():
+            raise labjack.LabJackError('PID control process is not running')
+        with self._connLock:
+            self._conn.send((method, args, kwargs))
+            (status, result) = self._conn.recv()
+        if status != 'ok':
+            raise result
+        return result
+
+    def _release(self):
+        if not self._closed:
+            self._closed = True
+            self._state.release()
+            self._shm.close()
+            self._shm.unlink()
+
+    def terminate(self):
+        if self._closed:
+            return
+        log.info('stopping PID control process')
+        try:
+            if self._process.is_alive():
+                self._call('terminate')
+                self._process.join(5)
+        finally:
+            if self._process.is_alive():
+                self._process.terminate()
+            self._release()
+
+    def getSetpoint(self):
+        state = self._state
+        if state[self.SETTLED_SEQ] != state[self.SETPOINT_SEQ]:
+            # not taken over by the PID process yet
+            if state[self.RAMP_DURATION] > 0:
+                return state[self.RAMP_START]
+            return state[self.SETPOINT]
+        return state[self.ACTIVE_SETPOINT]
+
+    def setSetpoint(self, setpoint):
+        with self._pidLock:
+            self._state[self.RAMP_DURATION] = 0.0
+            self._state[self.SETPOINT] = setpoint
+            self._state[self.SETPOINT_SEQ] += 1
+
+    def getPv(self):
+        return self._state[self.PV]
+
+    def getError(self):
+        return self.getSetpoint() - self._state[self.PV]
+
+    def getOutput(self):
+        return self._state[self.OUTPUT]
+
+    def getCi(self):
+        return self._state[self.CI]
+
+    def getPidLoopFrequency(self):
+        return self._state[self.FREQUENCY]
+
+    def getTelemetry(self):
+        '''returns dict with the state of the most recent PID cycle'''
+        state = self._state
+        return {'timestamp': state[self.TIMESTAMP], 'setpoint': self.getSetpoint(),
+                'pv': state[self.PV], 'error': state[self.ERROR], 
+                'output': state[self.OUTPUT], 'cycles': int(state[self.CYCLES])}
+
+    def isSettled(self):
+        state = self._state
+        return state[self.SETTLED_SEQ] == state[self.SETPOINT_SEQ] and state[self.SETTLED] > 0
+
+    def waitForSettled(self, timeout=None):
+        start = time.time()
+        while not self.isSettled():
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def getPvStats(self):
+        return self._call('getPvStats')
+
+    def rampSetpoint(self, start, stop, duration):
+        # passed like a setpoint change, so isSettled() is False until the
+        # PID process has started the ramp and the settled state is never
+        # that of the previous setpoint
+        with self._pidLock:
+            self._state[self.RAMP_START] = start
+            self._state[self.RAMP_DURATION] = max(float(duration), 1E-9)
+            self._state[self.SETPOINT] = stop
+            self._state[self.SETPOINT_SEQ] += 1
+
+    def getHistory(self, since=None):
+        return self._call('getHistory', since)
+
+    def getPid(self):
+        return self._call('getPid')
+
+    def setPid(self, pid):
+        return self._call('setPid', tuple(pid))
+
+    def getFeedForward(self):
+        return self._call('getFeedForward')
+
+    def setFeedForward(self, feedForward):
+        return self._call('setFeedForward', feedForward)
+
+    def calibrateFeedForward(self, *args, **kwargs):
+        return self._call('calibrateFeedForward', *args, **kwargs)
+
+    def autoTune(self, *args, **kwargs):
+        return self._call('autoTune', *args, **kwargs)
+
+    def laserPulse(self, length):
+        return self._call('laserPulse', length)
+
+    def laserGetOutputValue(self):
+        return self._call('laserGetOutputValue')
+
+    def printStatus(self):
+        print(self.__repr__())
+
+
 if __name__ == '__main__':
     import labjack
     try:
@@ -7,7 +7,10 @@ connected will be interfaced.'''
 import pyvisa
 import sys
 import time
+import math
 import logging
+from collections import deque
+from threading import Thread, Lock, Condition, Event
 
 
 class PowermeterError(Exception):
@@ -24,6 +27,9 @@ class Pm100usb():
         self.pm100usb_ini = pm100usb_ini
         self.isConnected = False
         self.isConfigured = False
+        self.sampler = None
+        # serialises device access between the sampler thread and direct calls
+        self._lock = Lock()
         if resourceName:
             self.resourceString = resourceName
         self.rm = pyvisa.ResourceManager()
@@ -45,10 +51,15 @@ class Pm100usb():
             log.error(msg)
             raise PowermeterError(msg)
         self.pm100usb_dev = self.rm.open_resource(device)
+        if device.upper().endswith('::SOCKET'):
+            # raw socket connection, e.g. to the simulated power meter of scpi_sim
+            self.pm100usb_dev.read_termination = '\n'
+            self.pm100usb_dev.write_termination = '\n'
         self.isConnected = True
         log.debug('connected PM100USB')
 
     def close(self):
+        self.stopSampling()
         if self.isConnected:
             self.pm100usb_dev.close()
             self.isConnected = False
@@ -58,6 +69,9 @@ class Pm100usb():
             log.debug('attempt to close already disconnected PM100USB')
 
     def _findPowermeter(self):
+        if self.resourceString.upper().endswith('::SOCKET'):
+            # socket resources are not listed by the resource manager
+            return self.resourceString
         devices = self.rm.list_resources(self.resourceString)
         if devices:
             for line in str(devices).splitlines():
@@ -72,7 +86,7 @@ class Pm100usb():
 
     def _getPmInfo(self):
         # first get power meter info
-        idn = self.pm100usb_dev.ask('*IDN?')
+        idn = self.pm100usb_dev.query('*IDN?')
         [t, modelCode, serialnr, firmwareVersion] = idn.strip().split(',')
         self.pm100usb_data = dict()
         self.pm100usb_data['modelCode'] = modelCode
@@ -83,14 +97,14 @@ class Pm100usb():
             log.info('\t%s:  %s' % (k,  str(v)))
         # next get power meter sensor info
         self.sensor_data = dict()
-        info = self.pm100usb_dev.ask('SYST:SENS:IDN?')
+        info = self.pm100usb_dev.query('SYST:SENS:IDN?')
         [sensModel, serialNr, calDate, sensorType, subtype, flags] = info.strip().split(',')
         self.sensor_data['model'] = sensModel
         self.sensor_data['serialNr'] = serialNr
         self.sensor_data['calDate'] = calDate
         self.sensor_data['type'] = sensorType
         self.sensor_data['subtype'] = subtype
-        self.sensor_data['responseValue'] = float(self.pm100usb_dev.ask('SENS:CORR:POW:THER:RESP?')) # in V/W
+        self.sensor_data['responseValue'] = float(self.pm100usb_dev.query('SENS:CORR:POW:THER:RESP?')) # in V/W
         log.info('PM100USB sensor head data:')
         for (k,  v) in self.sensor_data.items():
             log.info('\t%s:  %s' % (k,  str(v)))
@@ -111,8 +125,10 @@ class Pm100usb():
         log.info('powermeter configured for use')
 
     def readPower(self):
+        '''blocking power measurement of about 3 ms per averaged sample'''
         if self.isConfigured:
-            power = self.pm100usb_dev.ask('READ?')
+            with self._lock:
+                power = self.pm100usb_dev.query('READ?')
             log.debug('measured power: %s' % power.strip())
             return float(power)
         else:
@@ -121,9 +137,134 @@ class Pm100usb():
             raise PowermeterError(msg)
     
     def getTemperature(self):
-        self.pm100usb_dev.write('CONF:TEMP')
-        time.sleep(0.1)
-        answer = self.pm100usb_dev.ask('READ?')
-        temperature = float(answer.strip())
-        self.pm100usb_dev.write('CONF:POW')  #leave prepared for power measurement
+        # holding the lock keeps the sampler from reading during the temperature measurement
+        with self._lock:
+            self.pm100usb_dev.write('CONF:TEMP')
+            time.sleep(0.1)
+            answer = self.pm100usb_dev.query('READ?')
+            temperature = float(answer.strip())
+            self.pm100usb_dev.write('CONF:POW')  #leave prepared for power measurement
         return temperature
+
+    def startSampling(self, bufferSize=None):
+        '''starts continuous power sampling in a background thread
+
+        bufferSize  number of readings kept in the ring buffer, by default
+                    taken from the powermeter section of fdms.ini
+        '''
+        if self.sampler is not None and self.sampler.is_alive():
+            log.debug('power sampler already running')
+            return self.sampler
+        if bufferSize is None:
+            bufferSize = self.pm100usb_ini.get('bufferSize', 1000)
+        self.sampler = PowerSampler(self, bufferSize)
+        self.sampler.start()
+        log.info('started background power sampling')
+        return self.sampler
+
+    def stopSampling(self):
+        if self.sampler is not None:
+            self.sampler.terminate()
+            self.sampler = None
+            log.info('stopped background power sampling')
+
+    def latestPower(self, maxAge=0.5, timeout=1.0):
+        '''returns the most recent power reading in W that is not older than
+        maxAge seconds. Waits at most timeout seconds for a fresh reading of
+        the background sampler. Without a running sampler a blocking
+        measurement is done.'''
+        if self.sampler is None or not self.sampler.is_alive():
+            return self.readPower()
+        return self.sampler.latestPower(maxAge, timeout)[1]
+
+
+class PowerSampler(Thread):
+    def __init__(self, powermeter, bufferSize=1000):
+        '''continuously reads the powermeter and keeps a ring buffer of
+        (timestamp, power) tuples. The timestamp is the middle of the READ?
+        transaction, which approximates the centre of the averaging window.
+
+        powermeter  Pm100usb instance
+        bufferSize  maximum number of readings kept
+        '''
+        Thread.__init__(self, daemon=True)
+        self.powermeter = powermeter
+        self._buffer = deque(maxlen=bufferSize)
+        self._newReading = Condition()
+        self._terminate = Event()
+        self.readDuration = 0.0
+        self.errors = 0
+
+    def run(self):
+        while not self._terminate.is_set():
+            t0 = time.time()
+            try:
+                power = self.powermeter.readPower()
+            except Exception as err:
+                self.errors += 1
+                log.warning('power sampler read failed: %s' % err)
+                self._terminate.wait(0.1)
+                continue
+            t1 = time.time()
+            with self._newReading:
+                self.readDuration = t1 - t0
+                self._buffer.append(((t0 + t1) / 2.0, power))
+                self._newReading.notify_all()
+
+    def terminate(self):
+        self._terminate.set()
+        if self.is_alive():
+            self.join(5.0)
+
+    def latestPower(self, maxAge=0.5, timeout=1.0):
+        '''returns (timestamp, power) of the most recent reading not older
+        than maxAge seconds, waits at most timeout seconds for one'''
+        deadline = time.time() + timeout
+        with self._newReading:
+            while True:
+                if self._buffer and time.time() - self._buffer[-1][0] <= maxAge:
+                    return self._buffer[-1]
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.is_alive():
+                    break
+                self._newReading.wait(remaining)
+        msg = 'no power reading younger than %.3fs available' % maxAge
+        log.error(msg)
+        raise PowermeterError(msg)
+
+    def getHistory(self, window=None):
+        '''returns lists (timestamps, powers) of the readings of the last
+        window seconds, or of the whole buffer when window is None'''
+        with self._newReading:
+            readings = list(self._buffer)
+        if window is not None:
+            tmin = time.time() - window
+            readings = [r for r in readings if r[0] >= tmin]
+        return ([r[0] for r in readings], [r[1] for r in readings])
+
+    def getStats(self, window=10.0):
+        '''rolling statistics of the readings of the last window seconds
+
+        returns dict with mean, std, min and max in W, drift in W/s (least
+        squares slope), number of readings n and the age in s of the latest
+        reading'''
+        (times, powers) = self.getHistory(window)
+        n = len(powers)
+        if n == 0:
+            raise PowermeterError('no power readings in the last %.1fs' % window)
+        mean = sum(powers) / n
+        std = math.sqrt(sum((p - mean)**2 for p in powers) / n)
+        drift = 0.0
+        if n > 1:
+            tmean = sum(times) / n
+            stt = sum((t - tmean)**2 for t in times)
+            if stt > 0:
+                drift = sum((t - tmean)*(p - mean) for (t, p) in zip(times, powers)) / stt
+        return {'mean': mean, 'std': std, 'min': min(powers), 'max': max(powers),
+                'drift': drift, 'n': n, 'age': time.time() - times[-1]}
+
+    def printStats(self, window=10.0):
+        stats = self.getStats(window)
+        print('power over last %.1fs (%d readings): %.3f +/- %.3f W, min %.3f W, max %.3f W, drift %.2E W/s' %
+              (window, stats['n'], stats['mean'], stats['std'], stats['min'], stats['max'], stats['drift']))
+        print('reading duration: %.1f ms, latest reading %.1f ms old' % (self.readDuration*1e3, stats['age']*1e3))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Short horizon prediction of the CO2 laser power for the intensity correction
+of dimple shots.
+
+The power readings of the background sampler of pm100usb are filtered with a
+local linear trend Kalman filter (state: power level and drift rate). Just
+before a shot the power is extrapolated to the expected trigger time. Once
+the sampler has a reading after the trigger, the power at trigger time is
+interpolated from the readings and written to a csv file together with the
+prediction and the last reading that the old correction would have used, so
+the dose error of both methods can be compared over many shots.
+
+usage:
+    predictor = power_predictor.PowerPredictor(powermeter.sampler, logFile='power_prediction.csv')
+    (power, std) = predictor.predictTrigger()
+    ... shoot ...
+    predictor.registerShot(awg.triggerTime)
+
+@author: eschenm
+'''
+
+import os
+import math
+import time
+import logging
+
+log = logging.getLogger('power_predictor')
+
+
+class PowerPredictorError(Exception):
+    pass
+
+
+class PowerPredictor():
+    LOG_HEADER = 'shot,trigger_time,lead_time,predicted,predicted_std,last_reading,last_reading_age,measured,prediction_error,last_reading_error\n'
+
+    def __init__(self, sampler, processNoise=0.03, measurementNoise=0.03, leadTime=0.01, logFile=None, maxAge=0.5):
+        '''sampler             pm100usb.PowerSampler providing the readings
+        processNoise        spectral density of the drift acceleration in W^2/s^3
+        measurementNoise    standard deviation of a single reading in W
+        leadTime            initial estimate in s of the time between the
+                            prediction and the trigger, updated after every shot
+        logFile             csv file for predicted vs. measured power, None
+                            disables logging
+        maxAge              maximum age in s of the last reading, and maximum
+                            time over which the power is extrapolated, like
+                            max_power_age without prediction
+        '''
+        self.sampler = sampler
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.leadTime = leadTime
+        self.logFile = logFile
+        self.maxAge = maxAge
+        self.shots = 0
+        self.results = []
+        self._pending = []
+        self._prediction = None
+        self.reset()
+        if logFile is not None and not os.path.exists(logFile):
+            with open(logFile, 'w') as f:
+                f.write(self.LOG_HEADER)
+
+    def reset(self):
+        '''discards the filter state, the next update starts from scratch'''
+        self._t = None
+        self._x = [0.0, 0.0]                    # power in W, drift in W/s
+        self._P = [[0.0, 0.0], [0.0, 0.0]]
+
+    def _propagate(self, x, P, dt):
+        q = self.processNoise
+        x = [x[0] + dt*x[1], x[1]]
+        P = [[P[0][0] + dt*(P[0][1] + P[1][0]) + dt*dt*P[1][1] + q*dt**3/3,
+              P[0][1] + dt*P[1][1] + q*dt**2/2],
+             [P[1][0] + dt*P[1][1] + q*dt**2/2,
+              P[1][1] + q*dt]]
+        return (x, P)
+
+    def _filter(self, t, power):
+        r = self.measurementNoise**2
+        if self._t is None:
+            self._x = [power, 0.0]
+            # unknown drift, allow 1 W/s
+            self._P = [[r, 0.0], [0.0, 1.0]]
+            self._t = t
+            return
+        (x, P) = self._propagate(self._x, self._P, t - self._t)
+        s = P[0][0] + r
+        k = [P[0][0] / s, P[1][0] / s]
+        innovation = power - x[0]
+        self._x = [x[0] + k[0]*innovation, x[1] + k[1]*innovation]
+        self._P = [[(1 - k[0])*P[0][0], (1 - k[0])*P[0][1]],
+                   [P[1][0] - k[1]*P[0][0], P[1][1] - k[1]*P[0][1]]]
+        self._t = t
+
+    def update(self):
+        '''feeds the readings of the sampler that are newer than the filter
+        state and resolves shots whose trigger time is covered by readings'''
+        (times, powers) = self.sampler.getHistory()
+        for (t, power) in zip(times, powers):
+            if self._t is None or t > self._t:
+                self._filter(t, power)
+        if self._pending:
+            self._resolve(times, powers)
+
+    def predict(self, tm=None):
+        '''returns (power, std) in W of the power reading expected at time tm.
+        Raises PowerPredictorError when the last reading is older than maxAge
+        or tm is more than maxAge after the last reading, so a stalled
+        sampler never leads to an unlimited extrapolation.'''
+        self.update()
+        if self._t is None:
+            msg = 'no power readings available for prediction'
+            log.error(msg)
+            raise PowerPredictorError(msg)
+        now = time.time()
+        if tm is None:
+            tm = now
+        if now - self._t > self.maxAge:
+            msg = 'last power reading is %.3f s old, more than %.3f s' % (now - self._t, self.maxAge)
+            log.error(msg)
+            raise PowerPredictorError(msg)
+        if tm - self._t > self.maxAge:
+            msg = 'power prediction %.3f s after the last reading, more than %.3f s' % (tm - self._t, self.maxAge)
+            log.error(msg)
+            raise PowerPredictorError(msg)
+        (x, P) = self._propagate(self._x, self._P, max(tm - self._t, 0.0))
+        return (x[0], math.sqrt(P[0][0]))
+
+    def getDrift(self):
+        '''returns the estimated power drift in W/s'''
+        return self._x[1]
+
+    def predictTrigger(self):
+        '''predicts the power at the expected trigger time, now + leadTime.
+        The prediction is stored for the next registerShot() call.'''
+        now = time.time()
+        (power, std) = self.predict(now + self.leadTime)
+        (times, powers) = self.sampler.getHistory()
+        self._prediction = {'time': now, 'predicted': power, 'std': std,
+                            'lastReading': powers[-1], 'lastReadingTime': times[-1]}
+        log.debug('predicted power %.3f +/- %.3f W in %.1f ms' % (power, std, self.leadTime*1e3))
+        return (power, std)
+
+    def registerShot(self, triggerTime):
+        '''registers the trigger time of the shot belonging to the last
+        prediction. The measured power is filled in once the sampler has a
+        reading after the trigger.'''
+        if self._prediction is None:
+            log.warning('shot registered without power prediction')
+            return
+        shot = self._prediction
+        self._prediction = None
+        self.shots += 1
+        shot['shot'] = self.shots
+        shot['triggerTime'] = triggerTime
+        shot['leadTime'] = triggerTime - shot['time']
+        # running estimate of the time from prediction to trigger
+        self.leadTime += 0.2 * (shot['leadTime'] - self.leadTime)
+        self._pending.append(shot)
+
+    def _resolve(self, times, powers):
+        remaining = []
+        for shot in self._pending:
+            tt = shot['triggerTime']
+            if not times or times[-1] < tt:
+                remaining.append(shot)
+                continue
+            ii = next(ii for (ii, t) in enumerate(times) if t >= tt)
+            if ii == 0:
+                measured = powers[0]
+            else:
+                f = (tt - times[ii-1]) / (times[ii] - times[ii-1])
+                measured = powers[ii-1] + f * (powers[ii] - powers[ii-1])
+            shot['measured'] = measured
+            shot['predictionError'] = shot['predicted'] - measured
+            shot['lastReadingError'] = shot['lastReading'] - measured
+            self.results.append(shot)
+            self._writeLog(shot)
+        self._pending = remaining
+
+    def _writeLog(self, shot):
+        if self.logFile is None:
+            return
+        txt = '%d,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f\n'
+        vals = (shot['shot'], shot['triggerTime'], shot['leadTime'], shot['predicted'], shot['std'],
+                shot['lastReading'], shot['triggerTime'] - shot['lastReadingTime'], shot['measured'],
+                shot['predictionError'], shot['lastReadingError'])
+        try:
+            with open(self.logFile, 'a') as f:
+                f.write(txt % vals)
+        except Exception as error:
+            log.error('error during writing to file %s: %s' % (self.logFile, error))
+
+    def flush(self, timeout=1.0):
+        '''waits at most timeout seconds until all registered shots are resolved'''
+        deadline = time.time() + timeout
+        while self._pending and time.time() < deadline:
+            time.sleep(0.01)
+            self.update()
+        if self._pending:
+            log.warning('%d shots without power reading after trigger' % len(self._pending))
+
+    def getErrorStats(self):
+        '''returns dict with the number of resolved shots n and the rms error
+        in W of the prediction and of the last reading'''
+        n = len(self.results)
+        if n == 0:
+            raise PowerPredictorError('no resolved shots')
+        rms = lambda key: math.sqrt(sum(r[key]**2 for r in self.results) / n)
+        return {'n': n, 'predictionRms': rms('predictionError'),
+                'lastReadingRms': rms('lastReadingError')}
+
+    def printErrorStats(self):
+        stats = self.getErrorStats()
+        print('power at trigger time over %d shots:' % stats['n'])
+        print('\trms error of prediction:   %.4f W' % stats['predictionRms'])
+        print('\trms error of last reading: %.4f W' % stats['lastReadingRms'])
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Socket based SCPI stand-ins for the Siglent SDG2000X AWG and the Thorlabs
+PM100USB power meter, for testing and benchmarking the dimple shooting
+sequence without hardware.
+
+Each simulated instrument is served on a local TCP port and implements the
+subset of commands used by sdg2000x.py and pm100usb.py with a realistic
+latency per command. The power meter reads a drifting CO2 laser power through
+a first order thermopile response. Both instrument classes connect through
+their resourceName argument:
+
+    (awgServer, pmServer) = scpi_sim.startSimulators()
+    awg = sdg2000x.Sdg2000x(awg_ini, resourceName=awgServer.resourceName)
+    powermeter = pm100usb.Pm100usb(powermeter_ini, resourceName=pmServer.resourceName)
+
+@author: eschenm
+'''
+
+import re
+import math
+import time
+import random
+import socket
+import logging
+from threading import Thread
+from threading import Lock
+
+log = logging.getLogger('scpi_sim')
+
+
+class ScpiSimError(Exception):
+    pass
+
+
+class LaserSim():
+    def __init__(self, power=25.0, drift=0.02, driftPeriod=300.0, noise=0.002):
+        '''CO2 laser output power in W, drifting sinusoidally by a relative
+        amplitude drift with period driftPeriod in s plus relative noise'''
+        self.power = power
+        self.drift = drift
+        self.driftPeriod = driftPeriod
+        self.noise = noise
+        self.shots = []
+        self._start = time.time()
+
+    def getPower(self, tm=None):
+        if tm is None:
+            tm = time.time()
+        phase = 2 * math.pi * (tm - self._start) / self.driftPeriod
+        return self.power * (1 + self.drift * math.sin(phase) + random.gauss(0.0, self.noise))
+
+    def fire(self, tm, duration, width, cycles, intensity):
+        # record shot, power during the shot is proportional to intensity
+        self.shots.append({'time': tm, 'duration': duration, 'width': width,
+                           'cycles': cycles, 'intensity': intensity,
+                           'power': self.getPower(tm)})
+        log.info('simulated laser fired: %d pulses of %.3E s at %.3f V' % (cycles, width, intensity))
+
+
+class ScpiInstrument():
+    '''base class of the simulated instruments'''
+    # latency in s of a command without specific latency
+    latency = 0.0005
+    idn = ''
+
+    def __init__(self):
+        self.esr = 0
+
+    def commandLatency(self, header):
+        return self.latency
+
+    def handle(self, command):
+        '''handles a single command, returns the answer or None'''
+        (header, args) = (command.strip() + ' ').split(' ', 1)
+        header = header.upper()
+        args = [arg.strip() for arg in args.split(',')] if args.strip() else []
+        time.sleep(self.commandLatency(header))
+        if header == '*IDN?':
+            return self.idn
+        if header == '*OPC?':
+            return '1'
+        if header == '*OPC':
+            self.esr |= 1
+            return None
+        if header == '*ESR?':
+            (esr, self.esr) = (self.esr, 0)
+            return str(esr)
+        if header in ('*WAI', '*CLS'):
+            return None
+        answer = self.handleCommand(header, args)
+        if answer is NotImplemented:
+            # command error bit
+            self.esr |= 32
+            log.warning('%s: unsupported command %s' % (type(self).__name__, command))
+            return None
+        return answer
+
+    def handleCommand(self, header, args):
+        return NotImplemented
+
+
+class Sdg2000xSim(ScpiInstrument):
+    idn = 'Siglent Technologies,SDG2042X,SDG2XSIM000001,2.01.01.35R3'
+
+    def __init__(self, laser=None):
+        ScpiInstrument.__init__(self)
+        self.laser = laser
+        self.reset()
+
+    def reset(self):
+        self.channels = dict()
+        for ch in (1, 2):
+            self.channels[ch] = {
+                'BSWV': {'WVTP': 'SINE', 'FRQ': '1000HZ', 'AMP': '4V', 'OFST': '0V',
+                         'HLEV': '2V', 'LLEV': '-2V', 'PERI': '0.001S', 'WIDTH': '0.0005',
+                         'DLY': '0', 'RISE': '8.4E-9S', 'FALL': '8.4E-9S'},
+                'BTWV': {'STATE': 'OFF', 'TRSR': 'INT', 'GATE_NCYC': 'NCYC', 'TIME': '1'},
+                'OUTP': {'STATE': 'OFF', 'LOAD': 'HZ', 'PLRT': 'NOR'}}
+        self.buzzer = 'ON'
+
+    def commandLatency(self, header):
+        if header == '*RST':
+            return 0.15
+        if header.endswith(':BSWV') or header.endswith(':BTWV'):
+            return 0.003
+        return self.latency
+
+    def handleCommand(self, header, args):
+        if header == '*RST':
+            self.reset()
+            return None
+        if header == 'BUZZ':
+            self.buzzer = args[0].upper() if args else self.buzzer
+            return None
+        match = re.match(r'^C([12]):(BSWV|BTWV|OUTP)(\?)?$', header)
+        if match is None:
+            return NotImplemented
+        channel = self.channels[int(match.group(1))]
+        group = match.group(2)
+        if match.group(3):
+            return self._queryGroup(match.group(1), group, channel[group])
+        if group == 'OUTP' and args and args[0].upper() in ('ON', 'OFF'):
+            channel['OUTP']['STATE'] = args.pop(0).upper()
+        if group == 'BTWV' and args and args[0].upper() == 'MTRIG':
+            args.pop(0)
+            self._trigger(int(match.group(1)))
+        if len(args) % 2:
+            return NotImplemented
+        for ii in range(0, len(args), 2):
+            channel[group][args[ii].upper()] = args[ii+1].upper()
+        return None
+
+    def _queryGroup(self, ch, group, values):
+        items = dict(values)
+        if group == 'OUTP':
+            state = items.pop('STATE')
+            return 'C%s:OUTP %s,%s' % (ch, state, ','.join(['%s,%s' % kv for kv in items.items()]))
+        return 'C%s:%s %s' % (ch, group, ','.join(['%s,%s' % kv for kv in items.items()]))
+
+    def _trigger(self, channel):
+        settings = self.channels[channel]
+        if settings['OUTP']['STATE'] != 'ON' or settings['BTWV']['STATE'] != 'ON':
+            log.warning('simulated AWG triggered with output or burst mode off')
+            return
+        period = _toFloat(settings['BSWV']['PERI'])
+        width = _toFloat(settings['BSWV']['WIDTH'])
+        cycles = int(_toFloat(settings['BTWV']['TIME']))
+        intensity = 0.0
+        if self.channels[2]['OUTP']['STATE'] == 'ON':
+            intensity = _toFloat(self.channels[2]['BSWV']['OFST'])
+        if self.laser is not None:
+            self.laser.fire(time.time(), cycles*period, width, cycles, intensity)
+
+
+class Pm100usbSim(ScpiInstrument):
+    idn = 'Thorlabs,PM100USB,P2000001,1.6.0'
+    sensorIdn = 'S401C,16020101,01-Jan-2017,2,18,289'
+
+    def __init__(self, laser=None, timeConstant=0.3, temperature=23.5):
+        '''laser is a LaserSim, timeConstant is the thermopile time constant in s'''
+        ScpiInstrument.__init__(self)
+        if laser is None:
+            laser = LaserSim()
+        self.laser = laser
+        self.timeConstant = timeConstant
+        self.temperature = temperature
+        self.averages = 1
+        self.mode = 'POW'
+        self.settings = dict()
+        self._reading = laser.getPower()
+        self._readTime = time.time()
+
+    def commandLatency(self, header):
+        if header == 'READ?':
+            # about 3 ms per averaged sample
+            return 0.003 * self.averages
+        return self.latency
+
+    def _thermopile(self):
+        tm = time.time()
+        alpha = 1 - math.exp(-(tm - self._readTime) / self.timeConstant)
+        self._reading += alpha * (self.laser.getPower(tm) - self._reading)
+        self._readTime = tm
+        return self._reading
+
+    def handleCommand(self, header, args):
+        if header == 'SYST:SENS:IDN?':
+            return self.sensorIdn
+        if header == 'SENS:CORR:POW:THER:RESP?':
+            return '1.000000E-04'
+        if header == 'SENS:AVER:COUNT':
+            self.averages = int(args[0])
+            return None
+        if header == 'CONF:POW':
+            self.mode = 'POW'
+            return None
+        if header == 'CONF:TEMP':
+            self.mode = 'TEMP'
+            return None
+        if header == 'READ?':
+            if self.mode == 'TEMP':
+                return '%.6E' % (self.temperature + random.gauss(0.0, 0.02))
+            return '%.6E' % self._thermopile()
+        if header in ('SYST:LFR', 'INPUT:ADAPTER:TYPE', 'SENS:CORR:WAV', 'SENS:POW:RANG:AUTO',
+                      'SENS:POW:UNIT', 'SENS:POW:REF:STAT', 'INPUT:THER:ACCELERATOR'):
+            self.settings[header] = args
+            return None
+        return NotImplemented
+
+
+def _toFloat(value):
+    # strips units like 'S', 'V' or 'HZ' from a SCPI value
+    match = re.match(r'^[-+]?[0-9.]+(E[-+]?[0-9]+)?', value.strip().upper())
+    if match is None:
+        raise ScpiSimError('not a number: %s' % value)
+    return float(match.group(0))
+
+
+class ScpiServer(Thread):
+    def __init__(self, instrument, host='127.0.0.1', port=0):
+        '''serves a simulated instrument on a TCP socket, port=0 picks a free
+        port. Use the resourceName attribute to connect with pyvisa.'''
+        Thread.__init__(self, daemon=True)
+        self.instrument = instrument
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(1)
+        self._sock.settimeout(0.2)
+        (self.host, self.port) = self._sock.getsockname()
+        self.resourceName = 'TCPIP0::%s::%d::SOCKET' % (self.host, self.port)
+        self._lock = Lock()
+        self._continue = True
+
+    def stop(self):
+        self._continue = False
+        self.join()
+        self._sock.close()
+
+    def run(self):
+        log.info('serving %s on %s' % (type(self.instrument).__name__, self.resourceName))
+        while self._continue:
+            try:
+                (conn, address) = self._sock.accept()
+            except socket.timeout:
+                continue
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        conn.settimeout(0.2)
+        # answers are small, do not let Nagle delay them
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        with conn:
+            while self._continue:
+                try:
+                    data = conn.recv(4096)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                if not data:
+                    break
+                if hasattr(socket, 'TCP_QUICKACK'):
+                    # acknowledge immediately, otherwise a client using Nagle 
+                    # waits for the delayed ack before sending the next command
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                buf += data
+                while b'\n' in buf:
+                    (line, buf) = buf.split(b'\n', 1)
+                    answers = []
+                    with self._lock:
+                        for command in line.decode('ascii', errors='replace').split(';'):
+                            if command.strip():
+                                answer = self.instrument.handle(command)
+                                if answer is not None:
+                                    answers.append(answer)
+                    if answers:
+                        conn.sendall((';'.join(answers) + '\n').encode('ascii'))
+
+
+def startSimulators(laser=None):
+    '''starts simulated AWG and power meter sharing one simulated laser,
+    returns (awgServer, powermeterServer)'''
+    if laser is None:
+        laser = LaserSim()
+    awgServer = ScpiServer(Sdg2000xSim(laser))
+    pmServer = ScpiServer(Pm100usbSim(laser))
+    awgServer.start()
+    pmServer.start()
+    return (awgServer, pmServer)
+
+
+def benchmarkShooting(nrShots=5):
+    '''times preparing and shooting dimples on the simulated instruments'''
+    import sdg2000x
+    import pm100usb
+    import dimple_shooting
+    (awgServer, pmServer) = startSimulators()
+    awg_ini = {'load1': '4700', 'load2': 'HiZ'}
+    powermeter_ini = {'wavelength': 10600, 'averages': 50}
+    dimple_shooting_ini = {'period': 1E-5, 'width': 5E-6, 'nr_pulses': 1,
+                           'default_power': 25.0, 'default_height': 7.5,
+                           'max_power_age': 0.5}
+    awg = sdg2000x.Sdg2000x(awg_ini, resourceName=awgServer.resourceName)
+    powermeter = pm100usb.Pm100usb(powermeter_ini, resourceName=pmServer.resourceName)
+    shoot = dimple_shooting.DimpleShooting(powermeter_ini, awg_ini, dimple_shooting_ini, powermeter, awg)
+    times = []
+    try:
+        for ii in range(nrShots):
+            start = time.time()
+            shoot.prepareShot(width=5E-6 * (1 + ii % 2))
+            armed = time.time()
+            shoot.shoot()
+            times.append((armed - start, time.time() - armed))
+    finally:
+        awg.close()
+        powermeter.close()
+        awgServer.stop()
+        pmServer.stop()
+    for (ii, (tPrepare, tShoot)) in enumerate(times):
+        print('shot %d: prepare %.1f ms, shoot %.1f ms' % (ii, tPrepare*1e3, tShoot*1e3))
+    awg.printLatencyStats()
+    return times
+
+
+if __name__ == '__main__':
+    benchmarkShooting()
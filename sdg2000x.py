@@ -18,6 +18,8 @@ import sys
 import struct
 import time
 import logging
+from contextlib import contextmanager
+from collections import deque
 
 class AwgError(Exception):
     pass
@@ -32,6 +34,18 @@ class Sdg2000x():
         self.resourceString = 'USB?*::0xF4EC::0xEE38::?*::INSTR'
         self.isConnected = False
         self.isArmed = False
+        # time.time() at which the last burst was triggered
+        self.triggerTime = None
+        self._batch = None
+        self._batchParams = dict()
+        self._paramCache = dict()
+        self._outputState = dict()
+        self._latency = dict()
+        # max wait time in s for the AWG to complete pending operations
+        self.syncTimeout = 5.0
+        # wait in s after the burst duration before the burst is regarded as
+        # sent, *OPC does not track the burst output
+        self.burstMargin = float(awg_ini.get('burstMargin', 0.1))
         if resourceName:
             self.resourceString = resourceName
         self.rm = pyvisa.ResourceManager()
@@ -52,6 +66,10 @@ class Sdg2000x():
         if device == []:
             raise AwgError('AWG not found')
         self.awgDev = self.rm.open_resource(device)
+        if device.upper().endswith('::SOCKET'):
+            # raw socket connection, e.g. to the simulated AWG of scpi_sim
+            self.awgDev.read_termination = '\n'
+            self.awgDev.write_termination = '\n'
         self.isConnected = True
         log.info('AWG connected')
         self.awgDev.timeout = 5000
@@ -69,6 +87,9 @@ class Sdg2000x():
             log.debug('attempt to close already disconnected AWG')
 
     def findAwg(self):
+        if self.resourceString.upper().endswith('::SOCKET'):
+            # socket resources are not listed by the resource manager
+            return self.resourceString
         devices = self.rm.list_resources(self.resourceString)
         log.debug('found awg\'s: %s' % str(devices))
         if devices:
@@ -77,9 +98,181 @@ class Sdg2000x():
             else:
                 return devices[0]
 
+    def write(self, command):
+        '''writes a command to the AWG, or queues it when a batch is open'''
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            self._timedWrite(command)
+
+    def query(self, command):
+        '''sends a query and returns the answer, not possible within a batch'''
+        if self._batch is not None:
+            raise AwgError('cannot query %s within a command batch' % command)
+        start = time.time()
+        answer = self.awgDev.query(command)
+        self._addLatency(command, time.time() - start)
+        return answer
+
+    def _timedWrite(self, command):
+        start = time.time()
+        self.awgDev.write(command)
+        self._addLatency(command, time.time() - start)
+
+    def _addLatency(self, command, latency):
+        # latencies are stored per command header, e.g. C1:BSWV or *OPC?
+        key = command.split(';')[0].split(' ')[0]
+        if ';' in command:
+            key = 'batch'
+        if key not in self._latency:
+            self._latency[key] = deque(maxlen=100)
+        self._latency[key].append(latency)
+
+    def getLatencyStats(self):
+        '''returns dict {command header: (nr of calls, mean, max latency in s)} 
+        of the last 100 calls of each command'''
+        stats = dict()
+        for (key, values) in self._latency.items():
+            stats[key] = (len(values), sum(values)/len(values), max(values))
+        return stats
+
+    def printLatencyStats(self):
+        print('%-12s %6s %10s %10s' % ('command', 'calls', 'mean (ms)', 'max (ms)'))
+        for (key, (n, mean, mx)) in sorted(self.getLatencyStats().items()):
+            print('%-12s %6d %10.2f %10.2f' % (key, n, mean*1e3, mx*1e3))
+
+    def waitOperationComplete(self, timeout=None):
+        '''blocks on *OPC? until the AWG has completed all pending commands,
+        raises AwgError on timeout. Returns the wait time in s.'''
+        if timeout is None:
+            timeout = self.syncTimeout
+        start = time.time()
+        oldTimeout = self.awgDev.timeout
+        self.awgDev.timeout = int(timeout * 1000)
+        try:
+            self.query('*OPC?')
+        except pyvisa.VisaIOError as e:
+            msg = 'AWG did not complete operation within %.2f s: %s' % (timeout, e)
+            log.error(msg)
+            raise AwgError(msg)
+        finally:
+            self.awgDev.timeout = oldTimeout
+        return time.time() - start
+
+    def pollOperationComplete(self, timeout=None, interval=0.002):
+        '''sends *OPC and polls the operation complete bit of the standard 
+        event status register, so the VISA session is not blocked while 
+        waiting. Raises AwgError on timeout, returns the wait time in s.'''
+        if timeout is None:
+            timeout = self.syncTimeout
+        start = time.time()
+        self.query('*ESR?')         # clear event status register
+        self.write('*OPC')
+        while True:
+            esr = int(self.query('*ESR?').strip())
+            if esr & 1:
+                return time.time() - start
+            if time.time() - start > timeout:
+                msg = 'AWG did not set operation complete within %.2f s' % timeout
+                log.error(msg)
+                raise AwgError(msg)
+            time.sleep(interval)
+
+    def waitForBurst(self, triggerTime, timeout=None):
+        '''waits until the burst started at triggerTime has been sent: the 
+        remainder of the burst duration plus burstMargin, followed by
+        operation complete polling'''
+        remaining = self.duration + self.burstMargin - (time.time() - triggerTime)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.pollOperationComplete(timeout)
+        log.debug('burst completed %.1f ms after trigger' % ((time.time() - triggerTime)*1e3))
+
+    def setParameter(self, header, name, value):
+        '''setParameter('C1:BSWV', 'HLEV', '4.5V')
+        
+        writes a single parameter of a BSWV/BTWV/OUTP type command. The 
+        last written value is cached and the command is skipped when the 
+        value did not change. The cache is only updated once the value has
+        been written, within a batch when the batch has been sent.'''
+        key = (header, name)
+        if self._batch is not None:
+            if self._batchParams.get(key, self._paramCache.get(key)) == value:
+                return
+            self._batchParams[key] = value
+            self._batch.append((header, name, value))
+        else:
+            if self._paramCache.get(key) == value:
+                return
+            self._timedWrite('%s %s, %s' % (header, name, value))
+            self._paramCache[key] = value
+
+    def invalidateCache(self):
+        '''forget cached parameter values and output states, for instance 
+        after settings were changed on the front panel'''
+        self._paramCache = dict()
+        self._outputState = dict()
+
+    @contextmanager
+    def batch(self, sync=True):
+        '''collects all commands written within the with-block and sends them 
+        as a single ';' separated write, followed by one *OPC? query.
+
+        with awg.batch():
+            awg.setParameter('C1:BSWV', 'PERI', '1E-3')
+            awg.setOutput(1, True)'''
+        if self._batch is not None:
+            # nested batch, commands end up in the outer batch
+            yield
+            return
+        self._batch = []
+        self._batchParams = dict()
+        try:
+            yield
+        except:
+            # commands are not sent, cached values are no longer valid
+            self._batch = None
+            self.invalidateCache()
+            raise
+        (commands, params) = (self._batch, self._batchParams)
+        self._batch = None
+        try:
+            self._sendBatch(commands, params, sync)
+        except:
+            self.invalidateCache()
+            raise
+
+    def _sendBatch(self, commands, params, sync=True):
+        # consecutive parameters with the same header are merged into one 
+        # command: C1:BSWV PERI, 1E-3, WIDTH, 1E-5
+        merged = []
+        for item in commands:
+            if isinstance(item, tuple):
+                (header, name, value) = item
+                if merged and isinstance(merged[-1], list) and merged[-1][0] == header:
+                    merged[-1].extend([name, value])
+                else:
+                    merged.append([header, name, value])
+            else:
+                merged.append(item)
+        if not merged:
+            return
+        lines = []
+        for item in merged:
+            if isinstance(item, list):
+                lines.append('%s %s' % (item[0], ', '.join(item[1:])))
+            else:
+                lines.append(item)
+        message = ';'.join(lines)
+        log.debug('AWG batch: %s' % message)
+        self._timedWrite(message)
+        self._paramCache.update(params)
+        if sync:
+            self.waitOperationComplete()
+
     def getAwgInfo(self):
         self.awginfo = struct
-        idn = self.awgDev.ask('*IDN?').strip()
+        idn = self.query('*IDN?').strip()
         [mfg, model, serialNr, fwVersion] = idn.split(',')
         self.awginfo.model = model
         self.awginfo.serialNr = serialNr
@@ -87,25 +280,29 @@ class Sdg2000x():
         log.debug('AWG id: %s' % idn)
 
     def prepareSettings(self):
-        self.awgDev.write('*RST')   # reset to factory defaults
-        time.sleep(0.25)
-        self.awgDev.write('BUZZ OFF')
-        self.setOutput(2, False)
-        self.setOutput(1, False)
-        self.setLoad(1, self.awg_ini['load1'])
-        self.setLoad(2, self.awg_ini['load2'])
-        self.awgDev.write('C1:OUTP PLRT, NOR')
-        self.awgDev.write('C2:OUTP PLRT, NOR')
-        # set waveform for Channel 2 to DC offset
-        self.awgDev.write('C2:BSWV WVTP, DC')
-        self.awgDev.write('C2:BSWV OFST, 0.0V')
-        self.setOutput(2,False)
-        self.awgDev.write('C1:BSWV WVTP, PULSE')
-        self.awgDev.write('C1:BSWV LLEV, 0V')
-        self.awgDev.write('C1:BSWV HLEV, 0.1V')
-        self.awgDev.write('C1:BTWV STATE, ON')
-        self.awgDev.write('C1:BTWV TRSR, MAN')        
-        self.setOutput(1,True)
+        self.write('*RST')   # reset to factory defaults
+        self.invalidateCache()
+        self.waitOperationComplete()
+        # after a reset both outputs are off
+        self._outputState = {1: False, 2: False}
+        with self.batch():
+            self.write('BUZZ OFF')
+            self.setOutput(2, False)
+            self.setOutput(1, False)
+            self.setLoad(1, self.awg_ini['load1'])
+            self.setLoad(2, self.awg_ini['load2'])
+            self.setParameter('C1:OUTP', 'PLRT', 'NOR')
+            self.setParameter('C2:OUTP', 'PLRT', 'NOR')
+            # set waveform for Channel 2 to DC offset
+            self.setParameter('C2:BSWV', 'WVTP', 'DC')
+            self.setParameter('C2:BSWV', 'OFST', '0.000V')
+            self.setOutput(2,False)
+            self.setParameter('C1:BSWV', 'WVTP', 'PULSE')
+            self.setParameter('C1:BSWV', 'LLEV', '0V')
+            self.setParameter('C1:BSWV', 'HLEV', '0.1000V')
+            self.setParameter('C1:BTWV', 'STATE', 'ON')
+            self.setParameter('C1:BTWV', 'TRSR', 'MAN')
+            self.setOutput(1,True)
         
 
     def setLoad(self, channel, load):
@@ -119,7 +316,7 @@ class Sdg2000x():
             log.error('AWG: specified invalid output load')
             raise AwgError('AWG invalid output load')
         if channel in (1, 2):
-                self.awgDev.write('C%d:OUTP LOAD, %s' % (channel, str(load)))
+                self.setParameter('C%d:OUTP' % channel, 'LOAD', str(load))
                 log.debug('AWG enabled channel %d' % channel)
         else:
             log.error('AWG: specified invalid output channel')
@@ -131,23 +328,28 @@ class Sdg2000x():
             msg = 'intensity outside range 0 to 10 Volt!'
             log.error(msg)
             raise AwgError(msg)
-        self.awgDev.write('C2:BSWV OFST, %.3fV' % intensity)
+        self.setParameter('C2:BSWV', 'OFST', '%.3fV' % intensity)
+
+    def _writeBurstSettings(self, period, width, cycles, height):
+        # only parameters which differ from the cached values are sent
+        self.setParameter('C1:BSWV', 'WVTP', 'PULSE')
+        self.setParameter('C1:BSWV', 'LLEV', '0V')
+        self.setParameter('C1:BSWV', 'HLEV', '%.4fV' % height)
+        self.setParameter('C1:BSWV', 'PERI', '%.5E' % period)
+        self.setParameter('C1:BSWV', 'WIDTH', '%.5E' % width)
+        self.setParameter('C1:BSWV', 'DLY', '0')
+        self.setParameter('C1:BSWV', 'RISE', '8.4E-9S')
+        self.setParameter('C1:BSWV', 'FALL', '8.4E-9S')
+        self.setParameter('C1:BTWV', 'STATE', 'ON')
+        self.setParameter('C1:BTWV', 'TRSR', 'MAN')
+        self.setParameter('C1:BTWV', 'GATE_NCYC', 'NCYC')
+        self.setParameter('C1:BTWV', 'TIME', '%d' % cycles)
 
     def prepareBurst(self, period, width, cycles):
         # height for sending TTL pulse to the digital input
         height = 4.5
-        self.awgDev.write('C1:BSWV WVTP, PULSE')
-        self.awgDev.write('C1:BSWV LLEV, 0V')
-        self.awgDev.write('C1:BSWV HLEV, %.4fV' % height)
-        self.awgDev.write('C1:BSWV PERI, %.5E'  % period)
-        self.awgDev.write('C1:BSWV WIDTH, %.5E' % width)
-        self.awgDev.write('C1:BSWV DLY, 0')
-        self.awgDev.write('C1:BSWV RISE, 8.4E-9S')
-        self.awgDev.write('C1:BSWV FALL, 8.4E-9S')
-        self.awgDev.write('C1:BTWV STATE, ON')
-        self.awgDev.write('C1:BTWV TRSR, MAN')
-        self.awgDev.write('C1:BTWV GATE_NCYC, NCYC')
-        self.awgDev.write('C1:BTWV TIME, %d' % cycles)
+        with self.batch():
+            self._writeBurstSettings(period, width, cycles, height)
         self.isArmed = True
         self.duration = cycles * period
         msg ='AWG armed: width=%.3Es, nr of cycles=%d, period=%.3Es and TTL height=%.3E' % (width, cycles, period, height)
@@ -158,12 +360,8 @@ class Sdg2000x():
         if not self.isArmed:
             raise AwgError('awg is not armed')
         try:
-            self.setOutput(2,True)
-            time.sleep(0.25)
-            self.getOutput(2)
-            self.awgDev.write('C1:BTWV MTRIG')
-            log.info('triggered AWG')
-            time.sleep(self.duration+0.4)
+            self.triggerBurst()
+            self.waitForBurst(self.triggerTime)
             self.setOutput(2,False)
         except Exception as e:
             msg = 'error during attempt to shoot laser, disarm. Error: %s' % e
@@ -173,41 +371,66 @@ class Sdg2000x():
         self.isArmed = False
         log.info('disarmed AWG')
 
+    def triggerBurst(self):
+        '''enables channel 2 and triggers the armed burst without waiting for
+        it to complete, finishBurst() must be called afterwards. Returns the
+        trigger time.'''
+        if not self.isArmed:
+            raise AwgError('awg is not armed')
+        self.setOutput(2,True)
+        self.waitOperationComplete()
+        self.write('C1:BTWV MTRIG')
+        # after the write returned, the burst can not have started earlier
+        triggerTime = time.time()
+        self.triggerTime = triggerTime
+        log.info('triggered AWG')
+        return triggerTime
+
+    def finishBurst(self):
+        '''waits for the burst started by triggerBurst() to complete, then
+        disables channel 2 and disarms'''
+        try:
+            self.waitForBurst(self.triggerTime)
+        finally:
+            self.setOutput(2,False)
+            self.isArmed = False
+            log.info('disarmed AWG')
+
     def prepareBurstWithoutArm(self, period, width, cycles):
         # METHOD ASSUMES OUTPUTS ARE ENABLED!!!
         # height for sending TTL pulse to the digital input
         height = 4.5
-        self.setOutput(2,False)
-        self.awgDev.write('C1:BSWV WVTP, PULSE')
-        self.awgDev.write('C1:BSWV LLEV, 0V')
-        self.awgDev.write('C1:BSWV HLEV, %.4fV' % height)
-        self.awgDev.write('C1:BSWV PERI, %.5E'  % period)
-        self.awgDev.write('C1:BSWV WIDTH, %.5E' % width)
-        self.awgDev.write('C1:BSWV DLY, 0')
-        self.awgDev.write('C1:BSWV RISE, 8.4E-9S')
-        self.awgDev.write('C1:BSWV FALL, 8.4E-9S')
-        self.awgDev.write('C1:BTWV STATE, ON')
-        self.awgDev.write('C1:BTWV TRSR, MAN')
-        self.awgDev.write('C1:BTWV GATE_NCYC, NCYC')
-        self.awgDev.write('C1:BTWV TIME, %d' % cycles)
         try:
-            int(self.awgDev.query('*OPC?'))
+            with self.batch(sync=False):
+                self.setOutput(2,False)
+                self._writeBurstSettings(period, width, cycles, height)
         except:
-            pass
+            # the burst settings are unknown, make sure the intensity is off
+            try:
+                self._timedWrite('C2:OUTP OFF')
+                self._outputState[2] = False
+            except Exception as e:
+                log.error('could not disable channel 2 after failed burst preparation: %s' % e)
+            raise
+        try:
+            self.waitOperationComplete()
+        except AwgError as e:
+            log.warning('no response on *OPC? after preparing burst: %s' % e)
         self.duration = cycles * period + width
         msg ='AWG prepared: width=%.3Es, nr of cycles=%d, period=%.3Es and TTL height=%.3E' % (width, cycles, period, height)
         print(msg)
         logging.info(msg)
-        time.sleep(1)
         self.setOutput(2,True)
-        time.sleep(1)
+        self.waitOperationComplete()
 
     def sendBurstWithoutArm(self):
         # METHOD ASSUMES OUTPUTS ARE ENABLED!!!
         try:
-            self.awgDev.write('C1:BTWV MTRIG')
+            self.write('C1:BTWV MTRIG')
+            triggerTime = time.time()
+            self.triggerTime = triggerTime
             log.info('triggered AWG')
-            time.sleep(self.duration+0.1)
+            self.waitForBurst(triggerTime)
         except Exception as e:
             msg = 'error during attempt to shoot laser. Error: %s' % e
             print(msg)
@@ -220,14 +443,21 @@ class Sdg2000x():
             raise AwgError('invalid state, boolean expected')
         if channel in (1, 2):
             if state:
-                self.awgDev.write('C%d:OUTP ON' % channel)
+                self.write('C%d:OUTP ON' % channel)
+                self._outputState[channel] = True
                 log.debug('AWG enabled channel %d' % channel)
             else:
-                if channel == 1 and self.getOutput(2):
-                    msg = 'first turn of channel 2 before turning off channel 1!!!'
-                    log.error(msg)
-                    raise AwgError(msg)
-                self.awgDev.write('C%d:OUTP OFF' % channel)
+                if channel == 1:
+                    # the state of channel 2 is only queried when it is unknown
+                    ch2State = self._outputState.get(2)
+                    if ch2State is None:
+                        ch2State = self.getOutput(2)
+                    if ch2State:
+                        msg = 'first turn of channel 2 before turning off channel 1!!!'
+                        log.error(msg)
+                        raise AwgError(msg)
+                self.write('C%d:OUTP OFF' % channel)
+                self._outputState[channel] = False
                 log.debug('AWG disabled channel %d' % channel)
         else:
             raise AwgError('invalid channel')
@@ -235,13 +465,15 @@ class Sdg2000x():
     def getOutput(self, channel):
         # returns True when Output is enabled and False if not
         if channel in (1, 2):
-            answer = self.awgDev.ask('C%d:OUTP?' % channel)
+            answer = self.query('C%d:OUTP?' % channel)
             log.debug('AWG channel %d status: %s' % (channel, str(answer)))
             if len(answer) > 12:
                 state = answer.split(',')[0][8:]
                 if state == 'OFF':
+                    self._outputState[channel] = False
                     return False
                 elif state == 'ON':
+                    self._outputState[channel] = True
                     return True
                 else:
                     msg = 'invalid state answer'
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Job queue for shooting series of dimples, e.g. parameter sweeps over many
+fibres.
+
+Shot specs are dicts with the keyword arguments of
+DimpleShooting.prepareShot() (width, height, nr_pulses, period), missing
+values are taken from the dimple_shooting section of fdms.ini. A spec may
+carry an 'id' (used to resume from a shot log) and a 'label'.
+
+The executor picks the next job with the least AWG reconfiguration, so
+shots with equal burst settings are grouped and the parameter cache of
+Sdg2000x skips all unchanged settings. While a burst is running the next job
+is selected and the previous shot is logged, the AWG is re-armed as soon as
+the burst is complete. Every shot is appended to a csv shot log with the
+power used for the height correction and the timing.
+
+A failure before the trigger marks the job 'failed', resume() shoots it
+again. A failure after the trigger (e.g. while waiting for the end of the
+burst) marks the job 'fired' with the error attached: the dimple was shot,
+so the job is never requeued automatically.
+
+usage:
+    queue = shot_queue.ShotQueue(shoot, logFile='shots.csv')
+    queue.submit([{'width': 5E-6, 'height': 7.5}, {'width': 1E-5, 'height': 7.0}])
+    queue.start()
+    queue.abort()       # stops after the current shot
+    queue.resume()      # continues with the remaining jobs
+
+@author: eschenm
+'''
+
+import os
+import csv
+import time
+import logging
+from threading import Thread, Event, Lock
+
+log = logging.getLogger('shot_queue')
+
+
+class ShotQueueError(Exception):
+    pass
+
+
+class ShotQueue():
+    BURST_PARAMETERS = ('period', 'width', 'nr_pulses')
+    LOG_HEADER = 'id,label,status,width,nr_pulses,period,height,corrected_height,power,prepare_time,trigger_time,shot_time,error\n'
+
+    def __init__(self, shoot, logFile=None, correctPower=True, reorder=True, beforeShot=None):
+        '''shoot           dimple_shooting.DimpleShooting instance
+        logFile         csv shot log, None disables logging
+        correctPower    correct the pulse height for the laser power
+        reorder         minimise AWG reconfiguration by reordering the jobs,
+                        otherwise the jobs are shot in order of submission
+        beforeShot      optional function called with the job dict before
+                        each shot, e.g. to position the next fibre. An
+                        exception aborts the queue.
+        '''
+        self.shoot = shoot
+        self.logFile = logFile
+        self.correctPower = correctPower
+        self.reorder = reorder
+        self.beforeShot = beforeShot
+        self.jobs = []
+        self._lock = Lock()
+        self._abort = Event()
+        self._thread = None
+        self._current = None
+        if logFile is not None and not os.path.exists(logFile):
+            with open(logFile, 'w') as f:
+                f.write(self.LOG_HEADER)
+
+    def submit(self, specs):
+        '''adds a list of shot specs to the queue, returns the job ids'''
+        ids = []
+        with self._lock:
+            for spec in specs:
+                spec = dict(spec)
+                unknown = set(spec) - set(self.BURST_PARAMETERS) - set(('height', 'id', 'label'))
+                if unknown:
+                    raise ShotQueueError('unknown shot parameters: %s' % ', '.join(sorted(unknown)))
+                jobId = str(spec.pop('id', len(self.jobs)))
+                if any(job['id'] == jobId for job in self.jobs):
+                    raise ShotQueueError('duplicate job id: %s' % jobId)
+                label = spec.pop('label', '')
+                settings = self._settings(spec)
+                self.jobs.append({'id': jobId, 'label': label, 'spec': spec,
+                                  'settings': settings, 'status': 'pending'})
+                ids.append(jobId)
+        log.info('submitted %d shots, %d pending' % (len(ids), len(self.pending())))
+        return ids
+
+    def _settings(self, spec):
+        # resolved (period, width, nr_pulses, height) of a spec
+        ini = self.shoot.dimple_shooting_ini
+        return (float(spec.get('period', ini['period'])),
+                float(spec.get('width', ini['width'])),
+                int(spec.get('nr_pulses', ini['nr_pulses'])),
+                float(spec.get('height', ini['default_height'])))
+
+    def pending(self):
+        return [job for job in self.jobs if job['status'] == 'pending']
+
+    def markDone(self, logFile=None):
+        '''marks jobs which were shot according to the shot log as done (or
+        fired), to resume an interrupted series in a new session. Returns
+        the number of jobs marked.'''
+        if logFile is None:
+            logFile = self.logFile
+        shot = dict()
+        with open(logFile, 'r', newline='') as f:
+            rows = list(csv.reader(f))[1:]
+        for fields in rows:
+            if len(fields) > 2 and fields[2] in ('done', 'fired'):
+                shot[fields[0]] = fields[2]
+        nr = 0
+        with self._lock:
+            for job in self.jobs:
+                if job['status'] == 'pending' and job['id'] in shot:
+                    job['status'] = shot[job['id']]
+                    nr += 1
+        log.info('marked %d jobs as done from shot log %s' % (nr, logFile))
+        return nr
+
+    def _nextJob(self, previous):
+        # pending job needing the least AWG reconfiguration after previous
+        with self._lock:
+            jobs = [job for job in self.jobs if job['status'] == 'pending' and job is not previous]
+        if not jobs:
+            return None
+        if not self.reorder or previous is None:
+            return jobs[0]
+        def cost(job):
+            burst = sum(a != b for (a, b) in zip(job['settings'][:3], previous['settings'][:3]))
+            return (burst, job['settings'][3] != previous['settings'][3])
+        # min() returns the first job of equal cost, so submission order is kept within a group
+        return min(jobs, key=cost)
+
+    def start(self):
+        '''starts shooting the pending jobs in a background thread'''
+        if self.isRunning():
+            raise ShotQueueError('shot queue is already running')
+        self._abort.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        '''shoots the pending jobs, blocks until done or aborted'''
+        self._abort.clear()
+        self._run()
+
+    def abort(self, wait=True):
+        '''stops the queue after the shot in progress'''
+        self._abort.set()
+        log.info('shot queue abort requested')
+        if wait:
+            self.wait()
+
+    def resume(self):
+        '''continues with the remaining jobs after an abort or a failed shot.
+        Jobs which failed before the trigger are shot again, fired jobs are
+        not.'''
+        with self._lock:
+            for job in self.jobs:
+                if job['status'] == 'failed':
+                    job['status'] = 'pending'
+        self.start()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.isRunning()
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _arm(self, job):
+        (period, width, cycles, height) = job['settings']
+        start = time.time()
+        self.shoot.prepareShot(width=width, height=height, nr_pulses=cycles, period=period)
+        job['prepareTime'] = time.time() - start
+
+    def _run(self):
+        job = self._nextJob(None)
+        if job is None:
+            print('no pending shots')
+            return
+        msg = 'start shooting %d pending shots' % len(self.pending())
+        print(msg)
+        log.info(msg)
+        start = time.time()
+        nr = 0
+        try:
+            while job is not None:
+                self._current = job
+                fired = False
+                try:
+                    self._arm(job)
+                    if self.beforeShot is not None:
+                        self.beforeShot(job)
+                    (power, height, triggerTime) = self.shoot.triggerShot(self.correctPower)
+                    fired = True
+                    job.update({'power': power, 'correctedHeight': height, 'triggerTime': triggerTime})
+                    # select the next job while the burst is running
+                    nextJob = self._nextJob(job)
+                    self.shoot.finishShot(self.correctPower)
+                    job['shotTime'] = time.time() - triggerTime
+                    job['status'] = 'done'
+                    nr += 1
+                except Exception as err:
+                    # a fired job has a dimple and must not be shot again
+                    job['status'] = 'fired' if fired else 'failed'
+                    job['error'] = str(err)
+                    self._writeLog(job)
+                    if fired:
+                        nr += 1
+                        msg = 'shot %s failed after the trigger, queue stopped: %s' % (job['id'], err)
+                    else:
+                        msg = 'shot %s failed, queue stopped: %s' % (job['id'], err)
+                    print(msg)
+                    log.error(msg)
+                    return
+                self._writeLog(job)
+                if self._abort.is_set():
+                    msg = 'shot queue aborted, %d shots pending' % len(self.pending())
+                    print(msg)
+                    log.warning(msg)
+                    return
+                job = nextJob
+        finally:
+            self._current = None
+            duration = time.time() - start
+            msg = 'shot %d dimples in %.1f s' % (nr, duration)
+            print(msg)
+            log.info(msg)
+
+    def _writeLog(self, job):
+        if self.logFile is None:
+            return
+        (period, width, cycles, height) = job['settings']
+        # label and error are free text, the csv module quotes commas
+        txt = '%.5E,%d,%.5E,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f'
+        vals = (width, cycles, period, height,
+                job.get('correctedHeight', float('nan')), job.get('power', float('nan')),
+                job.get('prepareTime', float('nan')), job.get('triggerTime', float('nan')),
+                job.get('shotTime', float('nan')))
+        row = [job['id'], job['label'], job['status']] + (txt % vals).split(',') + [job.get('error', '')]
+        try:
+            with open(self.logFile, 'a', newline='') as f:
+                csv.writer(f, lineterminator='\n').writerow(row)
+        except Exception as error:
+            log.error('error during writing to file %s: %s' % (self.logFile, error))
+
+    def printStatus(self):
+        with self._lock:
+            counts = dict()
+            for job in self.jobs:
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        print('shot queue: %s' % ', '.join('%d %s' % (v, k) for (k, v) in sorted(counts.items())))
+        if self._current is not None:
+            print('shooting job %s' % self._current['id'])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''M. Eschen, 2017
+
+Lightweight timing instrumentation with named spans.
+
+    import timing
+    timing.enable()
+    with timing.span('camera.fetch'):
+        image = cam.get_image()
+    timing.timer.logSummary()
+
+Every span is recorded in the global timer and in all timers collecting at
+that moment, which gives a breakdown per measurement:
+
+    with timing.collect() as timer:
+        ... measurement ...
+    timer.logSummary()
+    timer.toAttrs(dataset.attrs)
+
+Spans from all threads of the process are recorded, spans of another
+process (e.g. the PID loop of pidControl.PidProcessController) are not.
+When timing is disabled span() returns a shared no-op context manager, the
+overhead is then a single function call.
+
+@author: eschenm
+'''
+
+import time
+import logging
+from threading import Lock
+
+log = logging.getLogger('timing')
+
+
+class Timer():
+    def __init__(self):
+        '''accumulates count, total and maximum duration per span name'''
+        self._stats = dict()
+        self._lock = Lock()
+        self.start = time.time()
+
+    def add(self, name, duration):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict()
+            self.start = time.time()
+
+    def getStats(self):
+        '''returns dict name: {'count', 'total', 'mean', 'max'} with times in s'''
+        with self._lock:
+            items = [(name, list(stats)) for (name, stats) in self._stats.items()]
+        return dict((name, {'count': count, 'total': total, 'mean': total / count, 'max': maximum})
+                    for (name, (count, total, maximum)) in items)
+
+    def summary(self):
+        '''returns the statistics as a text table sorted by name'''
+        stats = self.getStats()
+        elapsed = time.time() - self.start
+        lines = ['%-24s %7s %10s %10s %10s %6s' % ('span', 'count', 'total (ms)', 'mean (ms)', 'max (ms)', '%')]
+        for name in sorted(stats):
+            s = stats[name]
+            lines.append('%-24s %7d %10.1f %10.3f %10.3f %6.1f' %
+                         (name, s['count'], s['total']*1e3, s['mean']*1e3, s['max']*1e3, 100*s['total']/elapsed))
+        lines.append('elapsed: %.1f ms' % (elapsed*1e3))
+        return '\n'.join(lines)
+
+    def printSummary(self):
+        print(self.summary())
+
+    def logSummary(self, logger=None, title='timing summary'):
+        if logger is None:
+            logger = log
+        logger.info('%s:' % title)
+        for line in self.summary().splitlines():
+            logger.info('\t%s' % line)
+
+    def toAttrs(self, attrs, prefix='timing_'):
+        '''stores the statistics in hdf5 attributes, see writeAttrs()'''
+        writeAttrs(self.getStats(), attrs, prefix)
+        attrs[prefix + 'elapsed'] = time.time() - self.start
+
+
+class _Span():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_enabled = False
+_collectors = []
+_collectorsLock = Lock()
+# accumulates all spans since timing was enabled
+timer = Timer()
+
+
+def enable(state=True):
+    global _enabled
+    if state and not _enabled:
+        timer.reset()
+    _enabled = bool(state)
+    log.info('%s timing instrumentation' % ['disabled', 'enabled'][_enabled])
+
+
+def disable():
+    enable(False)
+
+
+def isEnabled():
+    return _enabled
+
+
+def span(name):
+    '''context manager timing the enclosed block as span name'''
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def record(name, duration):
+    '''records a duration in s measured elsewhere'''
+    if not _enabled:
+        return
+    timer.add(name, duration)
+    for collector in _collectors:
+        collector.add(name, duration)
+
+
+def writeAttrs(stats, attrs, prefix='timing_'):
+    '''stores statistics as returned by Timer.getStats() in hdf5 attributes,
+    one attribute per span name with [count, total, max] in s'''
+    for (name, s) in stats.items():
+        attrs[prefix + name] = [s['count'], s['total'], s['max']]
+
+
+class collect():
+    '''context manager returning a Timer which receives all spans recorded
+    while the context is active'''
+    def __enter__(self):
+        self.timer = Timer()
+        with _collectorsLock:
+            _collectors.append(self.timer)
+        return self.timer
+
+    def __exit__(self, *args):
+        with _collectorsLock:
+            _collectors.remove(self.timer)
+        return False
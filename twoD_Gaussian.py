@@ -1,3 +1,6 @@
+import math
+from functools import lru_cache
+
 import numpy as np
 
 def twoD_GaussianWithTilt(xdata_tuple, amplitude, xo, yo, sigma_x, sigma_y, theta, offset, tiltX, tiltY):
@@ -40,5 +43,138 @@ def simple_twoD_Gaussian(xdata_tuple, amplitude, xo, yo, sigma_x, sigma_y, offse
     g = offset + amplitude*np.exp( -(a*((x-xo)**2) + c*((y-yo)**2)))
     return g.ravel()
 
-
     # source https://stackoverflow.com/questions/21566379/fitting-a-2d-gaussian-function-using-scipy-optimize-curve-fit-valueerror-and-m
+
+
+@lru_cache(maxsize=8)
+def coordinates(shape, scale=1.0, centered=False):
+    ''' (x, y) = coordinates(shape, scale=1.0, centered=False)
+
+    returns the 1D pixel coordinates of an image with the given (H, W) shape
+    centered=False:  0, 1, .. n-1 times scale (as used by fitCore)
+    centered=True:   linspace(0, n, n) times scale around zero (as used by 
+                     fitGauss and plotOverview)
+    The arrays are cached per (shape, scale, centered) and read-only.   '''
+
+    axes = []
+    for n in shape:
+        if centered:
+            c = np.linspace(0, n, n) * scale
+            c -= np.mean(c)
+        else:
+            c = np.arange(n) * scale
+        c.flags.writeable = False
+        axes.append(c)
+    (y, x) = axes
+    return (x, y)
+
+@lru_cache(maxsize=8)
+def grid(shape, scale=1.0, centered=False):
+    ''' (x, y) = grid(shape, scale=1.0, centered=False)
+
+    2D meshgrid of coordinates(shape, scale, centered), cached and read-only
+    '''
+    (x, y) = np.meshgrid(*coordinates(shape, scale, centered))
+    x.flags.writeable = False
+    y.flags.writeable = False
+    return (x, y)
+
+
+class GaussianModel(object):
+    '''model = GaussianModel(shape, scale=1.0, centered=False, kind='tilt')
+
+    2D Gauss on a fixed pixel grid, evaluated without temporary arrays
+    shape:     (H, W) of the image
+    scale:     size of a pixel, see coordinates()
+    kind:      'tilt'    parameters of twoD_GaussianWithTilt
+               'rotated' parameters of twoD_Gaussian
+               'simple'  parameters of simple_twoD_Gaussian
+    
+    The exponent is built from the separable terms (x-xo)**2 and (y-yo)**2 of
+    the 1D coordinates, so only the final image is written at full size. The
+    model can be passed to curve_fit directly, the xdata argument is ignored:
+        popt, pcov = curve_fit(model, None, data.ravel(), p0=p0)
+    evaluate() and the curve_fit call return the internal buffer of the model,
+    which is overwritten by the next evaluation. Use out= to keep a result.
+    '''
+
+    kinds = {'tilt': 9, 'rotated': 7, 'simple': 6}
+
+    def __init__(self, shape, scale=1.0, centered=False, kind='tilt'):
+        if kind not in self.kinds:
+            raise ValueError('unknown Gauss model: %s' % kind)
+        self.shape = tuple(shape)
+        self.scale = scale
+        self.centered = centered
+        self.kind = kind
+        (self.x, self.y) = coordinates(self.shape, scale, centered)
+        self._out = np.empty(self.shape)
+        self._dx = np.empty_like(self.x)
+        self._tx = np.empty_like(self.x)
+        self._dy = np.empty_like(self.y)
+        self._ty = np.empty_like(self.y)
+        self._sigmas = None
+
+    @property
+    def grid(self):
+        # 2D coordinates for plotting and masking
+        return grid(self.shape, self.scale, self.centered)
+
+    def __call__(self, xdata, *params):
+        return self.evaluate(*params).ravel()
+
+    def evaluate(self, *params, out=None):
+        ''' image = evaluate(*params, out=None)
+
+        returns the model image (H, W) for the parameters of the model kind
+        '''
+        if len(params) != self.kinds[self.kind]:
+            raise ValueError('%s Gauss model takes %d parameters, got %d' % 
+                             (self.kind, self.kinds[self.kind], len(params)))
+        (tiltX, tiltY) = (0, 0)
+        if self.kind == 'tilt':
+            (amplitude, xo, yo, sigma_x, sigma_y, theta, offset, tiltX, tiltY) = params
+        elif self.kind == 'rotated':
+            (amplitude, xo, yo, sigma_x, sigma_y, theta, offset) = params
+        else:
+            (amplitude, xo, yo, sigma_x, sigma_y, offset) = params
+            theta = 0
+        if out is None:
+            out = self._out
+        (a, b, c) = self._terms(float(sigma_x), float(sigma_y), float(theta))
+        (dx, dy, tx, ty) = (self._dx, self._dy, self._tx, self._ty)
+        np.subtract(self.x, float(xo), out=dx)
+        np.subtract(self.y, float(yo), out=dy)
+        # -(a*dx**2 + 2*b*dx*dy + c*dy**2), the cross term is the only full size product
+        if b:
+            np.multiply(dy, -2*b, out=ty)
+            np.multiply(ty[:, None], dx, out=out)
+        else:
+            out.fill(0.0)
+        np.multiply(dx, dx, out=tx)
+        tx *= -a
+        out += tx
+        np.multiply(dy, dy, out=ty)
+        ty *= -c
+        out += ty[:, None]
+        np.exp(out, out=out)
+        out *= amplitude
+        out += offset
+        if tiltX:
+            np.multiply(self.x, float(tiltX), out=tx)
+            out += tx
+        if tiltY:
+            np.multiply(self.y, float(tiltY), out=ty)
+            out += ty[:, None]
+        return out
+
+    def _terms(self, sigma_x, sigma_y, theta):
+        # coefficients of the quadratic form, kept while the widths and angle do not change
+        if self._sigmas != (sigma_x, sigma_y, theta):
+            (cos, sin, sin2) = (math.cos(theta), math.sin(theta), math.sin(2*theta))
+            a = cos**2/(2*sigma_x**2) + sin**2/(2*sigma_y**2)
+            b = -sin2/(4*sigma_x**2) + sin2/(4*sigma_y**2)
+            c = sin**2/(2*sigma_x**2) + cos**2/(2*sigma_y**2)
+            self._sigmas = (sigma_x, sigma_y, theta)
+            self._abc = (a, b, c)
+        return self._abc
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compares accuracy and speed of the core position estimators in fit_core on
+synthetic cores: a 2D Gauss with random sub-pixel position, an offset and
+gaussian noise on a camera sized image.
+
+usage:  python utility/benchmarkCore.py
+
+@author: eschenm
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fit_core
+
+nrImages = 50
+shape = (960, 1280)
+amplitude = 3000
+offset = 50
+noise = 20
+sigmas = (2, 4, 8)
+
+rng = np.random.default_rng(0)
+(y, x) = np.mgrid[0:shape[0], 0:shape[1]]
+methods = ('parabola', 'moments', 'precise fit')
+
+print('%d images %dx%d, amplitude %d, offset %d, noise %d (rms)' % (nrImages, shape[1], shape[0], amplitude, offset, noise))
+print('%-12s %6s %14s %14s %12s' % ('method', 'sigma', 'pos err (px)', 'sigma err (%)', 'time (us)'))
+for sigma in sigmas:
+    images = []
+    truth = []
+    for ii in range(nrImages):
+        (x0, y0) = rng.uniform(100, shape[1]-100), rng.uniform(100, shape[0]-100)
+        img = offset + amplitude*np.exp(-((x-x0)**2 + (y-y0)**2)/(2*sigma**2)) + rng.normal(0, noise, shape)
+        images.append(np.clip(img, 0, 65535).astype(np.uint16))
+        truth.append((x0, y0))
+    # the argmax over the full image takes about the same time for every method
+    peaks = [np.unravel_index(np.argmax(img), shape) for img in images]
+    for name in methods:
+        if name == 'precise fit':
+            start = time.perf_counter()
+            results = [fit_core.fitCoreImage(img)[0] for img in images]
+        else:
+            start = time.perf_counter()
+            results = [fit_core.estimateCore(img, peak=peak, method=name) for (img, peak) in zip(images, peaks)]
+        duration = (time.perf_counter() - start) / nrImages
+        posErr = [np.hypot(r[1]-tx, r[2]-ty) for (r, (tx, ty)) in zip(results, truth)]
+        sigmaErr = [(r[3]+r[4])/2/sigma - 1 for r in results]
+        print('%-12s %6.1f %14.3f %14.1f %12.0f' % (name, sigma, np.sqrt(np.mean(np.square(posErr))),
+                                                   100*np.sqrt(np.mean(np.square(sigmaErr))), duration*1E6))